@@ -0,0 +1,655 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+# Banco de pruebas de punta a punta con dobles locales (sin Gemini, Apify ni webs reales).
+#
+#   BENCH_DATABASE_URL=postgresql://localhost/bench python benchmark_pipeline.py --campanas 5 --prospectos 500
+#
+# Crea un esquema propio en la BD de pruebas (se borra al terminar salvo --conservar), siembra N campañas
+# y M prospectos, y corre Cazador -> Espía -> Analista -> Persuasor -> Nutridor -> endpoints de Flask
+# contra los dobles. Informa por etapa: throughput, latencia p50/p99 y viajes a la BD.
+# La semilla fija los datos y las latencias simuladas: dos corridas iguales son comparables.
+
+
+# --- CONTEO DE VIAJES A LA BD ---
+
+class ContadorViajes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+
+    def sumar(self, n=1):
+        with self._lock:
+            self.total += n
+
+_viajes = ContadorViajes()
+
+def fabrica_conexion(esquema):
+    """connection_factory del pool: cuenta cada execute/commit/rollback y fija el esquema del banco."""
+    import psycopg2.extensions
+
+    class CursorContado(psycopg2.extensions.cursor):
+        def execute(self, consulta, parametros=None):
+            _viajes.sumar()
+            return super().execute(consulta, parametros)
+
+        def executemany(self, consulta, secuencia):
+            secuencia = list(secuencia)
+            _viajes.sumar(len(secuencia))
+            return super().executemany(consulta, secuencia)
+
+    class ConexionContada(psycopg2.extensions.connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            cur = super().cursor()
+            cur.execute(f'SET search_path TO "{esquema}", public')
+            cur.close()
+            super().commit()
+            self.cursor_factory = CursorContado
+
+        def commit(self):
+            _viajes.sumar()
+            return super().commit()
+
+        def rollback(self):
+            _viajes.sumar()
+            return super().rollback()
+
+    return ConexionContada
+
+
+# --- DOBLES LOCALES ---
+
+def _latencia(media, rnd):
+    """Latencia simulada alrededor de `media` (±50%), reproducible con la semilla."""
+    return max(0.0, media * rnd.uniform(0.5, 1.5)) if media > 0 else 0.0
+
+
+class WebLocal:
+    """Webs de prospectos: HTML con títulos y párrafos, latencia configurable y un % de errores 500."""
+
+    def __init__(self, latencia, tasa_error, semilla):
+        doble = self
+        self._rnd = random.Random(semilla)
+        self._lock = threading.Lock()
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with doble._lock:
+                    espera = _latencia(latencia, doble._rnd)
+                    falla = doble._rnd.random() < tasa_error
+                time.sleep(espera)
+                if falla:
+                    cuerpo, estado = b"error", 500
+                else:
+                    nombre = self.path.strip("/").replace("/", " ")
+                    cuerpo = (f"<html><head><meta name='description' content='Negocio {nombre}'></head><body>"
+                              f"<h1>{nombre}</h1><h2>Servicios</h2>"
+                              + "".join(f"<p>Párrafo {i} sobre clientes, precios y horarios de {nombre}.</p>" for i in range(20))
+                              + "</body></html>").encode("utf-8")
+                    estado = 200
+                self.send_response(estado)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        self._servidor = ThreadingHTTPServer(("127.0.0.1", 0), Manejador)
+        self._servidor.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self._servidor.server_address[1]}"
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+
+    def cerrar(self):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+
+class _RespuestaGemini:
+    def __init__(self, texto):
+        self.text = texto
+
+
+class GeminiFalso:
+    """
+    Sustituye a GenerativeModel: responde según el prompt (JSON del Analista, array del Persuasor,
+    texto libre para emails y chat) tras una latencia simulada. stream=True entrega trozos.
+    """
+
+    def __init__(self, latencia, tasa_descarte, tasa_error, semilla):
+        self.latencia = latencia
+        self.tasa_descarte = tasa_descarte
+        self.tasa_error = tasa_error
+        self._rnd = random.Random(semilla)
+        self._lock = threading.Lock()
+
+    def _sortear(self):
+        with self._lock:
+            return _latencia(self.latencia, self._rnd), self._rnd.random(), self._rnd.random()
+
+    @staticmethod
+    def _contenido(pid=None):
+        datos = {
+            "email_asunto": "Una idea para tu negocio",
+            "email_cuerpo": "Detectamos una oportunidad clara y preparamos una demostración personalizada.",
+            "prenido_titulo": "Más clientes sin más trabajo",
+            "prenido_mensaje": "Hicimos un análisis preliminar. Confirma tu correo para ver el reporte completo.",
+        }
+        return dict(datos, id=pid) if pid is not None else datos
+
+    def _texto(self, prompt, azar):
+        if "ANALISTA DE VENTAS" in prompt:
+            descartado = azar < self.tasa_descarte
+            return json.dumps({
+                "veredicto": "DESCARTADO" if descartado else "APROBADO",
+                "razon_descarte": "Red flag simulada" if descartado else None,
+                "perfil_demografico": {"tono_recomendado": "Profesional"},
+                "analisis_dolores": [{"dolor_detectado": "Falta de tiempo", "plan_ataque": "Automatizar"}],
+                "puntuacion_calidad": 80,
+            })
+        if "ARRAY JSON" in prompt:
+            return json.dumps([self._contenido(pid) for pid in re.findall(r'- id: "([^"]+)"', prompt)])
+        if "Copywriting" in prompt:
+            return json.dumps(self._contenido())
+        return "Gracias por escribirnos. Te cuento cómo podemos ayudarte con tu negocio esta misma semana."
+
+    def generate_content(self, prompt, stream=False, **opciones):
+        espera, azar_error, azar = self._sortear()
+        time.sleep(espera)
+        if azar_error < self.tasa_error:
+            raise RuntimeError("503 Servicio no disponible (simulado)")
+        texto = self._texto(str(prompt), azar)
+        if stream:
+            palabras = texto.split(" ")
+            return iter([_RespuestaGemini(" ".join(palabras[i:i + 5]) + " ") for i in range(0, len(palabras), 5)])
+        return _RespuestaGemini(texto)
+
+
+class ApifyFalso:
+    """
+    Sustituye a ApifyClient. Los actores de búsqueda van llenando su dataset durante `latencia`
+    segundos (el Cazador en streaming lo lee mientras corre); el de Instagram responde al final.
+    """
+
+    def __init__(self, web_base, latencia, tasa_contacto, semilla):
+        self.web_base = web_base
+        self.latencia = latencia
+        self.tasa_contacto = tasa_contacto
+        self._rnd = random.Random(semilla)
+        self._lock = threading.Lock()
+        self._corridas = {}
+        self._siguiente = 0
+
+    # El cliente real se crea con ApifyClient(token): la instancia hace de clase
+    def __call__(self, token=None):
+        return self
+
+    def _nueva_corrida(self, actor_id, entrada):
+        with self._lock:
+            self._siguiente += 1
+            rid = f"run-{self._siguiente}"
+            duracion = _latencia(self.latencia, self._rnd)
+            if "instagram-scraper" in actor_id:
+                items = [{"username": u, "businessEmail": f"{u}@bench.local"}
+                         for u in entrada.get("usernames", []) if self._rnd.random() < self.tasa_contacto]
+            else:
+                lote = "%06x" % self._rnd.getrandbits(24)
+                items = []
+                for i in range(int(entrada.get("maxItems", 10))):
+                    con_contacto = self._rnd.random() < self.tasa_contacto
+                    items.append({
+                        "title": f"Bench {lote} {i}",
+                        "website": f"{self.web_base}/{lote}/{i}",
+                        "phone": f"+1555{self._rnd.randint(1000000, 9999999)}" if con_contacto else None,
+                    })
+            self._corridas[rid] = {"inicio": time.monotonic(), "duracion": duracion, "items": items, "abortada": False}
+        return rid
+
+    def _producidos(self, c):
+        if c["abortada"] or c["duracion"] <= 0:
+            return len(c["items"]) if not c["abortada"] else c.get("cortados", 0)
+        fraccion = min(1.0, (time.monotonic() - c["inicio"]) / c["duracion"])
+        return int(len(c["items"]) * fraccion)
+
+    def _estado(self, c):
+        if c["abortada"]:
+            return "ABORTED"
+        return "SUCCEEDED" if time.monotonic() - c["inicio"] >= c["duracion"] else "RUNNING"
+
+    def _run(self, rid):
+        return {"id": rid, "defaultDatasetId": rid, "status": self._estado(self._corridas[rid])}
+
+    # --- API usada por los trabajadores ---
+
+    def actor(self, actor_id):
+        falso = self
+
+        class Actor:
+            def call(self, run_input=None, **kw):
+                rid = falso._nueva_corrida(actor_id, run_input or {})
+                time.sleep(falso._corridas[rid]["duracion"])
+                return falso._run(rid)
+
+            def start(self, run_input=None, **kw):
+                return falso._run(falso._nueva_corrida(actor_id, run_input or {}))
+
+        return Actor()
+
+    def run(self, rid):
+        falso = self
+
+        class Corrida:
+            def get(self):
+                return falso._run(rid)
+
+            def abort(self):
+                c = falso._corridas[rid]
+                c["cortados"] = falso._producidos(c)
+                c["abortada"] = True
+
+        return Corrida()
+
+    def dataset(self, rid):
+        falso = self
+
+        class Pagina:
+            def __init__(self, items):
+                self.items = items
+
+        class Dataset:
+            def iterate_items(self):
+                c = falso._corridas[rid]
+                return iter(c["items"][:falso._producidos(c)])
+
+            def list_items(self, offset=0, limit=100, **kw):
+                c = falso._corridas[rid]
+                return Pagina(c["items"][offset:min(offset + limit, falso._producidos(c))])
+
+            def get(self):
+                return {"itemCount": falso._producidos(falso._corridas[rid])}
+
+        return Dataset()
+
+
+# --- BD DEL BANCO ---
+
+_SQL_ESQUEMA = """
+CREATE TABLE clients (
+    id SERIAL PRIMARY KEY,
+    email TEXT UNIQUE,
+    is_active BOOLEAN DEFAULT TRUE,
+    status TEXT DEFAULT 'active'
+);
+CREATE TABLE campaigns (
+    id SERIAL PRIMARY KEY,
+    client_id INTEGER REFERENCES clients(id),
+    campaign_name TEXT,
+    product_description TEXT,
+    target_audience TEXT,
+    product_type TEXT DEFAULT 'Tangible',
+    geo_location TEXT,
+    daily_prospects_limit INTEGER DEFAULT 4,
+    ticket_price TEXT,
+    red_flags TEXT,
+    pain_points_defined TEXT,
+    competitors TEXT,
+    tone_voice TEXT,
+    status TEXT DEFAULT 'active',
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE TABLE prospects (
+    id BIGSERIAL PRIMARY KEY,
+    campaign_id INTEGER REFERENCES campaigns(id),
+    business_name TEXT,
+    website_url TEXT,
+    phone_number TEXT,
+    captured_email TEXT,
+    social_profiles JSONB DEFAULT '{}'::jsonb,
+    source_bot_id TEXT,
+    status TEXT,
+    raw_data JSONB,
+    pain_points JSONB,
+    generated_content JSONB,
+    access_token TEXT UNIQUE,
+    draft_message TEXT,
+    last_interaction_at TIMESTAMPTZ,
+    nurture_interactions_count INTEGER DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW(),
+    UNIQUE (campaign_id, business_name)
+);
+CREATE INDEX idx_prospects_campaign_status ON prospects (campaign_id, status);
+CREATE TABLE bot_arsenal (
+    platform TEXT,
+    actor_id TEXT,
+    input_config JSONB,
+    is_active BOOLEAN DEFAULT TRUE,
+    confidence_level INTEGER DEFAULT 0
+);
+"""
+
+def sembrar(url, esquema, args, web_base):
+    """Crea el esquema del banco y siembra clientes, campañas y prospectos (fuera del conteo de viajes)."""
+    import psycopg2
+    from psycopg2.extras import execute_values, Json
+
+    rnd = random.Random(args.semilla)
+    conn = psycopg2.connect(url)
+    with conn, conn.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS "{esquema}" CASCADE; CREATE SCHEMA "{esquema}"; SET search_path TO "{esquema}", public;')
+        cur.execute(_SQL_ESQUEMA)
+        cur.execute("INSERT INTO clients (email) VALUES ('admin@autoneura.com') RETURNING id")
+        cliente = cur.fetchone()[0]
+        cur.execute("""
+            INSERT INTO bot_arsenal (platform, actor_id, input_config, confidence_level)
+            VALUES ('Google Maps', 'compass/crawler-google-places', '{}', 10)
+        """)
+        campanas = execute_values(cur, """
+            INSERT INTO campaigns (client_id, campaign_name, product_description, target_audience, geo_location,
+                                   daily_prospects_limit, ticket_price, tone_voice)
+            VALUES %s RETURNING id
+        """, [(cliente, f"Campaña {i}", f"Software de gestión {i}", "Restaurantes", "Miami", args.limite,
+               "$99", "Profesional") for i in range(args.campanas)], fetch=True)
+        campanas = [c[0] for c in campanas]
+
+        filas = []
+        for i in range(args.prospectos):
+            cid = campanas[i % len(campanas)]
+            con_contacto = rnd.random() < args.tasa_contacto
+            filas.append((cid, f"Semilla {i}", f"{web_base}/semilla/{i}",
+                          f"+1555{rnd.randint(1000000, 9999999)}" if con_contacto else None,
+                          f"semilla{i}@bench.local" if con_contacto else None,
+                          Json({}), "compass/crawler-google-places", "cazado", Json({"title": f"Semilla {i}"})))
+        execute_values(cur, """
+            INSERT INTO prospects (campaign_id, business_name, website_url, phone_number, captured_email,
+                                   social_profiles, source_bot_id, status, raw_data)
+            VALUES %s
+        """, filas, page_size=1000)
+    conn.close()
+    return campanas
+
+def borrar_esquema(url, esquema):
+    import psycopg2
+    conn = psycopg2.connect(url)
+    with conn, conn.cursor() as cur:
+        cur.execute(f'DROP SCHEMA IF EXISTS "{esquema}" CASCADE')
+    conn.close()
+
+
+# --- MEDICIÓN ---
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    # Rango más cercano: el menor valor que deja al menos p de la muestra a su izquierda
+    return valores[min(len(valores) - 1, max(0, math.ceil(p * len(valores)) - 1))]
+
+class Cronometro:
+    """Latencias de la unidad de trabajo de una etapa (una corrida, un prospecto, una petición)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = []
+
+    def envolver(self, funcion):
+        def medida(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.latencias.append(time.perf_counter() - inicio)
+        return medida
+
+def _transiciones():
+    import metricas
+    return sum(v for n, _, v in metricas._registro.foto()["contadores"]
+               if n == "autoneura_prospectos_transiciones_total")
+
+def _llamadas_llm():
+    from pasarela_llm import metricas_llm
+    return sum(d.get("llamadas", 0) for d in metricas_llm().values())
+
+def medir_etapa(nombre, ejecutar, cronometro, items=None):
+    """Corre `ejecutar()` y devuelve la fila del informe (items = transiciones si no se indican)."""
+    viajes0, trans0, llm0 = _viajes.total, _transiciones(), _llamadas_llm()
+    inicio = time.perf_counter()
+    ejecutar()
+    duracion = time.perf_counter() - inicio
+    procesados = items() if items else _transiciones() - trans0
+    viajes = _viajes.total - viajes0
+    return {
+        "etapa": nombre,
+        "items": procesados,
+        "segundos": round(duracion, 3),
+        "items_por_seg": round(procesados / duracion, 2) if duracion > 0 else 0.0,
+        "unidades": len(cronometro.latencias),
+        "p50_seg": round(percentil(cronometro.latencias, 0.50), 4),
+        "p99_seg": round(percentil(cronometro.latencias, 0.99), 4),
+        "viajes_bd": viajes,
+        "viajes_por_item": round(viajes / procesados, 2) if procesados else None,
+        "llamadas_llm": _llamadas_llm() - llm0,
+    }
+
+
+# --- ETAPAS ---
+
+def _contar_estado(estados):
+    from pool_conexiones import conexion
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM prospects WHERE status IN %s", (tuple(estados),))
+        return cur.fetchone()[0]
+
+def correr_pipeline(args, campanas, web_base):
+    import trabajador_cazador
+    import trabajador_espia
+    import trabajador_analista
+    import trabajador_persuasor
+    from trabajador_nutridor import TrabajadorNutridor
+
+    filas = []
+
+    crono = Cronometro()
+    caza = crono.envolver(trabajador_cazador.ejecutar_caza)
+    filas.append(medir_etapa("cazador", lambda: [
+        caza(cid, "restaurantes", "Miami", limite_diario_contratado=args.limite) for cid in campanas
+    ], crono))
+
+    crono = Cronometro()
+    espia = crono.envolver(trabajador_espia.ejecutar_espia)
+    filas.append(medir_etapa("espia", lambda: [espia(cid, args.limite) for cid in campanas], crono))
+
+    # Analista: unidad = un prospecto (analizar_prospecto se busca en el módulo en cada lote)
+    crono = Cronometro()
+    trabajador_analista.analizar_prospecto = crono.envolver(trabajador_analista.analizar_prospecto)
+
+    def analizar_todo():
+        while trabajador_analista.trabajar_analista(args.concurrencia_analista, continuo=False):
+            pass
+    filas.append(medir_etapa("analista", analizar_todo, crono))
+
+    # Persuasor: unidad = un lote reclamado
+    crono = Cronometro()
+    trabajador_persuasor.procesar_lote_persuasion = crono.envolver(trabajador_persuasor.procesar_lote_persuasion)
+
+    def persuadir_todo():
+        anterior = None
+        while True:
+            pendientes = trabajador_persuasor.contar_pendientes()
+            if not pendientes or pendientes == anterior:
+                return   # vacío, o lo que queda falla siempre (reclamos vivos hasta que venza el lease)
+            anterior = pendientes
+            trabajador_persuasor.trabajar_persuasor(continuo=False)
+    filas.append(medir_etapa("persuasor", persuadir_todo, crono))
+
+    # Nutridor: los persuadidos "envejecen" para entrar en la primera jugada
+    from pool_conexiones import conexion
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE prospects SET updated_at = NOW() - INTERVAL '30 days' WHERE status = 'persuadido'")
+        conn.commit()
+    crono = Cronometro()
+    nutridor = TrabajadorNutridor()
+    nutridor._redactar_email = crono.envolver(nutridor._redactar_email)
+    filas.append(medir_etapa("nutridor", lambda: nutridor.ejecutar_ciclo_seguimiento(presupuesto_seg=args.presupuesto_nutridor), crono))
+    return filas
+
+def correr_flask(args):
+    """Peticiones concurrentes a los endpoints que ve un prospecto/cliente. Una fila por endpoint."""
+    import main
+    from pool_conexiones import conexion
+
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("SELECT access_token FROM prospects WHERE access_token IS NOT NULL ORDER BY id LIMIT %s", (args.peticiones,))
+        tokens = [t[0] for t in cur.fetchall()] or ["sin-token"]
+
+    rnd = random.Random(args.semilla)
+    endpoints = {
+        "GET /ver-pre-nido/<token>": lambda cliente: cliente.get(f"/ver-pre-nido/{rnd.choice(tokens)}"),
+        "POST /api/chat-nido": lambda cliente: cliente.post("/api/chat-nido", json={"token": rnd.choice(tokens), "mensaje": "¿Cuánto cuesta?"}),
+        "GET /api/dashboard-data": lambda cliente: cliente.get("/api/dashboard-data"),
+        "GET /metrics": lambda cliente: cliente.get("/metrics", headers={"Authorization": f"Bearer {os.environ['METRICAS_TOKEN']}"}),
+    }
+
+    filas = []
+    for nombre, peticion in endpoints.items():
+        crono = Cronometro()
+        errores = []
+        local = threading.local()
+
+        def una(_):
+            cliente = getattr(local, "cliente", None)
+            if cliente is None:
+                cliente = local.cliente = main.app.test_client()
+            r = crono.envolver(peticion)(cliente)
+            if r.status_code >= 500:
+                errores.append(r.status_code)
+
+        def ejecutar():
+            with ThreadPoolExecutor(max_workers=args.hilos_flask) as ejecutor:
+                list(ejecutor.map(una, range(args.peticiones)))
+
+        fila = medir_etapa(f"flask {nombre}", ejecutar, crono, items=lambda: args.peticiones)
+        fila["errores_5xx"] = len(errores)
+        filas.append(fila)
+    return filas
+
+
+# --- INFORME ---
+
+def imprimir_informe(filas, args, total_seg):
+    print(f"\n📊 Benchmark: {args.campanas} campañas, {args.prospectos} prospectos sembrados, semilla {args.semilla} "
+          f"(Gemini {args.lat_gemini}s, Apify {args.lat_apify}s, web {args.lat_web}s) en {total_seg:.1f}s\n")
+    cabecera = f"{'etapa':<30} {'items':>7} {'seg':>8} {'items/s':>8} {'p50 s':>8} {'p99 s':>8} {'viajes BD':>10} {'BD/item':>8} {'LLM':>5}"
+    print(cabecera)
+    print("-" * len(cabecera))
+    for f in filas:
+        por_item = "-" if f["viajes_por_item"] is None else f"{f['viajes_por_item']:.2f}"
+        print(f"{f['etapa']:<30} {f['items']:>7} {f['segundos']:>8.2f} {f['items_por_seg']:>8.2f} "
+              f"{f['p50_seg']:>8.3f} {f['p99_seg']:>8.3f} {f['viajes_bd']:>10} {por_item:>8} {f['llamadas_llm']:>5}")
+
+
+def argumentos():
+    p = argparse.ArgumentParser(description="Benchmark de punta a punta del pipeline de ventas con dobles locales.")
+    p.add_argument("--campanas", type=int, default=3)
+    p.add_argument("--prospectos", type=int, default=200, help="Prospectos sembrados (además de lo que cace el Cazador)")
+    p.add_argument("--limite", type=int, default=4, help="Prospectos diarios contratados por campaña")
+    p.add_argument("--semilla", type=int, default=42)
+    p.add_argument("--lat-gemini", type=float, default=0.5, help="Latencia media simulada de Gemini (s)")
+    p.add_argument("--lat-apify", type=float, default=3.0, help="Duración media simulada de una corrida de Apify (s)")
+    p.add_argument("--lat-web", type=float, default=0.2, help="Latencia media de las webs de prospectos (s)")
+    p.add_argument("--error-gemini", type=float, default=0.0, help="Fracción de llamadas a Gemini que fallan con 503")
+    p.add_argument("--error-web", type=float, default=0.05, help="Fracción de webs que responden 500")
+    p.add_argument("--tasa-contacto", type=float, default=0.5, help="Fracción de prospectos/perfiles con contacto")
+    p.add_argument("--tasa-descarte", type=float, default=0.2, help="Fracción que el Analista descarta")
+    p.add_argument("--concurrencia-analista", type=int, default=None)
+    p.add_argument("--presupuesto-nutridor", type=float, default=120.0)
+    p.add_argument("--peticiones", type=int, default=200, help="Peticiones por endpoint de Flask")
+    p.add_argument("--hilos-flask", type=int, default=8)
+    p.add_argument("--sin-limites-llm", action="store_true", help="Quita la cuota de la pasarela (mide el código, no la cuota de Google)")
+    p.add_argument("--esquema", default="bench_pipeline")
+    p.add_argument("--conservar", action="store_true", help="No borrar el esquema al terminar")
+    p.add_argument("--salida", help="Guardar el informe en JSON (para comparar corridas)")
+    p.add_argument("--verboso", action="store_true")
+    return p.parse_args()
+
+
+def main():
+    args = argumentos()
+    url = os.environ.get("BENCH_DATABASE_URL")
+    if not url:
+        sys.exit("Falta BENCH_DATABASE_URL (una BD de pruebas: el banco crea y borra su propio esquema).")
+    if url == os.environ.get("DATABASE_URL"):
+        sys.exit("BENCH_DATABASE_URL no puede ser la BD de producción (DATABASE_URL).")
+
+    # Antes de importar los trabajadores: leen la configuración al importarse
+    os.environ["DATABASE_URL"] = url
+    os.environ["GOOGLE_API_KEY"] = "bench-falso"
+    os.environ["APIFY_API_TOKEN"] = "bench-falso"
+    os.environ.setdefault("CAZADOR_SONDEO_SEG", "0.2")
+    os.environ.setdefault("METRICAS_ROL", "benchmark")
+    os.environ.setdefault("METRICAS_TOKEN", "bench")
+    if args.sin_limites_llm:
+        sin_cuota = {"rpm": 1_000_000, "rafaga": 10_000, "concurrencia": 256}
+        os.environ["LLM_LIMITES"] = json.dumps({"models/gemini-2.0-flash": sin_cuota, "models/gemini-pro-latest": sin_cuota})
+
+    web = WebLocal(args.lat_web, args.error_web, args.semilla)
+    campanas = sembrar(url, args.esquema, args, web.base)
+
+    import pool_conexiones
+    pool_conexiones._pool = pool_conexiones.PoolConexiones(dsn=url, connection_factory=fabrica_conexion(args.esquema))
+
+    import pasarela_llm
+    gemini = GeminiFalso(args.lat_gemini, args.tasa_descarte, args.error_gemini, args.semilla)
+    pasarela_llm.obtener_pasarela().modelo = lambda nombre: gemini
+
+    apify = ApifyFalso(web.base, args.lat_apify, args.tasa_contacto, args.semilla)
+    import trabajador_cazador
+    import trabajador_espia
+    trabajador_cazador.ApifyClient = apify
+    trabajador_espia.ApifyClient = apify
+
+    # Los triggers de KPIs existen en producción: también aquí, para medir su costo
+    import kpis_dashboard
+    kpis_dashboard.asegurar_esquema()
+
+    if not args.verboso:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    inicio = time.perf_counter()
+    try:
+        filas = correr_pipeline(args, campanas, web.base) + correr_flask(args)
+        total = time.perf_counter() - inicio
+        imprimir_informe(filas, args, total)
+        if args.salida:
+            with open(args.salida, "w", encoding="utf-8") as f:
+                json.dump({"parametros": vars(args), "segundos": round(total, 3), "etapas": filas}, f, ensure_ascii=False, indent=2)
+            print(f"\n💾 Informe guardado en {args.salida}")
+    finally:
+        try:
+            from buffer_interacciones import obtener_buffer
+            obtener_buffer().volcar()
+        except Exception:
+            pass
+        pool_conexiones._pool.cerrar_todo()
+        web.cerrar()
+        if not args.conservar:
+            borrar_esquema(url, args.esquema)
+
+
+if __name__ == "__main__":
+    main()
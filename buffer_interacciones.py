@@ -0,0 +1,128 @@
+import os
+import atexit
+import logging
+import threading
+from psycopg2.extras import execute_batch
+from dotenv import load_dotenv
+from pool_conexiones import conexion
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+# Cada cuántos segundos se vuelcan los contadores acumulados (máximo que se pierde si el proceso muere)
+INTERACCIONES_FLUSH_SEG = float(os.environ.get("INTERACCIONES_FLUSH_SEG", "2"))
+# Incrementos pendientes que fuerzan un volcado inmediato (otro tope a lo que se puede perder)
+INTERACCIONES_MAX_PENDIENTES = int(os.environ.get("INTERACCIONES_MAX_PENDIENTES", "500"))
+
+
+class BufferInteracciones:
+    """
+    Write-behind de 'nurture_interactions_count': el chat solo suma en memoria y un hilo
+    vuelca cada INTERACCIONES_FLUSH_SEG con UPDATE ... SET n = n + k (atómico, sin carreras),
+    todos los prospectos en una sola transacción. También vuelca al apagar el proceso.
+    """
+
+    def __init__(self, intervalo=INTERACCIONES_FLUSH_SEG, max_pendientes=INTERACCIONES_MAX_PENDIENTES):
+        self.intervalo = max(0.1, intervalo)
+        self.max_pendientes = max(1, max_pendientes)
+        self._iniciar_estado()
+        self._stats = {"sumados": 0, "volcados": 0, "vuelcos": 0, "errores": 0}
+
+    def _iniciar_estado(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pendientes = {}          # prospect_id -> incremento acumulado
+        self._total_pendiente = 0
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def _verificar_fork(self):
+        # Tras un fork (gunicorn --preload) el hilo no existe en el hijo y lo pendiente es del padre
+        if os.getpid() != self._pid:
+            self._iniciar_estado()
+
+    def _asegurar_hilo(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            self._hilo = threading.Thread(target=self._bucle, name="buffer_interacciones", daemon=True)
+            self._hilo.start()
+
+    def sumar(self, prospect_id, cantidad=1):
+        """Cuenta una interacción sin tocar la BD (O(1), no bloquea el chat)."""
+        self._verificar_fork()
+        with self._lock:
+            self._pendientes[prospect_id] = self._pendientes.get(prospect_id, 0) + cantidad
+            self._total_pendiente += cantidad
+            self._stats["sumados"] += cantidad
+            self._asegurar_hilo()
+            lleno = self._total_pendiente >= self.max_pendientes
+        if lleno:
+            self._despertar.set()
+
+    def _bucle(self):
+        while True:
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+            self.volcar()
+
+    def volcar(self):
+        """Escribe lo acumulado. Si la BD falla, lo devuelve al buffer para el próximo intento."""
+        self._verificar_fork()
+        with self._lock:
+            if not self._pendientes:
+                return 0
+            lote, self._pendientes = self._pendientes, {}
+            self._total_pendiente = 0
+
+        try:
+            with conexion() as conn, conn.cursor() as cur:
+                # CORRECCIÓN: Actualizar contador 'nurture_interactions_count'
+                execute_batch(cur, """
+                    UPDATE prospects
+                    SET nurture_interactions_count = COALESCE(nurture_interactions_count, 0) + %s,
+                        updated_at = NOW()
+                    WHERE id = %s
+                """, [(n, pid) for pid, n in lote.items()])
+                conn.commit()
+        except Exception as e:
+            logging.error(f"❌ No se pudieron volcar {len(lote)} contadores de interacción: {e}")
+            with self._lock:
+                self._stats["errores"] += 1
+                for pid, n in lote.items():
+                    self._pendientes[pid] = self._pendientes.get(pid, 0) + n
+                    self._total_pendiente += n
+            return 0
+
+        with self._lock:
+            self._stats["volcados"] += sum(lote.values())
+            self._stats["vuelcos"] += 1
+        return len(lote)
+
+    def metricas(self):
+        with self._lock:
+            return {**self._stats, "pendientes": self._total_pendiente, "prospectos_pendientes": len(self._pendientes)}
+
+
+# --- BUFFER COMPARTIDO DEL PROCESO ---
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def obtener_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = BufferInteracciones()
+    return _buffer
+
+def sumar_interaccion(prospect_id, cantidad=1):
+    obtener_buffer().sumar(prospect_id, cantidad)
+
+def _volcar_al_salir():
+    if _buffer is not None:
+        try:
+            _buffer.volcar()
+        except Exception as e:
+            logging.error(f"❌ Error volcando interacciones al salir: {e}")
+
+atexit.register(_volcar_al_salir)
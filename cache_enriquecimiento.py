@@ -0,0 +1,164 @@
+import os
+import logging
+import threading
+import unicodedata
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+from pool_conexiones import conexion
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+CACHE_ENRIQ_ACTIVO = os.environ.get("CACHE_ENRIQ_ACTIVO", "1") == "1"
+# Un contacto encontrado cambia poco: se reutiliza entre campañas y clientes durante este tiempo
+CACHE_ENRIQ_TTL_DIAS = float(os.environ.get("CACHE_ENRIQ_TTL_DIAS", "90"))
+# Perfiles sin contacto: se recuerdan menos por si el negocio publica su email más adelante
+CACHE_ENRIQ_TTL_NEGATIVO_DIAS = float(os.environ.get("CACHE_ENRIQ_TTL_NEGATIVO_DIAS", "30"))
+# Precio de una consulta de perfil en Apify (el que paga el Espía): valoriza los aciertos en /metrics
+CACHE_ENRIQ_COSTO_CONSULTA = float(os.environ.get("CACHE_ENRIQ_COSTO_CONSULTA", "0.005"))
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "hits": 0,
+    "hits_negativos": 0,
+    "misses": 0,
+    "guardados": 0,
+    "errores_cache": 0,
+    "dolares_ahorrados": 0.0,
+}
+
+
+def _contar(clave, cantidad=1):
+    with _stats_lock:
+        _stats[clave] += cantidad
+
+def normalizar_nombre(nombre):
+    """'Café  Doña-María' -> 'cafedonamaria' (sin tildes, espacios ni signos)."""
+    if not nombre:
+        return ""
+    sin_tildes = unicodedata.normalize("NFKD", str(nombre))
+    return "".join(c for c in sin_tildes if c.isalnum() and not unicodedata.combining(c)).lower()
+
+def clave_enriquecimiento(nombre_negocio, handle):
+    """Clave global (independiente de campaña/cliente). Sin handle no hay nada que consultar."""
+    handle = (handle or "").strip().lstrip("@").lower()
+    if not handle:
+        return ""
+    return f"{normalizar_nombre(nombre_negocio)}|{handle}"
+
+def asegurar_tabla():
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        with conexion() as conn, conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS enrichment_cache (
+                    clave TEXT PRIMARY KEY,
+                    handle TEXT NOT NULL,
+                    email TEXT,
+                    telefono TEXT,
+                    encontrado BOOLEAN NOT NULL,
+                    consultado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    expira_en TIMESTAMPTZ NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_enrichment_cache_expira ON enrichment_cache (expira_en);
+            """)
+            conn.commit()
+        _esquema_listo = True
+
+# --- LECTURA / ESCRITURA ---
+
+def buscar_lote(claves, costo_consulta=0.0):
+    """
+    Busca varias claves en una sola ida a la BD y marca los aciertos (hits += 1).
+    Devuelve {clave: (email, telefono, encontrado)} solo con entradas vigentes.
+    Cada acierto suma `costo_consulta` a los dólares ahorrados.
+    """
+    claves = tuple(dict.fromkeys(c for c in claves if c))
+    if not CACHE_ENRIQ_ACTIVO or not claves:
+        return {}
+
+    try:
+        asegurar_tabla()
+        with conexion() as conn, conn.cursor() as cur:
+            cur.execute("""
+                UPDATE enrichment_cache SET hits = hits + 1
+                WHERE clave IN %s AND expira_en > NOW()
+                RETURNING clave, email, telefono, encontrado
+            """, (claves,))
+            filas = cur.fetchall()
+            conn.commit()
+    except Exception as e:
+        logging.warning(f"⚠️ Caché de enriquecimiento no disponible ({e}). Se consultará Apify.")
+        _contar("errores_cache")
+        return {}
+
+    aciertos = {clave: (email, telefono, encontrado) for clave, email, telefono, encontrado in filas}
+    negativos = sum(1 for v in aciertos.values() if not v[2])
+    _contar("hits", len(aciertos) - negativos)
+    _contar("hits_negativos", negativos)
+    _contar("misses", len(claves) - len(aciertos))
+    _contar("dolares_ahorrados", len(aciertos) * costo_consulta)
+    return aciertos
+
+def guardar_lote(entradas):
+    """
+    Guarda resultados de consultas pagadas. `entradas` = [(clave, handle, email, telefono)].
+    Sin email ni teléfono se guarda como resultado negativo (TTL más corto).
+    """
+    filas = []
+    for clave, handle, email, telefono in entradas:
+        if not clave:
+            continue
+        encontrado = bool(email or telefono)
+        ttl_dias = CACHE_ENRIQ_TTL_DIAS if encontrado else CACHE_ENRIQ_TTL_NEGATIVO_DIAS
+        filas.append((clave, handle, email, telefono, encontrado, ttl_dias * 86400))
+    if not CACHE_ENRIQ_ACTIVO or not filas:
+        return
+
+    try:
+        asegurar_tabla()
+        with conexion() as conn, conn.cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO enrichment_cache (clave, handle, email, telefono, encontrado, consultado_en, expira_en)
+                SELECT v.clave, v.handle, v.email, v.telefono, v.encontrado, NOW(), NOW() + make_interval(secs => v.ttl)
+                FROM (VALUES %s) AS v (clave, handle, email, telefono, encontrado, ttl)
+                ON CONFLICT (clave) DO UPDATE SET
+                    email = EXCLUDED.email,
+                    telefono = EXCLUDED.telefono,
+                    encontrado = EXCLUDED.encontrado,
+                    consultado_en = NOW(),
+                    expira_en = EXCLUDED.expira_en
+            """, filas, template="(%s, %s, %s, %s, %s::boolean, %s::double precision)")
+            conn.commit()
+        _contar("guardados", len(filas))
+    except Exception as e:
+        logging.warning(f"⚠️ No se pudo guardar en caché de enriquecimiento: {e}")
+        _contar("errores_cache")
+
+def ahorro_historico(cur, costo_consulta=CACHE_ENRIQ_COSTO_CONSULTA):
+    """
+    (aciertos, dólares) de Apify evitados desde que existe la caché, sumando todos los procesos.
+    Solo lectura con el cursor recibido (se usa desde el scrape de /metrics).
+    """
+    cur.execute("SELECT to_regclass('enrichment_cache') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0, 0.0
+    cur.execute("SELECT COALESCE(SUM(hits), 0) FROM enrichment_cache")
+    hits = int(cur.fetchone()[0])
+    return hits, round(hits * costo_consulta, 4)
+
+def metricas_enriquecimiento():
+    with _stats_lock:
+        datos = dict(_stats)
+    consultas = datos["hits"] + datos["hits_negativos"] + datos["misses"]
+    datos["tasa_acierto"] = round((consultas - datos["misses"]) / consultas, 3) if consultas else 0.0
+    datos["dolares_ahorrados"] = round(datos["dolares_ahorrados"], 4)
+    return datos
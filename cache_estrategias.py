@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from dotenv import load_dotenv
+from pool_conexiones import conexion
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+CACHE_ESTRATEGIA_ACTIVO = os.environ.get("CACHE_ESTRATEGIA_ACTIVO", "1") == "1"
+# Cuánto vale una estrategia pensada por Gemini para las mismas entradas de campaña
+ESTRATEGIA_TTL_HORAS = float(os.environ.get("ESTRATEGIA_TTL_HORAS", "24"))
+# Estrategias distintas que se guardan por campaña y entre las que se rota (1 = sin rotación)
+ESTRATEGIA_MAX_VARIANTES = int(os.environ.get("ESTRATEGIA_MAX_VARIANTES", "3"))
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "errores_cache": 0,
+}
+
+# --- INVALIDACIÓN AL EDITAR LA CAMPAÑA ---
+# Si cambian las entradas de la estrategia (o se borra la campaña), sus variantes se descartan.
+
+_SQL_TRIGGER = """
+CREATE OR REPLACE FUNCTION strategy_cache_invalidar() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    DELETE FROM strategy_cache WHERE campaign_id = OLD.id::text;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS trg_strategy_cache_update ON campaigns;
+CREATE TRIGGER trg_strategy_cache_update
+    AFTER UPDATE OF product_description, target_audience, product_type ON campaigns
+    FOR EACH ROW
+    WHEN (OLD.product_description IS DISTINCT FROM NEW.product_description
+          OR OLD.target_audience IS DISTINCT FROM NEW.target_audience
+          OR OLD.product_type IS DISTINCT FROM NEW.product_type)
+    EXECUTE FUNCTION strategy_cache_invalidar();
+
+DROP TRIGGER IF EXISTS trg_strategy_cache_delete ON campaigns;
+CREATE TRIGGER trg_strategy_cache_delete
+    AFTER DELETE ON campaigns
+    FOR EACH ROW EXECUTE FUNCTION strategy_cache_invalidar();
+"""
+
+
+def _contar(clave, cantidad=1):
+    with _stats_lock:
+        _stats[clave] += cantidad
+
+def hash_entradas(descripcion_producto, audiencia_objetivo, tipo_producto):
+    """Huella de lo que ve el Estratega: mismas entradas -> misma entrada de caché."""
+    datos = [str(v or "").strip().lower() for v in (descripcion_producto, audiencia_objetivo, tipo_producto)]
+    return hashlib.sha256(json.dumps(datos).encode("utf-8")).hexdigest()
+
+def asegurar_esquema():
+    """Crea la tabla de estrategias y los triggers de invalidación (solo si no existen)."""
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        with conexion() as conn, conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('strategy_cache'))")
+            cur.execute("SELECT to_regclass('strategy_cache') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                logging.info("🧱 Creando strategy_cache + triggers de invalidación...")
+                # campaign_id como TEXT: no depende del tipo de campaigns.id
+                cur.execute("""
+                    CREATE TABLE strategy_cache (
+                        campaign_id TEXT NOT NULL,
+                        clave TEXT NOT NULL,
+                        variante INTEGER NOT NULL,
+                        query TEXT NOT NULL,
+                        platform TEXT NOT NULL,
+                        usos INTEGER NOT NULL DEFAULT 0,
+                        creado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                        expira_en TIMESTAMPTZ NOT NULL,
+                        PRIMARY KEY (campaign_id, clave, variante)
+                    );
+                """)
+                cur.execute(_SQL_TRIGGER)
+            conn.commit()
+        _esquema_listo = True
+
+# --- LECTURA / ESCRITURA ---
+
+def _variantes_vigentes(campana, clave):
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT variante, query, platform, usos FROM strategy_cache
+            WHERE campaign_id = %s AND clave = %s AND expira_en > NOW()
+            ORDER BY usos, variante
+        """, (campana, clave))
+        return cur.fetchall()
+
+def _usar(campana, clave, variante):
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE strategy_cache SET usos = usos + 1
+            WHERE campaign_id = %s AND clave = %s AND variante = %s
+        """, (campana, clave, variante))
+        conn.commit()
+
+def _guardar(campana, clave, query, platform):
+    with conexion() as conn, conn.cursor() as cur:
+        # Lo vencido y lo de entradas anteriores de la campaña ya no sirve
+        cur.execute("""
+            DELETE FROM strategy_cache
+            WHERE campaign_id = %s AND (clave <> %s OR expira_en <= NOW())
+        """, (campana, clave))
+        cur.execute("""
+            INSERT INTO strategy_cache (campaign_id, clave, variante, query, platform, usos, expira_en)
+            SELECT %s, %s, COALESCE(MAX(variante) + 1, 0), %s, %s, 1, NOW() + make_interval(secs => %s)
+            FROM strategy_cache WHERE campaign_id = %s AND clave = %s
+            ON CONFLICT DO NOTHING
+        """, (campana, clave, query, platform, ESTRATEGIA_TTL_HORAS * 3600, campana, clave))
+        conn.commit()
+
+def obtener_estrategia(campana_id, descripcion_producto, audiencia_objetivo, tipo_producto, generar):
+    """
+    Devuelve (query, platform) para la campaña pasando por la caché.
+    `generar()` consulta al modelo y devuelve (query, platform) o None si falló.
+    Mientras haya menos de ESTRATEGIA_MAX_VARIANTES vigentes se pide una nueva (diversidad);
+    con el cupo lleno se rota entre las guardadas (la menos usada primero) sin llamar a la IA.
+    """
+    if not CACHE_ESTRATEGIA_ACTIVO or campana_id is None:
+        return generar()
+
+    campana = str(campana_id)
+    clave = hash_entradas(descripcion_producto, audiencia_objetivo, tipo_producto)
+    try:
+        asegurar_esquema()
+        variantes = _variantes_vigentes(campana, clave)
+    except Exception as e:
+        logging.warning(f"⚠️ Caché de estrategias no disponible ({e}). Consultando a la IA.")
+        _contar("errores_cache")
+        return generar()
+
+    if len(variantes) < max(1, ESTRATEGIA_MAX_VARIANTES):
+        _contar("misses")
+        nueva = generar()
+        if nueva:
+            try:
+                _guardar(campana, clave, nueva[0], nueva[1])
+            except Exception as e:
+                logging.warning(f"⚠️ No se pudo guardar la estrategia de {campana}: {e}")
+                _contar("errores_cache")
+            return nueva
+        if not variantes:
+            return None
+
+    # Rotación: la variante menos usada (ya vienen ordenadas por usos)
+    _contar("hits")
+    variante, query, platform, _ = variantes[0]
+    try:
+        _usar(campana, clave, variante)
+    except Exception as e:
+        logging.warning(f"⚠️ No se pudo marcar el uso de la estrategia de {campana}: {e}")
+    return query, platform
+
+def invalidar(campana_id=None):
+    """Descarta las estrategias de una campaña (o todas). Los triggers ya lo hacen al editar campaigns."""
+    asegurar_esquema()
+    with conexion() as conn, conn.cursor() as cur:
+        if campana_id is None:
+            cur.execute("DELETE FROM strategy_cache")
+        else:
+            cur.execute("DELETE FROM strategy_cache WHERE campaign_id = %s", (str(campana_id),))
+        conn.commit()
+
+def metricas_estrategias():
+    with _stats_lock:
+        datos = dict(_stats)
+    consultas = datos["hits"] + datos["misses"]
+    datos["tasa_acierto"] = round(datos["hits"] / consultas, 3) if consultas else 0.0
+    return datos
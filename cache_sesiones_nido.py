@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from pool_conexiones import conexion
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+# Sesiones de chat del Nido que se recuerdan en memoria (las menos usadas salen primero)
+NIDO_CONTEXTO_MAX = int(os.environ.get("NIDO_CONTEXTO_MAX", "2000"))
+# Segundos que vale el contexto de una sesión antes de releerlo de la BD
+NIDO_CONTEXTO_TTL_SEG = float(os.environ.get("NIDO_CONTEXTO_TTL_SEG", "600"))
+
+
+def texto_dolores(p_dolores):
+    """Dolores del prospecto como texto (vienen como dict o como JSON en string)."""
+    if not p_dolores:
+        return ""
+    if isinstance(p_dolores, dict):
+        return ", ".join(p_dolores.get("dolores_detectados", []))
+    if isinstance(p_dolores, str):
+        try: return ", ".join(json.loads(p_dolores).get("dolores_detectados", []))
+        except: pass
+    return ""
+
+
+class CacheContextoNido:
+    """
+    Contexto por token de acceso (prospecto, dolores, producto) con LRU + TTL.
+    Evita abrir conexión y repetir el JOIN prospects/campaigns en cada mensaje del chat.
+    """
+
+    def __init__(self, maximo=NIDO_CONTEXTO_MAX, ttl_seg=NIDO_CONTEXTO_TTL_SEG):
+        self.maximo = max(1, maximo)
+        self.ttl_seg = ttl_seg
+        self._entradas = OrderedDict()   # token -> (vence, contexto)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expulsados": 0, "invalidados": 0}
+
+    def obtener(self, token):
+        """Contexto de la sesión o None si el token no existe."""
+        if not token:
+            return None
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._entradas.get(token)
+            if entrada and entrada[0] > ahora:
+                self._entradas.move_to_end(token)
+                self._stats["hits"] += 1
+                return entrada[1]
+            self._stats["misses"] += 1
+
+        contexto = self._leer(token)
+        if contexto:
+            with self._lock:
+                self._entradas[token] = (ahora + self.ttl_seg, contexto)
+                self._entradas.move_to_end(token)
+                while len(self._entradas) > self.maximo:
+                    self._entradas.popitem(last=False)
+                    self._stats["expulsados"] += 1
+        return contexto
+
+    def _leer(self, token):
+        with conexion() as conn, conn.cursor() as cur:
+            # CORRECCIÓN: Tablas y Columnas en Inglés
+            cur.execute("""
+                SELECT p.id, p.business_name, p.pain_points, c.campaign_name, c.product_description
+                FROM prospects p
+                JOIN campaigns c ON p.campaign_id = c.id
+                WHERE p.access_token = %s
+            """, (token,))
+            fila = cur.fetchone()
+        if not fila:
+            return None
+        pid, p_nombre, p_dolores, c_cliente, c_producto = fila
+        return {
+            "id": pid,
+            "nombre": p_nombre,
+            "dolores": texto_dolores(p_dolores),
+            "cliente": c_cliente,
+            "producto": c_producto,
+        }
+
+    def invalidar(self, token=None):
+        """Olvida una sesión (p.ej. el prospecto o su campaña cambiaron) o todas."""
+        with self._lock:
+            if token is None:
+                self._stats["invalidados"] += len(self._entradas)
+                self._entradas.clear()
+            elif self._entradas.pop(token, None) is not None:
+                self._stats["invalidados"] += 1
+
+    def metricas(self):
+        with self._lock:
+            return {**self._stats, "sesiones": len(self._entradas)}
+
+
+# --- CACHÉ COMPARTIDA DEL PROCESO ---
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def obtener_cache_contexto():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CacheContextoNido()
+    return _cache
+
+def invalidar_contexto(token=None):
+    obtener_cache_contexto().invalidar(token)
@@ -0,0 +1,232 @@
+import os
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from dotenv import load_dotenv
+from pool_conexiones import conexion
+from lector_web import obtener_lector, normalizar_url
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+CACHE_WEB_ACTIVO = os.environ.get("CACHE_WEB_ACTIVO", "1") == "1"
+# Cuánto vale una web leída antes de revalidarla
+CACHE_WEB_TTL_HORAS = float(os.environ.get("CACHE_WEB_TTL_HORAS", "168"))
+# Webs caídas / vacías: se recuerdan menos tiempo por si resucitan
+CACHE_WEB_TTL_NEGATIVO_HORAS = float(os.environ.get("CACHE_WEB_TTL_NEGATIVO_HORAS", "24"))
+# Tamaño máximo de la caché (texto guardado). Se expulsa lo menos usado.
+CACHE_WEB_MAX_MB = float(os.environ.get("CACHE_WEB_MAX_MB", "200"))
+# Cada cuántas escrituras se revisa el tamaño total
+CACHE_WEB_REVISAR_CADA = int(os.environ.get("CACHE_WEB_REVISAR_CADA", "50"))
+
+# Respuestas que confirman que la página ya no existe (las demás fallas pueden ser pasajeras)
+_ESTADOS_DEFINITIVOS = (404, 410)
+
+# Parámetros de tracking que no cambian el contenido de la página
+_PARAMS_IGNORADOS = ("utm_", "fbclid", "gclid", "igshid", "ref")
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_stats = {
+    "hits": 0,
+    "hits_negativos": 0,
+    "revalidados_304": 0,
+    "vencidos_servidos": 0,
+    "misses": 0,
+    "errores_cache": 0,
+    "bytes_ahorrados": 0,
+    "segundos_ahorrados": 0.0,
+}
+_escrituras = 0
+
+
+def _contar(clave, cantidad=1):
+    with _stats_lock:
+        _stats[clave] += cantidad
+
+def clave_url(url):
+    """Normaliza la URL para que 'WWW.Sitio.com/?utm_source=x' y 'sitio.com' compartan entrada."""
+    url = normalizar_url(url)
+    if not url:
+        return ""
+    partes = urlsplit(url)
+    host = (partes.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    if partes.port and partes.port not in (80, 443):
+        host = f"{host}:{partes.port}"
+    ruta = partes.path.rstrip("/")
+    params = sorted((k, v) for k, v in parse_qsl(partes.query) if not k.lower().startswith(_PARAMS_IGNORADOS))
+    query = f"?{urlencode(params)}" if params else ""
+    return f"{host}{ruta}{query}"
+
+def asegurar_tabla():
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        with conexion() as conn, conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS web_scan_cache (
+                    url TEXT PRIMARY KEY,
+                    texto TEXT NOT NULL DEFAULT '',
+                    estado TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    tamano_bytes INTEGER NOT NULL DEFAULT 0,
+                    segundos_descarga REAL NOT NULL DEFAULT 0,
+                    descargado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    expira_en TIMESTAMPTZ NOT NULL,
+                    ultimo_acceso TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+                CREATE INDEX IF NOT EXISTS idx_web_scan_cache_acceso ON web_scan_cache (ultimo_acceso DESC);
+            """)
+            conn.commit()
+        _esquema_listo = True
+
+# --- LECTURA / ESCRITURA ---
+
+def _buscar(cur, clave):
+    # Una sola ida a la BD: buscamos y marcamos el acceso (para la expulsión LRU)
+    cur.execute("""
+        UPDATE web_scan_cache SET ultimo_acceso = NOW()
+        WHERE url = %s
+        RETURNING texto, estado, etag, last_modified, expira_en > NOW(), tamano_bytes, segundos_descarga
+    """, (clave,))
+    return cur.fetchone()
+
+def _guardar(cur, clave, descarga, ttl_horas):
+    estado = "ok" if descarga.ok and descarga.texto else "muerto"
+    cur.execute("""
+        INSERT INTO web_scan_cache
+            (url, texto, estado, etag, last_modified, tamano_bytes, segundos_descarga, descargado_en, expira_en, ultimo_acceso)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW() + make_interval(secs => %s), NOW())
+        ON CONFLICT (url) DO UPDATE SET
+            texto = EXCLUDED.texto,
+            estado = EXCLUDED.estado,
+            etag = EXCLUDED.etag,
+            last_modified = EXCLUDED.last_modified,
+            tamano_bytes = EXCLUDED.tamano_bytes,
+            segundos_descarga = EXCLUDED.segundos_descarga,
+            descargado_en = NOW(),
+            expira_en = EXCLUDED.expira_en,
+            ultimo_acceso = NOW()
+    """, (clave, descarga.texto or "", estado, descarga.etag, descarga.last_modified,
+          descarga.bytes_leidos, descarga.segundos, ttl_horas * 3600))
+
+def _expulsar_si_excede(cur):
+    """Mantiene la caché bajo CACHE_WEB_MAX_MB borrando lo menos usado recientemente."""
+    cur.execute("""
+        DELETE FROM web_scan_cache WHERE url IN (
+            SELECT url FROM (
+                SELECT url, SUM(octet_length(texto) + 256) OVER (ORDER BY ultimo_acceso DESC, url) AS acumulado
+                FROM web_scan_cache
+            ) t
+            WHERE acumulado > %s
+        )
+    """, (int(CACHE_WEB_MAX_MB * 1024 * 1024),))
+    if cur.rowcount > 0:
+        logging.info(f"🧹 Caché web: {cur.rowcount} entradas expulsadas por tamaño.")
+
+def leer_web(url):
+    """
+    Texto clave de la web pasando por la caché persistente:
+    acierto vigente -> sin red; vencida con ETag/Last-Modified -> GET condicional;
+    sin entrada -> descarga y guarda (las webs caídas quedan como entrada negativa).
+    Si una entrada buena vence y la descarga falla de forma pasajera, se sigue sirviendo la copia.
+    """
+    global _escrituras
+    lector = obtener_lector()
+    if not CACHE_WEB_ACTIVO:
+        return lector.leer(url)
+
+    clave = clave_url(url)
+    if not clave:
+        return ""
+
+    try:
+        asegurar_tabla()
+        with conexion() as conn, conn.cursor() as cur:
+            fila = _buscar(cur, clave)
+            conn.commit()
+    except Exception as e:
+        logging.warning(f"⚠️ Caché web no disponible ({e}). Leyendo directo.")
+        _contar("errores_cache")
+        return lector.leer(url)
+
+    cabeceras = {}
+    if fila:
+        texto, estado, etag, last_modified, vigente, tamano, segundos = fila
+        if vigente:
+            _contar("hits" if estado == "ok" else "hits_negativos")
+            _contar("bytes_ahorrados", tamano or 0)
+            _contar("segundos_ahorrados", segundos or 0.0)
+            return texto if estado == "ok" else ""
+        if estado == "ok":
+            if etag: cabeceras["If-None-Match"] = etag
+            if last_modified: cabeceras["If-Modified-Since"] = last_modified
+
+    descarga = lector.descargar(url, cabeceras=cabeceras)
+
+    try:
+        with conexion() as conn, conn.cursor() as cur:
+            if fila and descarga.estado == 304:
+                # El sitio no cambió: renovamos la vigencia sin volver a bajar el cuerpo
+                cur.execute("""
+                    UPDATE web_scan_cache
+                    SET expira_en = NOW() + make_interval(secs => %s), ultimo_acceso = NOW()
+                    WHERE url = %s
+                """, (CACHE_WEB_TTL_HORAS * 3600, clave))
+                conn.commit()
+                _contar("revalidados_304")
+                _contar("bytes_ahorrados", fila[5] or 0)
+                return fila[0]
+
+            conservar = (fila and fila[1] == "ok" and not (descarga.ok and descarga.texto)
+                         and descarga.estado not in _ESTADOS_DEFINITIVOS)
+            if conservar:
+                # Timeout / 5xx / conexión caída: la copia buena vale más que nada; se reintenta más tarde
+                cur.execute("""
+                    UPDATE web_scan_cache
+                    SET expira_en = NOW() + make_interval(secs => %s), ultimo_acceso = NOW()
+                    WHERE url = %s
+                """, (CACHE_WEB_TTL_NEGATIVO_HORAS * 3600, clave))
+                conn.commit()
+                _contar("vencidos_servidos")
+                return fila[0]
+
+            _contar("misses")
+            ttl = CACHE_WEB_TTL_HORAS if descarga.ok and descarga.texto else CACHE_WEB_TTL_NEGATIVO_HORAS
+            _guardar(cur, clave, descarga, ttl)
+            with _stats_lock:
+                _escrituras += 1
+                revisar = _escrituras % CACHE_WEB_REVISAR_CADA == 0
+            if revisar:
+                _expulsar_si_excede(cur)
+            conn.commit()
+    except Exception as e:
+        logging.warning(f"⚠️ No se pudo guardar en caché web {clave}: {e}")
+        _contar("errores_cache")
+
+    if descarga.estado == 304:
+        return fila[0] if fila else ""
+    if descarga.ok and descarga.texto:
+        return descarga.texto
+    if fila and fila[1] == "ok" and descarga.estado not in _ESTADOS_DEFINITIVOS:
+        return fila[0]
+    return ""
+
+def precargar_webs(urls):
+    """Versión en lote (en paralelo) de leer_web. Devuelve {url: Future[str]}."""
+    return obtener_lector().precargar(urls, lectura=leer_web)
+
+def metricas_cache():
+    with _stats_lock:
+        datos = dict(_stats)
+    consultas = datos["hits"] + datos["hits_negativos"] + datos["revalidados_304"] + datos["misses"]
+    datos["tasa_acierto"] = round((consultas - datos["misses"]) / consultas, 3) if consultas else 0.0
+    return datos
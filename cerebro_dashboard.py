@@ -1,12 +1,89 @@
 import os
-import google.generativeai as genai
+import time
+import threading
+from collections import OrderedDict
+from pasarela_llm import obtener_modelo, ejecutar, MODELO_PRO, INTERACTIVO
 
-print(">>> [Cerebro v3.0 - EXPERTO AUTONEURA] Cargando...")
+# --- MEMORIA DE CONVERSACIONES ---
+# Tokens (aprox.) de historial que se mandan por mensaje: ventana deslizante, la latencia no crece
+CHAT_MAX_TOKENS_HISTORIAL = int(os.environ.get("DASHBOARD_CHAT_MAX_TOKENS", "3000"))
+# Sesiones inactivas se olvidan tras este tiempo
+CHAT_TTL_SEG = float(os.environ.get("DASHBOARD_CHAT_TTL_SEG", "1800"))
+# Techo de memoria: número de sesiones y tamaño total del historial guardado
+CHAT_MAX_SESIONES = int(os.environ.get("DASHBOARD_CHAT_MAX_SESIONES", "500"))
+CHAT_MAX_MB = float(os.environ.get("DASHBOARD_CHAT_MAX_MB", "20"))
+
+
+def estimar_tokens(texto):
+    # ~4 caracteres por token: suficiente para recortar sin llamar a count_tokens (otra ida a la API)
+    return len(texto) // 4 + 1
+
+
+class SesionesChat:
+    """
+    Historial por visitante (clave = id de la sesión Flask) con expulsión LRU/TTL
+    bajo un techo de sesiones y de bytes.
+    """
+
+    def __init__(self, max_sesiones=CHAT_MAX_SESIONES, ttl_seg=CHAT_TTL_SEG, max_bytes=int(CHAT_MAX_MB * 1024 * 1024)):
+        self.max_sesiones = max(1, max_sesiones)
+        self.ttl_seg = ttl_seg
+        self.max_bytes = max_bytes
+        self._sesiones = OrderedDict()   # id -> {"turnos": [(pregunta, respuesta)], "bytes": n, "visto": ts}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def historial(self, sesion_id):
+        with self._lock:
+            self._expulsar_vencidas()
+            sesion = self._sesiones.get(sesion_id)
+            if not sesion:
+                return []
+            sesion["visto"] = time.monotonic()
+            self._sesiones.move_to_end(sesion_id)
+            return list(sesion["turnos"])
+
+    def agregar(self, sesion_id, pregunta, respuesta, max_tokens=CHAT_MAX_TOKENS_HISTORIAL):
+        with self._lock:
+            sesion = self._sesiones.pop(sesion_id, None) or {"turnos": [], "bytes": 0}
+            self._bytes -= sesion["bytes"]
+            sesion["turnos"].append((pregunta, respuesta))
+            # Solo guardamos lo que cabe en la ventana: lo que no se va a enviar no ocupa memoria
+            while len(sesion["turnos"]) > 1 and sum(estimar_tokens(p) + estimar_tokens(r) for p, r in sesion["turnos"]) > max_tokens:
+                sesion["turnos"].pop(0)
+            sesion["bytes"] = sum(len(p) + len(r) for p, r in sesion["turnos"])
+            sesion["visto"] = time.monotonic()
+            self._sesiones[sesion_id] = sesion
+            self._bytes += sesion["bytes"]
+
+            while self._sesiones and (len(self._sesiones) > self.max_sesiones or self._bytes > self.max_bytes):
+                _, vieja = self._sesiones.popitem(last=False)
+                self._bytes -= vieja["bytes"]
+
+    def olvidar(self, sesion_id):
+        with self._lock:
+            sesion = self._sesiones.pop(sesion_id, None)
+            if sesion:
+                self._bytes -= sesion["bytes"]
+
+    def _expulsar_vencidas(self):
+        limite = time.monotonic() - self.ttl_seg
+        while self._sesiones:
+            sesion_id, sesion = next(iter(self._sesiones.items()))
+            if sesion["visto"] >= limite:
+                break
+            self._sesiones.popitem(last=False)
+            self._bytes -= sesion["bytes"]
+
+    def metricas(self):
+        with self._lock:
+            return {"sesiones": len(self._sesiones), "bytes": self._bytes}
 
 class DashboardBrain:
     def __init__(self, descripcion_producto: str):
         self.model = None
-        self.chat = None
+        self.protocolo = None
+        self.sesiones = SesionesChat()
 
         # --- INYECCIÓN DE CONOCIMIENTO DE SEGURIDAD ---
         # Si la base de datos no manda descripción (porque está vacía),
@@ -52,39 +129,55 @@ class DashboardBrain:
         # --- FIN DEL PROTOCOLO ---
 
         try:
-            # Mantenemos el modelo que tú tenías configurado
-            self.model = genai.GenerativeModel('models/gemini-pro-latest')
-            self.chat = self.model.start_chat(history=[
+            # Mantenemos el modelo que tú tenías configurado (compartido vía la pasarela LLM)
+            self.model = obtener_modelo(MODELO_PRO)
+            # El protocolo abre cada conversación; el historial de cada visitante va aparte
+            self.protocolo = [
                 {'role': 'user', 'parts': [protocolo_vendedor_enfocado]},
                 {'role': 'model', 'parts': ["Protocolo 'Vendedor Enfocado' cargado. Conozco los precios y no inventaré enlaces. Listo para vender."]}
-            ])
+            ]
             print(">>> [Cerebro] Modelo de IA y chat con personalidad REFORZADA inicializados.")
         except Exception as e:
             print(f"!!! ERROR [Cerebro]: No se pudo inicializar el modelo o el chat. {e} !!!")
 
     def invoke(self, input_data):
-        if not self.chat:
+        """
+        `input_data` = {"question": ..., "session_id": ...}. Cada visitante tiene su propio
+        historial (ventana de CHAT_MAX_TOKENS_HISTORIAL), así el costo por mensaje no crece.
+        """
+        if not self.model:
             return "Lo siento, el cerebro de la IA no está disponible en este momento."
         
         question = input_data.get("question")
         if not question:
             return "Error interno: No se recibió ninguna pregunta."
+        sesion_id = input_data.get("session_id") or "anonimo"
+
+        contenido = list(self.protocolo)
+        for pregunta, respuesta in self.sesiones.historial(sesion_id):
+            contenido.append({'role': 'user', 'parts': [pregunta]})
+            contenido.append({'role': 'model', 'parts': [respuesta]})
+        contenido.append({'role': 'user', 'parts': [question]})
             
         try:
-            response = self.chat.send_message(question)
-            return response.text
+            # Carril interactivo: el chat adelanta a los trabajos por lotes del mismo modelo
+            response = ejecutar(MODELO_PRO, lambda: self.model.generate_content(contenido), prioridad=INTERACTIVO)
+            texto = response.text
+            self.sesiones.agregar(sesion_id, question, texto)
+            return texto
         except Exception as e:
             print(f"!!! ERROR [Cerebro]: Ocurrió un error al enviar el mensaje a la IA. {e} !!!")
             return "En este momento, parece que hubo una pequeña incidencia al procesar tu solicitud. ¿Podrías intentar reformular tu pregunta?"
 
-def create_chatbot(descripcion_producto: str):
+def create_chatbot(descripcion_producto: str = ""):
     # Pequeña validación para evitar enviar None a la clase
     if not descripcion_producto:
         descripcion_producto = ""
 
+    print(">>> [Cerebro v3.0 - EXPERTO AUTONEURA] Cargando...")
     brain_instance = DashboardBrain(descripcion_producto)
     
-    if brain_instance.chat:
+    if brain_instance.model:
         print(">>> [create_chatbot] Instancia del cerebro creada y lista para operar.")
         return brain_instance
     else:
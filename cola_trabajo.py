@@ -0,0 +1,123 @@
+import os
+import socket
+import logging
+import threading
+from dotenv import load_dotenv
+from pool_conexiones import conexion
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+# Segundos que un trabajador "posee" las filas que reclamó. Si muere, vuelven a la cola al vencer.
+LEASE_SEGUNDOS = int(os.environ.get("COLA_LEASE_SEGUNDOS", "600"))
+
+# Identidad de este proceso (máquina de fly.io + pid) para saber quién tomó cada fila
+_HOST = os.environ.get("FLY_MACHINE_ID") or socket.gethostname()
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+
+def id_trabajador(etapa):
+    return f"{etapa}@{_HOST}:{os.getpid()}"
+
+def asegurar_columnas():
+    """Agrega las columnas de reclamo a 'prospects' solo si faltan (evita bloquear la tabla en cada arranque)."""
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        with conexion() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_name = 'prospects'
+                AND column_name IN ('claimed_by', 'claimed_at', 'claim_expires_at', 'claim_attempts')
+            """)
+            if len(cur.fetchall()) < 4:
+                cur.execute("""
+                    ALTER TABLE prospects
+                        ADD COLUMN IF NOT EXISTS claimed_by TEXT,
+                        ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ,
+                        ADD COLUMN IF NOT EXISTS claim_expires_at TIMESTAMPTZ,
+                        ADD COLUMN IF NOT EXISTS claim_attempts INTEGER NOT NULL DEFAULT 0;
+                """)
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_prospects_status_claim ON prospects (status, claim_expires_at);")
+                logging.info("🧱 Columnas de reclamo (claimed_by / claim_expires_at) creadas en prospects.")
+            conn.commit()
+        _esquema_listo = True
+
+def reclamar_lote(etapa, condicion_sql, columnas_sql, limite, parametros=(), orden_sql=None, lease_segundos=LEASE_SEGUNDOS):
+    """
+    Reclama atómicamente hasta `limite` prospectos que cumplan `condicion_sql` (alias p)
+    y que nadie tenga reclamados con un lease vigente. El reclamo se confirma EN EL ACTO,
+    así el trabajo lento (Gemini, webs) ocurre fuera de cualquier transacción.
+
+    `columnas_sql` puede usar los alias p (prospects) y c (campaigns).
+    Las filas quedan con claimed_by = dueño; si el trabajador muere, el lease vence y
+    otro las retoma. Devuelve (dueño, filas).
+    """
+    asegurar_columnas()
+    dueno = id_trabajador(etapa)
+    orden = f"ORDER BY {orden_sql}" if orden_sql else ""
+    sql = f"""
+        WITH candidatos AS (
+            SELECT p.id
+            FROM prospects p
+            WHERE ({condicion_sql})
+            AND (p.claim_expires_at IS NULL OR p.claim_expires_at < NOW())
+            {orden}
+            LIMIT %s
+            FOR UPDATE OF p SKIP LOCKED
+        )
+        UPDATE prospects p
+        SET claimed_by = %s,
+            claimed_at = NOW(),
+            claim_expires_at = NOW() + make_interval(secs => %s)
+        FROM candidatos k, campaigns c
+        WHERE p.id = k.id AND c.id = p.campaign_id
+        RETURNING {columnas_sql}
+    """
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute(sql, tuple(parametros) + (limite, dueno, lease_segundos))
+        filas = cur.fetchall()
+        conn.commit()
+    return dueno, filas
+
+def liberar(ids, dueno):
+    """Devuelve a la cola filas reclamadas que no se llegaron a procesar."""
+    if not ids:
+        return
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE prospects SET claim_expires_at = NULL
+            WHERE id IN %s AND claimed_by = %s
+        """, (tuple(ids), dueno))
+        conn.commit()
+
+def registrar_fallos(ids, dueno, max_intentos, estado_fallido):
+    """
+    Devuelve a la cola filas cuyo procesamiento falló, sumando un intento.
+    Al llegar a `max_intentos` pasan a `estado_fallido` y dejan de reclamarse.
+    Con dueno=None no se exige reclamo (etapas que seleccionan sin reclamar, como el Espía).
+    Devuelve cuántas quedaron en el estado terminal.
+    """
+    if not ids:
+        return 0
+    asegurar_columnas()
+    del_dueno = "AND claimed_by = %s" if dueno is not None else ""
+    parametros = (max_intentos, estado_fallido, tuple(ids)) + ((dueno,) if dueno is not None else ()) + (estado_fallido,)
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE prospects
+            SET claim_attempts = claim_attempts + 1,
+                claim_expires_at = NULL,
+                status = CASE WHEN claim_attempts + 1 >= %s THEN %s ELSE status END,
+                updated_at = NOW()
+            WHERE id IN %s {del_dueno}
+            RETURNING status = %s
+        """, parametros)
+        terminales = sum(1 for (terminal,) in cur.fetchall() if terminal)
+        conn.commit()
+    return terminales
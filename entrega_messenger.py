@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+# Endpoint de envío (se puede apuntar a un doble local para pruebas de carga)
+GRAPH_API_URL = os.environ.get("GRAPH_API_URL", "https://graph.facebook.com/v19.0/me/messages")
+GRAPH_TIMEOUT_SEG = float(os.environ.get("GRAPH_TIMEOUT_SEG", "15"))
+GRAPH_REINTENTOS = int(os.environ.get("GRAPH_REINTENTOS", "4"))
+GRAPH_BACKOFF_BASE_SEG = float(os.environ.get("GRAPH_BACKOFF_BASE_SEG", "1"))
+GRAPH_BACKOFF_MAX_SEG = float(os.environ.get("GRAPH_BACKOFF_MAX_SEG", "60"))
+# % de uso (X-App-Usage / X-Business-Use-Case-Usage) a partir del cual se frena antes del bloqueo
+GRAPH_USO_FRENO = float(os.environ.get("GRAPH_USO_FRENO", "85"))
+GRAPH_PAUSA_FRENO_SEG = float(os.environ.get("GRAPH_PAUSA_FRENO_SEG", "5"))
+
+# Códigos de error de Graph que significan "vas demasiado rápido"
+# 4 app, 17 usuario, 32 página, 613 llamadas, 80006 Messenger
+_CODIGOS_LIMITE = {4, 17, 32, 613, 80006}
+_CODIGOS_HTTP_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+def uso_graph(respuesta):
+    """
+    Lee las cabeceras de uso de Graph y devuelve (porcentaje_max, segundos_hasta_recuperar).
+    X-App-Usage / X-Page-Usage: {"call_count": %, "total_time": %, "total_cputime": %}
+    X-Business-Use-Case-Usage: {"<id>": [{..., "estimated_time_to_regain_access": minutos}]}
+    """
+    porcentaje, recuperar = 0.0, 0.0
+    for cabecera in ("X-App-Usage", "X-Page-Usage", "X-Ad-Account-Usage"):
+        try:
+            datos = json.loads(respuesta.headers.get(cabecera) or "{}")
+            porcentaje = max([porcentaje] + [float(v) for v in datos.values() if isinstance(v, (int, float))])
+        except (ValueError, AttributeError):
+            pass
+    try:
+        for entradas in json.loads(respuesta.headers.get("X-Business-Use-Case-Usage") or "{}").values():
+            for e in entradas:
+                porcentaje = max(porcentaje, *(float(e.get(k) or 0) for k in ("call_count", "total_time", "total_cputime")))
+                recuperar = max(recuperar, float(e.get("estimated_time_to_regain_access") or 0) * 60)
+    except (ValueError, AttributeError, TypeError):
+        pass
+    return porcentaje, recuperar
+
+def _codigo_graph(respuesta):
+    try:
+        return (respuesta.json().get("error") or {}).get("code")
+    except ValueError:
+        return None
+
+def _retry_after(respuesta):
+    try:
+        return float(respuesta.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class EntregaMessenger:
+    """
+    Cliente de envío a la Send API de Messenger compartido por varios hilos:
+    conexiones HTTP reutilizadas (keep-alive), freno común cuando Graph avisa de que se
+    acerca al límite y reintentos con backoff exponencial + jitter ante 429/5xx/errores de cuota.
+    """
+
+    def __init__(self, token, url=GRAPH_API_URL, conexiones=10, reintentos=GRAPH_REINTENTOS, timeout=GRAPH_TIMEOUT_SEG):
+        self.token = token
+        self.url = url
+        self.reintentos = max(0, reintentos)
+        self.timeout = timeout
+        self.sesion = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, conexiones))
+        self.sesion.mount("https://", adaptador)
+        self.sesion.mount("http://", adaptador)
+        self.sesion.headers.update({"Content-Type": "application/json"})
+
+        self._lock = threading.Lock()
+        self._pausa_hasta = 0.0
+        self._stats = {"enviados": 0, "fallidos": 0, "reintentos": 0, "frenados": 0, "pausa_total_seg": 0.0}
+
+    # --- FRENO COMPARTIDO ---
+
+    def _pausar(self, segundos):
+        with self._lock:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+            self._stats["frenados"] += 1
+
+    def _esperar_freno(self):
+        while True:
+            with self._lock:
+                restante = self._pausa_hasta - time.monotonic()
+            if restante <= 0:
+                return
+            with self._lock:
+                self._stats["pausa_total_seg"] += restante
+            time.sleep(restante)
+
+    def _contar(self, clave):
+        with self._lock:
+            self._stats[clave] += 1
+
+    # --- ENVÍO ---
+
+    def enviar(self, destinatario, texto):
+        """Envía un mensaje. Devuelve True si Graph lo aceptó (tras los reintentos necesarios)."""
+        datos = {"recipient": {"id": destinatario}, "message": {"text": texto}}
+        for intento in range(self.reintentos + 1):
+            self._esperar_freno()
+            try:
+                r = self.sesion.post(self.url, params={"access_token": self.token}, json=datos, timeout=self.timeout)
+            except requests.RequestException as e:
+                r, error = None, str(e)
+            else:
+                error = r.text[:300]
+                porcentaje, recuperar = uso_graph(r)
+                if porcentaje >= GRAPH_USO_FRENO:
+                    # Antes de que Graph bloquee: todos los hilos esperan un poco (o lo que Graph estime)
+                    self._pausar(max(recuperar, GRAPH_PAUSA_FRENO_SEG * porcentaje / 100))
+                if r.status_code == 200:
+                    self._contar("enviados")
+                    return True
+
+            limitado = r is not None and (r.status_code == 429 or _codigo_graph(r) in _CODIGOS_LIMITE)
+            reintentable = r is None or limitado or r.status_code in _CODIGOS_HTTP_REINTENTABLES
+            if not reintentable or intento == self.reintentos:
+                break
+
+            espera = min(GRAPH_BACKOFF_MAX_SEG, GRAPH_BACKOFF_BASE_SEG * (2 ** intento)) * random.uniform(0.5, 1.0)
+            if r is not None:
+                espera = max(espera, _retry_after(r) or 0, uso_graph(r)[1])
+            if limitado:
+                # Un límite de cuota afecta a todos los envíos, no solo a este hilo
+                self._pausar(espera)
+            self._contar("reintentos")
+            time.sleep(0 if limitado else espera)
+
+        self._contar("fallidos")
+        logging.warning(f"⚠️ Messenger: no se pudo enviar a {destinatario}: {error}")
+        return False
+
+    def metricas(self):
+        with self._lock:
+            return {**self._stats, "pausa_total_seg": round(self._stats["pausa_total_seg"], 2)}
+
+    def cerrar(self):
+        self.sesion.close()
+
+
+# --- DOBLE LOCAL DE GRAPH (PRUEBAS DE CARGA) ---
+
+class GraphLocal:
+    """
+    Servidor HTTP local que imita la Send API: latencia configurable, un % de respuestas 429
+    con Retry-After y cabecera X-App-Usage. Uso: `with GraphLocal(latencia=0.05) as g: g.url`.
+    """
+
+    def __init__(self, latencia=0.05, tasa_429=0.0, uso=10, puerto=0):
+        doble = self
+        self.latencia = latencia
+        self.tasa_429 = tasa_429
+        self.uso = uso
+        self.recibidos = 0
+        self._lock = threading.Lock()
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                time.sleep(doble.latencia)
+                if random.random() < doble.tasa_429:
+                    estado, cuerpo = 429, {"error": {"code": 613, "message": "Calls to this api have exceeded the rate limit."}}
+                else:
+                    with doble._lock:
+                        doble.recibidos += 1
+                    estado, cuerpo = 200, {"recipient_id": "1", "message_id": "m_local"}
+                datos = json.dumps(cuerpo).encode("utf-8")
+                self.send_response(estado)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(datos)))
+                self.send_header("X-App-Usage", json.dumps({"call_count": doble.uso, "total_time": doble.uso, "total_cputime": doble.uso}))
+                if estado == 429:
+                    self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def log_message(self, *args):
+                pass
+
+        self._servidor = ThreadingHTTPServer(("127.0.0.1", puerto), Manejador)
+        self._servidor.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._servidor.server_address[1]}/v19.0/me/messages"
+
+    def __enter__(self):
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+
+if __name__ == "__main__":
+    # Prueba de carga sin Facebook: python entrega_messenger.py [mensajes] [hilos] [latencia_seg]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    hilos = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    latencia = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+
+    from concurrent.futures import ThreadPoolExecutor
+    with GraphLocal(latencia=latencia, tasa_429=0.02) as graph:
+        entrega = EntregaMessenger("token-local", url=graph.url, conexiones=hilos)
+        inicio = time.monotonic()
+        with ThreadPoolExecutor(max_workers=hilos) as ejecutor:
+            list(ejecutor.map(lambda i: entrega.enviar(f"psid-{i}", "Hola"), range(total)))
+        duracion = time.monotonic() - inicio
+        entrega.cerrar()
+    m = entrega.metricas()
+    logging.info(f"📨 {m['enviados']}/{total} enviados en {duracion:.2f}s ({m['enviados'] / duracion:.1f} msg/s). {m}")
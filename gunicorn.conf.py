@@ -0,0 +1,49 @@
+import os
+import sys
+import logging
+
+# Gunicorn carga este archivo solo (está en el directorio de trabajo): vale para el Dockerfile y el Procfile.
+
+bind = os.environ.get("GUNICORN_BIND", f"0.0.0.0:{os.environ.get('PORT', '8080')}")
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# Hilos por worker: un stream SSE del chat ocupa su hilo durante toda la respuesta de Gemini,
+# así que con un solo hilo /ver-pre-nido y el resto de la web esperarían detrás de cada chat.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+
+# --preload: el master importa la app una vez y los workers la heredan por fork (copy-on-write).
+# Arrancan más rápido y comparten memoria; cada worker crea después sus propias conexiones y clientes.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "0") == "1"
+
+# Con preload, módulos que el master importa además de main (también por fork, sin crear clientes).
+# El SDK de Gemini solo se importa: sus canales gRPC no sobreviven un fork y se abren en cada worker.
+PRECARGAR = [m for m in os.environ.get("GUNICORN_PRECARGAR", "trabajador_nutridor,cerebro_dashboard").split(",") if m.strip()]
+PRECARGAR_SDK = os.environ.get("GUNICORN_PRECARGAR_SDK", "0") == "1"
+
+
+def on_starting(server):
+    if not preload_app:
+        return
+    modulos = [m.strip() for m in PRECARGAR] + (["google.generativeai"] if PRECARGAR_SDK else [])
+    for modulo in modulos:
+        try:
+            __import__(modulo)
+        except Exception as e:
+            logging.warning(f"⚠️ Precarga: no se pudo importar {modulo}: {e}")
+
+
+def post_fork(server, worker):
+    # Lo que el master haya creado (cerebros, pasarela, pool, buffer) no se comparte entre procesos
+    main = sys.modules.get("main")
+    if main is not None:
+        main.reiniciar_tras_fork()
+    pasarela = sys.modules.get("pasarela_llm")
+    if pasarela is not None:
+        pasarela._pasarela = None
+    pool = sys.modules.get("pool_conexiones")
+    if pool is not None and pool._pool is not None:
+        pool._pool._verificar_fork()
+    buffer = sys.modules.get("buffer_interacciones")
+    if buffer is not None and buffer._buffer is not None:
+        buffer._buffer._verificar_fork()
@@ -0,0 +1,213 @@
+import os
+import time
+import json
+import hashlib
+import logging
+import threading
+from dotenv import load_dotenv
+from pool_conexiones import conexion
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+# Segundos que el proceso web reutiliza los KPIs ya leídos de un cliente
+KPIS_CACHE_SEGUNDOS = float(os.environ.get("KPIS_CACHE_SEGUNDOS", "15"))
+# Un prospecto cuenta como 'calificado' a partir de estas interacciones en el Nido
+UMBRAL_CALIFICADO = 3
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+# --- CONTADORES MANTENIDOS POR TRIGGERS ---
+# Triggers por SENTENCIA con tablas de transición: un INSERT masivo del Cazador
+# actualiza cada campaña una sola vez, no una vez por fila.
+
+_SQL_FUNCIONES = f"""
+CREATE OR REPLACE FUNCTION kpis_prospects_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO campaign_kpis AS k (campaign_id, total, calificados, actualizado_en)
+    SELECT campaign_id, COUNT(*),
+           COUNT(*) FILTER (WHERE nurture_interactions_count >= {UMBRAL_CALIFICADO}), NOW()
+    FROM nuevos WHERE campaign_id IS NOT NULL
+    GROUP BY campaign_id
+    ON CONFLICT (campaign_id) DO UPDATE SET
+        total = k.total + EXCLUDED.total,
+        calificados = k.calificados + EXCLUDED.calificados,
+        actualizado_en = NOW();
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION kpis_prospects_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE campaign_kpis k SET
+        total = k.total - d.total,
+        calificados = k.calificados - d.calificados,
+        actualizado_en = NOW()
+    FROM (
+        SELECT campaign_id, COUNT(*) AS total,
+               COUNT(*) FILTER (WHERE nurture_interactions_count >= {UMBRAL_CALIFICADO}) AS calificados
+        FROM viejos WHERE campaign_id IS NOT NULL
+        GROUP BY campaign_id
+    ) d
+    WHERE k.campaign_id = d.campaign_id;
+    RETURN NULL;
+END $$;
+
+CREATE OR REPLACE FUNCTION kpis_prospects_update() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    -- Solo toca campaign_kpis si cambió la campaña o el estado de calificación
+    INSERT INTO campaign_kpis AS k (campaign_id, total, calificados, actualizado_en)
+    SELECT campaign_id, SUM(dt), SUM(dc), NOW()
+    FROM (
+        SELECT campaign_id, 1 AS dt,
+               CASE WHEN nurture_interactions_count >= {UMBRAL_CALIFICADO} THEN 1 ELSE 0 END AS dc
+        FROM nuevos
+        UNION ALL
+        SELECT campaign_id, -1,
+               CASE WHEN nurture_interactions_count >= {UMBRAL_CALIFICADO} THEN -1 ELSE 0 END
+        FROM viejos
+    ) delta
+    WHERE campaign_id IS NOT NULL
+    GROUP BY campaign_id
+    HAVING SUM(dt) <> 0 OR SUM(dc) <> 0
+    ON CONFLICT (campaign_id) DO UPDATE SET
+        total = k.total + EXCLUDED.total,
+        calificados = k.calificados + EXCLUDED.calificados,
+        actualizado_en = NOW();
+    RETURN NULL;
+END $$;
+"""
+
+_SQL_TRIGGERS = """
+DROP TRIGGER IF EXISTS trg_kpis_insert ON prospects;
+CREATE TRIGGER trg_kpis_insert AFTER INSERT ON prospects
+    REFERENCING NEW TABLE AS nuevos
+    FOR EACH STATEMENT EXECUTE FUNCTION kpis_prospects_insert();
+
+DROP TRIGGER IF EXISTS trg_kpis_delete ON prospects;
+CREATE TRIGGER trg_kpis_delete AFTER DELETE ON prospects
+    REFERENCING OLD TABLE AS viejos
+    FOR EACH STATEMENT EXECUTE FUNCTION kpis_prospects_delete();
+
+DROP TRIGGER IF EXISTS trg_kpis_update ON prospects;
+CREATE TRIGGER trg_kpis_update AFTER UPDATE ON prospects
+    REFERENCING OLD TABLE AS viejos NEW TABLE AS nuevos
+    FOR EACH STATEMENT EXECUTE FUNCTION kpis_prospects_update();
+"""
+
+_SQL_RECONTAR = f"""
+INSERT INTO campaign_kpis AS k (campaign_id, total, calificados, actualizado_en)
+SELECT c.id, COUNT(p.id),
+       COUNT(p.id) FILTER (WHERE p.nurture_interactions_count >= {UMBRAL_CALIFICADO}), NOW()
+FROM campaigns c
+LEFT JOIN prospects p ON p.campaign_id = c.id
+GROUP BY c.id
+ON CONFLICT (campaign_id) DO UPDATE SET
+    total = EXCLUDED.total,
+    calificados = EXCLUDED.calificados,
+    actualizado_en = NOW();
+"""
+
+
+def asegurar_esquema():
+    """Crea la tabla de KPIs, sus triggers y la rellena una vez (solo si no existe)."""
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        with conexion() as conn, conn.cursor() as cur:
+            # Varios workers de gunicorn pueden arrancar a la vez: solo uno crea el esquema
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('campaign_kpis'))")
+            cur.execute("SELECT to_regclass('campaign_kpis') IS NOT NULL")
+            if not cur.fetchone()[0]:
+                logging.info("🧱 Creando campaign_kpis + triggers y recontando (solo la primera vez)...")
+                # Mismo tipo que campaigns.id, sea uuid o entero
+                cur.execute("""
+                    CREATE TABLE campaign_kpis AS
+                    SELECT id AS campaign_id, 0::bigint AS total, 0::bigint AS calificados, NOW() AS actualizado_en
+                    FROM campaigns WITH NO DATA;
+                    ALTER TABLE campaign_kpis ADD PRIMARY KEY (campaign_id);
+                """)
+                cur.execute(_SQL_FUNCIONES)
+                # Los triggers bloquean escrituras en prospects hasta el commit: el recuento es exacto.
+                cur.execute(_SQL_TRIGGERS)
+                cur.execute(_SQL_RECONTAR)
+            conn.commit()
+        _esquema_listo = True
+
+def reconciliar_kpis():
+    """Recuento completo para corregir cualquier deriva (p.ej. cargas hechas con triggers desactivados)."""
+    asegurar_esquema()
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute(_SQL_RECONTAR)
+        conn.commit()
+    invalidar_cache()
+
+# --- LECTURA PARA EL DASHBOARD ---
+
+def _leer_kpis(client_email):
+    asegurar_esquema()
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.campaign_name, c.created_at, c.status,
+                   COALESCE(k.total, 0), COALESCE(k.calificados, 0)
+            FROM campaigns c
+            JOIN clients cl ON c.client_id = cl.id
+            LEFT JOIN campaign_kpis k ON k.campaign_id = c.id
+            WHERE cl.email = %s
+            ORDER BY c.created_at DESC
+        """, (client_email,))
+        filas = cur.fetchall()
+
+    campanas = []
+    total_prospectos = 0
+    total_calificados = 0
+    for row in filas:
+        total_prospectos += row[3]
+        total_calificados += row[4]
+        campanas.append({
+            "nombre": row[0],
+            "fecha": row[1].strftime('%Y-%m-%d') if row[1] else "-",
+            "estado": row[2],
+            "encontrados": row[3],
+            "calificados": row[4]
+        })
+    tasa_conversion = round((total_calificados / total_prospectos * 100), 1) if total_prospectos > 0 else 0
+
+    return {
+        "kpis": {
+            "total": total_prospectos,
+            "calificados": total_calificados,
+            "tasa": f"{tasa_conversion}%"
+        },
+        "campanas": campanas
+    }
+
+def obtener_kpis_cliente(client_email):
+    """
+    KPIs del dashboard en O(campañas). Devuelve (datos, etag).
+    Se cachean KPIS_CACHE_SEGUNDOS en el proceso.
+    """
+    ahora = time.monotonic()
+    with _cache_lock:
+        entrada = _cache.get(client_email)
+        if entrada and entrada[0] > ahora:
+            return entrada[1], entrada[2]
+
+    datos = _leer_kpis(client_email)
+    etag = hashlib.sha1(json.dumps(datos, sort_keys=True).encode("utf-8")).hexdigest()
+    with _cache_lock:
+        _cache[client_email] = (ahora + KPIS_CACHE_SEGUNDOS, datos, etag)
+    return datos, etag
+
+def invalidar_cache(client_email=None):
+    with _cache_lock:
+        if client_email is None:
+            _cache.clear()
+        else:
+            _cache.pop(client_email, None)
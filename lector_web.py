@@ -0,0 +1,187 @@
+import os
+import time
+import logging
+import threading
+import weakref
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup
+from metricas import observar
+
+# --- CONFIGURACIÓN ---
+# Solo guardamos este texto por web; no tiene sentido bajar más de lo necesario.
+LECTOR_MAX_CARACTERES = int(os.environ.get("LECTOR_MAX_CARACTERES", "2500"))
+# Tope duro de bytes descargados por web (el resto ni se lee)
+LECTOR_MAX_BYTES = int(os.environ.get("LECTOR_MAX_BYTES", str(512 * 1024)))
+LECTOR_TIMEOUT_CONEXION = float(os.environ.get("LECTOR_TIMEOUT_CONEXION", "3"))
+LECTOR_TIMEOUT_LECTURA = float(os.environ.get("LECTOR_TIMEOUT_LECTURA", "5"))
+# Plazo total por web: un host lento no bloquea más que esto aunque vaya goteando bytes
+LECTOR_TIMEOUT_TOTAL = float(os.environ.get("LECTOR_TIMEOUT_TOTAL", "8"))
+# Descargas simultáneas: total y por host (para no martillar un mismo directorio/franquicia)
+LECTOR_CONCURRENCIA = int(os.environ.get("LECTOR_CONCURRENCIA", "16"))
+LECTOR_MAX_POR_HOST = int(os.environ.get("LECTOR_MAX_POR_HOST", "2"))
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Cada cuántos bytes intentamos extraer texto para ver si ya alcanza (se duplica cada vez)
+_PRIMER_CHEQUEO_BYTES = 32 * 1024
+_TAMANO_TROZO = 16 * 1024
+
+
+def normalizar_url(url):
+    if not url: return ""
+    url = url.strip()
+    if not url.startswith("http"): url = "http://" + url
+    return url
+
+def extraer_texto(html, max_caracteres=LECTOR_MAX_CARACTERES):
+    """Extrae títulos, párrafos y meta description (misma regla que siempre usó el Analista)."""
+    soup = BeautifulSoup(html, 'html.parser')
+    textos = []
+    for tag in soup.find_all(['h1', 'h2', 'h3', 'p', 'meta']):
+        if tag.name == 'meta' and tag.get('name') == 'description':
+            textos.append(tag.get('content', ''))
+        else:
+            textos.append(tag.get_text(strip=True))
+    return " ".join(textos)[:max_caracteres]
+
+
+class Descarga:
+    """Resultado de una descarga. `estado` es el código HTTP o None si hubo error de red."""
+
+    __slots__ = ("url", "estado", "texto", "etag", "last_modified", "bytes_leidos", "segundos", "error")
+
+    def __init__(self, url, estado=None, texto="", etag=None, last_modified=None, bytes_leidos=0, segundos=0.0, error=None):
+        self.url = url
+        self.estado = estado
+        self.texto = texto
+        self.etag = etag
+        self.last_modified = last_modified
+        self.bytes_leidos = bytes_leidos
+        self.segundos = segundos
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.estado == 200
+
+
+class LectorWeb:
+    """
+    Lector de webs de prospectos con conexiones keep-alive reutilizadas,
+    límite de concurrencia por host, lectura en streaming con corte temprano
+    y descarga por lotes en paralelo.
+    """
+
+    def __init__(self, concurrencia=LECTOR_CONCURRENCIA, max_por_host=LECTOR_MAX_POR_HOST,
+                 max_bytes=LECTOR_MAX_BYTES, max_caracteres=LECTOR_MAX_CARACTERES):
+        self.max_por_host = max(1, max_por_host)
+        self.max_bytes = max_bytes
+        self.max_caracteres = max_caracteres
+
+        self.sesion = requests.Session()
+        self.sesion.headers.update({'User-Agent': USER_AGENT})
+        adaptador = HTTPAdapter(pool_connections=concurrencia, pool_maxsize=concurrencia, max_retries=0)
+        self.sesion.mount("http://", adaptador)
+        self.sesion.mount("https://", adaptador)
+
+        self._ejecutor = ThreadPoolExecutor(max_workers=max(1, concurrencia), thread_name_prefix="lector_web")
+        self._lock = threading.Lock()
+        self._semaforos = weakref.WeakValueDictionary()
+
+    def _semaforo_host(self, url):
+        host = (urlsplit(url).hostname or "").lower()
+        with self._lock:
+            sem = self._semaforos.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.max_por_host)
+                self._semaforos[host] = sem
+            return sem
+
+    def _leer_cuerpo(self, respuesta, inicio):
+        """Lee en trozos y corta al tener texto suficiente, al tope de bytes o al plazo total."""
+        codificacion = respuesta.encoding
+        if not codificacion or codificacion.lower() == "iso-8859-1":
+            codificacion = "utf-8"
+
+        trozos = []
+        leidos = 0
+        proximo_chequeo = _PRIMER_CHEQUEO_BYTES
+        for trozo in respuesta.iter_content(chunk_size=_TAMANO_TROZO):
+            if not trozo:
+                continue
+            trozos.append(trozo)
+            leidos += len(trozo)
+            if leidos >= self.max_bytes or time.time() - inicio > LECTOR_TIMEOUT_TOTAL:
+                break
+            if leidos >= proximo_chequeo:
+                proximo_chequeo *= 2
+                html = b"".join(trozos).decode(codificacion, errors="replace")
+                texto = extraer_texto(html, self.max_caracteres)
+                if len(texto) >= self.max_caracteres:
+                    return texto, leidos
+
+        html = b"".join(trozos).decode(codificacion, errors="replace")
+        return extraer_texto(html, self.max_caracteres), leidos
+
+    def descargar(self, url, cabeceras=None):
+        """
+        Descarga una web y devuelve un objeto Descarga.
+        `cabeceras` permite peticiones condicionales (If-None-Match / If-Modified-Since).
+        """
+        url = normalizar_url(url)
+        if not url:
+            return Descarga(url, error="sin url")
+
+        inicio = time.time()
+        with self._semaforo_host(url):
+            try:
+                with self.sesion.get(url, headers=cabeceras or {}, stream=True,
+                                     timeout=(LECTOR_TIMEOUT_CONEXION, LECTOR_TIMEOUT_LECTURA)) as r:
+                    descarga = Descarga(url, estado=r.status_code,
+                                        etag=r.headers.get("ETag"),
+                                        last_modified=r.headers.get("Last-Modified"))
+                    tipo = r.headers.get("Content-Type", "text/html").lower()
+                    if r.status_code == 200 and ("html" in tipo or "text" in tipo):
+                        descarga.texto, descarga.bytes_leidos = self._leer_cuerpo(r, inicio)
+            except Exception as e:
+                logging.warning(f"No se pudo leer la web {url}: {e}")
+                descarga = Descarga(url, error=str(e))
+
+        descarga.segundos = time.time() - inicio
+        resultado = "ok" if descarga.ok else ("no_modificada" if descarga.estado == 304 else "error")
+        observar("autoneura_web_segundos", descarga.segundos, resultado=resultado)
+        return descarga
+
+    def leer(self, url):
+        """Texto clave de la web ('' si no se pudo leer)."""
+        d = self.descargar(url)
+        return d.texto if d.ok else ""
+
+    def precargar(self, urls, lectura=None):
+        """
+        Lanza la lectura de un lote en paralelo. Devuelve {url: Future[str]} sin esperar.
+        `lectura` permite anteponer otra capa (p.ej. la caché) a self.leer.
+        """
+        lectura = lectura or self.leer
+        return {url: self._ejecutor.submit(lectura, url) for url in dict.fromkeys(u for u in urls if u)}
+
+    def leer_lote(self, urls):
+        """Lee un lote en paralelo y espera a todas. Devuelve {url: texto}."""
+        return {url: futuro.result() for url, futuro in self.precargar(urls).items()}
+
+
+# --- LECTOR COMPARTIDO DEL PROCESO ---
+
+_lector = None
+_lector_lock = threading.Lock()
+
+def obtener_lector():
+    global _lector
+    if _lector is None:
+        with _lector_lock:
+            if _lector is None:
+                _lector = LectorWeb()
+    return _lector
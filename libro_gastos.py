@@ -0,0 +1,115 @@
+import logging
+import threading
+from dotenv import load_dotenv
+from pool_conexiones import conexion
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+
+class Reserva:
+    """Cupo reservado en el libro para una corrida (se liquida con registrar_consumo)."""
+
+    __slots__ = ("campana_id", "trabajador", "dia", "cantidad")
+
+    def __init__(self, campana_id, trabajador, dia, cantidad):
+        self.campana_id = campana_id
+        self.trabajador = trabajador
+        self.dia = dia
+        self.cantidad = cantidad
+
+    def __bool__(self):
+        return self.cantidad > 0
+
+
+def asegurar_tabla():
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        with conexion() as conn, conn.cursor() as cur:
+            # campaign_id como TEXT: el libro no depende del tipo de campaigns.id
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS spend_ledger (
+                    campaign_id TEXT NOT NULL,
+                    trabajador TEXT NOT NULL,
+                    dia DATE NOT NULL,
+                    items_reservados INTEGER NOT NULL DEFAULT 0,
+                    items_consumidos INTEGER NOT NULL DEFAULT 0,
+                    costo_usd NUMERIC(12, 4) NOT NULL DEFAULT 0,
+                    corridas INTEGER NOT NULL DEFAULT 0,
+                    actualizado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (campaign_id, trabajador, dia)
+                );
+            """)
+            conn.commit()
+        _esquema_listo = True
+
+def reservar(campana_id, trabajador, solicitados, tope_diario, tope_mensual):
+    """
+    Reserva atómicamente hasta `solicitados` ítems sin superar los topes del día y del mes.
+    Un candado advisory por (trabajador, campaña) serializa a los hilos/procesos que
+    compiten por el mismo presupuesto: nunca pueden pasarse juntos.
+    Lo consumido en días anteriores cuenta para el mes; las reservas viejas sin liquidar
+    (un trabajador que murió) solo bloquean el día en que se hicieron.
+    Devuelve una Reserva (cantidad 0 si no hay saldo).
+    """
+    asegurar_tabla()
+    campana = str(campana_id)
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"spend_ledger:{trabajador}:{campana}",))
+        cur.execute("""
+            SELECT
+                CURRENT_DATE,
+                COALESCE(SUM(items_consumidos + items_reservados) FILTER (WHERE dia = CURRENT_DATE), 0),
+                COALESCE(SUM(items_consumidos), 0)
+                    + COALESCE(SUM(items_reservados) FILTER (WHERE dia = CURRENT_DATE), 0)
+            FROM spend_ledger
+            WHERE campaign_id = %s AND trabajador = %s
+            AND dia >= date_trunc('month', CURRENT_DATE)::date
+        """, (campana, trabajador))
+        hoy, usado_hoy, usado_mes = cur.fetchone()
+
+        cantidad = int(max(0, min(solicitados, tope_diario - usado_hoy, tope_mensual - usado_mes)))
+        if cantidad > 0:
+            cur.execute("""
+                INSERT INTO spend_ledger (campaign_id, trabajador, dia, items_reservados)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (campaign_id, trabajador, dia) DO UPDATE SET
+                    items_reservados = spend_ledger.items_reservados + EXCLUDED.items_reservados,
+                    actualizado_en = NOW()
+            """, (campana, trabajador, hoy, cantidad))
+        conn.commit()
+
+    logging.info(
+        f"📒 Libro [{trabajador}] campaña {campana}: hoy {usado_hoy}/{int(tope_diario)}, "
+        f"mes {usado_mes}/{int(tope_mensual)}. Reservado: {cantidad}"
+    )
+    return Reserva(campana, trabajador, hoy, cantidad)
+
+def registrar_consumo(reserva, consumidos, costo_unitario):
+    """
+    Liquida una reserva: libera lo reservado y anota lo realmente consumido y su costo.
+    Llamar SIEMPRE al terminar la corrida (con consumidos=0 si falló) para devolver el cupo.
+    """
+    if reserva is None or (reserva.cantidad <= 0 and consumidos <= 0):
+        return
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO spend_ledger (campaign_id, trabajador, dia, items_consumidos, costo_usd, corridas)
+            VALUES (%s, %s, %s, %s, %s, 1)
+            ON CONFLICT (campaign_id, trabajador, dia) DO UPDATE SET
+                items_reservados = GREATEST(spend_ledger.items_reservados - %s, 0),
+                items_consumidos = spend_ledger.items_consumidos + EXCLUDED.items_consumidos,
+                costo_usd = spend_ledger.costo_usd + EXCLUDED.costo_usd,
+                corridas = spend_ledger.corridas + 1,
+                actualizado_en = NOW()
+        """, (reserva.campana_id, reserva.trabajador, reserva.dia, int(consumidos),
+              round(consumidos * costo_unitario, 4), reserva.cantidad))
+        conn.commit()
+    logging.info(f"📒 Libro [{reserva.trabajador}] campaña {reserva.campana_id}: consumidos {consumidos} (${consumidos * costo_unitario:.4f}).")
@@ -0,0 +1,54 @@
+import time
+import threading
+
+
+class CubetaTokens:
+    """
+    Limitador 'token bucket' seguro para hilos.
+    Se rellena a `tasa_por_segundo` tokens/seg hasta `capacidad` (ráfaga máxima).
+    Reemplaza los time.sleep fijos: solo se espera cuando de verdad no hay cuota.
+    """
+
+    def __init__(self, tasa_por_segundo, capacidad=None):
+        self.tasa = max(float(tasa_por_segundo), 1e-6)
+        self.capacidad = float(capacidad if capacidad is not None else max(1.0, self.tasa))
+        self._tokens = self.capacidad
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def por_minuto(cls, peticiones_por_minuto, rafaga=None):
+        return cls(peticiones_por_minuto / 60.0, rafaga)
+
+    def _rellenar(self):
+        ahora = time.monotonic()
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.tasa)
+        self._ultimo = ahora
+
+    def intentar(self, tokens=1.0):
+        """Consume sin esperar. True si había cuota."""
+        with self._lock:
+            self._rellenar()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def adquirir(self, tokens=1.0, timeout=None):
+        """Espera hasta tener cuota. Devuelve los segundos esperados, o None si venció el timeout."""
+        inicio = time.monotonic()
+        while True:
+            with self._lock:
+                self._rellenar()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return time.monotonic() - inicio
+                faltan = (tokens - self._tokens) / self.tasa
+            if timeout is not None and time.monotonic() - inicio + faltan > timeout:
+                return None
+            time.sleep(min(faltan, 1.0))
+
+    def disponibles(self):
+        with self._lock:
+            self._rellenar()
+            return self._tokens
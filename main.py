@@ -1,24 +1,18 @@
 import os
-import psycopg2
 import json
-import google.generativeai as genai
 import uuid
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+import logging
+import threading
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, session, stream_with_context
 from flask_babel import Babel, gettext
 from psycopg2.extras import Json
 from werkzeug.routing import BaseConverter
 from dotenv import load_dotenv
-
-# --- IMPORTACIÓN DE MÓDULOS PROPIOS ---
-try:
-    from cerebro_dashboard import create_chatbot
-except ImportError:
-    create_chatbot = None
-
-try:
-    from trabajador_nutridor import TrabajadorNutridor
-except ImportError:
-    TrabajadorNutridor = None
+from pool_conexiones import conexion
+from kpis_dashboard import obtener_kpis_cliente, invalidar_cache as invalidar_cache_kpis
+from pasarela_llm import llm_disponible
+from cache_sesiones_nido import invalidar_contexto
+from metricas import exponer as exponer_metricas, contar_transicion, TIPO_CONTENIDO as TIPO_METRICAS
 
 # --- CONFIGURACIÓN INICIAL ---
 load_dotenv()
@@ -49,20 +43,47 @@ def inject_get_locale():
 DATABASE_URL = os.environ.get("DATABASE_URL")
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
+# --- CEREBROS IA (PEREZOSOS) ---
+# Se importan y crean al primer mensaje de chat, no al arrancar: así un worker recién
+# levantado (fly.io escala desde cero) sirve la primera landing sin cargar los SDK de IA.
 dashboard_brain = None
 nutridor_brain = None
-
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    if TrabajadorNutridor:
-        nutridor_brain = TrabajadorNutridor()
+_cerebros_lock = threading.Lock()
+
+def obtener_nutridor():
+    global nutridor_brain
+    if nutridor_brain is None and llm_disponible():
+        with _cerebros_lock:
+            if nutridor_brain is None:
+                try:
+                    from trabajador_nutridor import TrabajadorNutridor
+                    nutridor_brain = TrabajadorNutridor()
+                except ImportError as e:
+                    logging.error(f"❌ No se pudo cargar el Nutridor: {e}")
+    return nutridor_brain
+
+def obtener_dashboard_brain():
+    global dashboard_brain
+    if dashboard_brain is None:
+        with _cerebros_lock:
+            if dashboard_brain is None:
+                try:
+                    from cerebro_dashboard import create_chatbot
+                    dashboard_brain = create_chatbot()
+                except ImportError as e:
+                    logging.error(f"❌ No se pudo cargar el cerebro del dashboard: {e}")
+    return dashboard_brain
+
+def reiniciar_tras_fork():
+    """Hook post_fork de gunicorn (--preload): cada worker crea sus propios cerebros, locks y clientes."""
+    global dashboard_brain, nutridor_brain, _cerebros_lock
+    dashboard_brain = None
+    nutridor_brain = None
+    _cerebros_lock = threading.Lock()
 
 def get_db_connection():
-    try:
-        return psycopg2.connect(DATABASE_URL)
-    except Exception as e:
-        print(f"Error DB: {e}")
-        return None
+    """Conexión prestada del pool. Usar SIEMPRE como `with get_db_connection() as conn:`."""
+    return conexion()
 
 # --- RUTAS PRINCIPALES ---
 @app.route('/')
@@ -83,171 +104,158 @@ def admin_taller(): return render_template('admin_taller.html')
 # --- API: DATOS DEL DASHBOARD ---
 @app.route('/api/dashboard-data', methods=['GET'])
 def obtener_datos_dashboard():
-    conn = get_db_connection()
-    if not conn: return jsonify({"error": "No DB"}), 500
-    
     try:
-        cur = conn.cursor()
         client_email = 'admin@autoneura.com' 
-        
-        cur.execute("""
-            SELECT 
-                COUNT(p.id) as total,
-                COUNT(p.id) FILTER (WHERE p.nurture_interactions_count >= 3) as calificados
-            FROM prospects p
-            JOIN campaigns c ON p.campaign_id = c.id
-            JOIN clients cl ON c.client_id = cl.id
-            WHERE cl.email = %s
-        """, (client_email,))
-        kpis = cur.fetchone()
-        total_prospectos = kpis[0] or 0
-        total_calificados = kpis[1] or 0
-        tasa_conversion = round((total_calificados / total_prospectos * 100), 1) if total_prospectos > 0 else 0
-
-        cur.execute("""
-            SELECT 
-                c.campaign_name, 
-                c.created_at, 
-                c.status,
-                COUNT(p.id) as encontrados,
-                COUNT(p.id) FILTER (WHERE p.nurture_interactions_count >= 3) as leads
-            FROM campaigns c
-            JOIN clients cl ON c.client_id = cl.id
-            LEFT JOIN prospects p ON c.id = p.campaign_id
-            WHERE cl.email = %s
-            GROUP BY c.id
-            ORDER BY c.created_at DESC
-        """, (client_email,))
-        
-        campanas = []
-        for row in cur.fetchall():
-            campanas.append({
-                "nombre": row[0],
-                "fecha": row[1].strftime('%Y-%m-%d') if row[1] else "-",
-                "estado": row[2],
-                "encontrados": row[3],
-                "calificados": row[4]
-            })
-
-        return jsonify({
-            "kpis": {
-                "total": total_prospectos,
-                "calificados": total_calificados,
-                "tasa": f"{tasa_conversion}%"
-            },
-            "campanas": campanas
-        })
+        # KPIs mantenidos por triggers (O(campañas)) + caché corta en proceso
+        datos, etag = obtener_kpis_cliente(client_email)
+        respuesta = jsonify(datos)
+        respuesta.set_etag(etag)
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+        # Si el navegador ya tiene esta versión, responde 304 sin cuerpo
+        return respuesta.make_conditional(request)
 
     except Exception as e:
         print(f"Error API Dashboard: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        cur.close()
-        conn.close()
 
 # --- API: CREAR CAMPAÑA (CORREGIDO: AHORA GUARDA LOS DATOS NUEVOS) ---
 @app.route('/api/crear-campana', methods=['POST'])
 def crear_campana():
-    conn = get_db_connection()
-    if not conn: return jsonify({"success": False}), 500
     try:
-        d = request.json
-        cur = conn.cursor()
+        with get_db_connection() as conn:
+            d = request.json
+            cur = conn.cursor()
         
-        # 1. Obtener o Crear Cliente Admin
-        cur.execute("SELECT id FROM clients WHERE email = 'admin@autoneura.com'")
-        res = cur.fetchone()
-        if not res:
-            cur.execute("INSERT INTO clients (email, full_name, plan_type, plan_cost) VALUES ('admin@autoneura.com', 'Admin', 'starter', 149.00) RETURNING id")
-            cid = cur.fetchone()[0]
-            conn.commit()
-        else:
-            cid = res[0]
-
-        # 2. Preparar Datos (Incluyendo los nuevos campos estratégicos)
-        desc = f"{d.get('que_vende')}. {d.get('descripcion')}"
+            # 1. Obtener o Crear Cliente Admin
+            cur.execute("SELECT id FROM clients WHERE email = 'admin@autoneura.com'")
+            res = cur.fetchone()
+            if not res:
+                cur.execute("INSERT INTO clients (email, full_name, plan_type, plan_cost) VALUES ('admin@autoneura.com', 'Admin', 'starter', 149.00) RETURNING id")
+                cid = cur.fetchone()[0]
+                conn.commit()
+            else:
+                cid = res[0]
+
+            # 2. Preparar Datos (Incluyendo los nuevos campos estratégicos)
+            desc = f"{d.get('que_vende')}. {d.get('descripcion')}"
         
-        # Recogemos los campos nuevos del formulario HTML
-        ticket = d.get('ticket_producto')
-        competidores = d.get('competidores_principales')
-        cta = d.get('objetivo_cta')
-        dolores = d.get('dolores_pain_points')
-        tono = d.get('tono_marca')
-        red_flags = d.get('red_flags')
+            # Recogemos los campos nuevos del formulario HTML
+            ticket = d.get('ticket_producto')
+            competidores = d.get('competidores_principales')
+            cta = d.get('objetivo_cta')
+            dolores = d.get('dolores_pain_points')
+            tono = d.get('tono_marca')
+            red_flags = d.get('red_flags')
         
-        # Guardamos en la base de datos (INSERT actualizado)
-        cur.execute("""
-            INSERT INTO campaigns (
-                client_id, campaign_name, product_description, target_audience, 
-                product_type, search_languages, geo_location,
-                ticket_price, competitors, cta_goal, pain_points_defined, tone_voice, red_flags,
-                status, created_at
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'active', NOW())
-            RETURNING id
-        """, (
-            cid, d.get('nombre'), desc, d.get('a_quien'), 
-            d.get('tipo_producto'), d.get('idiomas'), d.get('ubicacion'),
-            ticket, competidores, cta, dolores, tono, red_flags
-        ))
+            # Guardamos en la base de datos (INSERT actualizado)
+            cur.execute("""
+                INSERT INTO campaigns (
+                    client_id, campaign_name, product_description, target_audience, 
+                    product_type, search_languages, geo_location,
+                    ticket_price, competitors, cta_goal, pain_points_defined, tone_voice, red_flags,
+                    status, created_at
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 'active', NOW())
+                RETURNING id
+            """, (
+                cid, d.get('nombre'), desc, d.get('a_quien'), 
+                d.get('tipo_producto'), d.get('idiomas'), d.get('ubicacion'),
+                ticket, competidores, cta, dolores, tono, red_flags
+            ))
         
-        nid = cur.fetchone()[0]
-        conn.commit()
-        return jsonify({"success": True})
+            nid = cur.fetchone()[0]
+            conn.commit()
+            invalidar_cache_kpis('admin@autoneura.com')
+            return jsonify({"success": True})
     except Exception as e:
-        if conn: conn.rollback()
+        # El pool ya hizo rollback y recuperó la conexión
         # Logueamos el error para verlo en Railway si falla
         print(f"ERROR CREANDO CAMPAÑA: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
-    finally:
-        conn.close()
 
 # --- RUTAS DE NIDO ---
 @app.route('/ver-pre-nido/<string:token>')
 def mostrar_pre_nido(token):
-    conn = get_db_connection()
-    if not conn: return "Error DB", 500
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, business_name, generated_content FROM prospects WHERE access_token = %s", (token,))
-            res = cur.fetchone()
-            if res:
-                content = res[2] if res[2] else {}
-                if isinstance(content, str): content = json.loads(content)
-                return render_template('persuasor.html', prospecto_id=res[0], nombre_negocio=res[1], 
-                                     titulo_personalizado=content.get('prenido_titulo', 'Hola'),
-                                     mensaje_personalizado=content.get('prenido_mensaje', 'Bienvenido'))
-            return "Enlace no válido", 404
-    finally:
-        conn.close()
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id, business_name, generated_content FROM prospects WHERE access_token = %s", (token,))
+        res = cur.fetchone()
+    if res:
+        content = res[2] if res[2] else {}
+        if isinstance(content, str): content = json.loads(content)
+        return render_template('persuasor.html', prospecto_id=res[0], nombre_negocio=res[1], 
+                             titulo_personalizado=content.get('prenido_titulo', 'Hola'),
+                             mensaje_personalizado=content.get('prenido_mensaje', 'Bienvenido'))
+    return "Enlace no válido", 404
 
 @app.route('/generar-nido', methods=['POST'])
 def generar_nido_y_entrar():
     email = request.form.get('email')
     pid = request.form.get('prospecto_id')
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                UPDATE prospects SET captured_email = %s, status = 'nutriendo', last_interaction_at = NOW()
-                WHERE id = %s RETURNING business_name, access_token
-            """, (email, pid))
-            res = cur.fetchone()
-            conn.commit()
-            if res:
-                return render_template('nido_template.html', nombre_negocio=res[0], token_sesion=res[1], 
-                                     titulo_personalizado=f"Bienvenido {res[0]}", texto_contenido_de_valor="Demo")
-            return "Error", 404
-    finally:
-        conn.close()
+    with get_db_connection() as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE prospects SET captured_email = %s, status = 'nutriendo', last_interaction_at = NOW()
+            WHERE id = %s RETURNING business_name, access_token
+        """, (email, pid))
+        res = cur.fetchone()
+        conn.commit()
+    if res:
+        contar_transicion("nutriendo")
+        # Sesión nueva del Nido: que el chat relea el contexto del prospecto
+        invalidar_contexto(res[1])
+        return render_template('nido_template.html', nombre_negocio=res[0], token_sesion=res[1], 
+                             titulo_personalizado=f"Bienvenido {res[0]}", texto_contenido_de_valor="Demo")
+    return "Error", 404
 
 @app.route('/api/chat-nido', methods=['POST'])
 def chat_nido_api():
     d = request.json
-    if nutridor_brain:
-        return jsonify({"respuesta": nutridor_brain.responder_chat_nido(d.get('token'), d.get('mensaje'))})
+    nutridor = obtener_nutridor()
+    if nutridor:
+        return jsonify({"respuesta": nutridor.responder_chat_nido(d.get('token'), d.get('mensaje'))})
     return jsonify({"respuesta": "Conectando..."})
 
+def _evento_sse(datos, evento=None):
+    cabecera = f"event: {evento}\n" if evento else ""
+    return f"{cabecera}data: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+@app.route('/api/chat-nido/stream', methods=['POST'])
+def chat_nido_stream_api():
+    """Chat del Nido por SSE: cada evento 'data' trae un trozo de texto; 'fin' o 'error' cierran."""
+    d = request.json or {}
+
+    def eventos():
+        nutridor = obtener_nutridor()
+        if not nutridor:
+            yield _evento_sse({"t": "Conectando..."})
+            yield _evento_sse({}, "fin")
+            return
+        try:
+            for trozo in nutridor.responder_chat_nido_stream(d.get('token'), d.get('mensaje')):
+                yield _evento_sse({"t": trozo})
+            yield _evento_sse({}, "fin")
+        except ValueError as e:
+            yield _evento_sse({"error": str(e)}, "error")
+        except Exception as e:
+            app.logger.error(f"Error en chat-nido stream: {e}")
+            yield _evento_sse({"error": "Lo siento, estoy teniendo problemas de conexión. Intenta de nuevo."}, "error")
+
+    return Response(stream_with_context(eventos()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- OBSERVABILIDAD ---
+@app.route('/metrics')
+def metrics():
+    """
+    Métricas de todo el pipeline (todos los procesos) en formato de texto de Prometheus.
+    Incluyen gasto por campaña: sin METRICAS_TOKEN configurado el endpoint queda cerrado.
+    """
+    token = os.environ.get("METRICAS_TOKEN")
+    if not token:
+        return "Métricas desactivadas (configura METRICAS_TOKEN)", 404
+    if request.headers.get("Authorization") != f"Bearer {token}":
+        return "No autorizado", 401
+    return Response(exponer_metricas(), content_type=TIPO_METRICAS)
+
 # --- RUTAS DEBUG ---
 @app.route('/ver-pre-nido')
 def debug_pre(): return render_template('persuasor.html', prospecto_id="TEST", nombre_negocio="Demo", titulo_personalizado="Demo", mensaje_personalizado="Demo")
@@ -257,9 +265,10 @@ def debug_nido(): return render_template('nido_template.html', nombre_negocio="D
 
 @app.route('/chat', methods=['POST'])
 def chat_admin():
-    global dashboard_brain
-    if not dashboard_brain and create_chatbot: dashboard_brain = create_chatbot()
-    if dashboard_brain: return jsonify({"response": dashboard_brain.invoke({"question": request.json.get('message')})})
+    dashboard_brain = obtener_dashboard_brain()
+    # Cada visitante conversa con su propio historial (no uno global para todo el servidor)
+    if 'chat_id' not in session: session['chat_id'] = uuid.uuid4().hex
+    if dashboard_brain: return jsonify({"response": dashboard_brain.invoke({"question": request.json.get('message'), "session_id": session['chat_id']})})
     return jsonify({"response": "Mantenimiento"})
 
 if __name__ == '__main__':
@@ -0,0 +1,365 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from psycopg2.extras import Json
+from dotenv import load_dotenv
+import pool_conexiones
+from pool_conexiones import conexion
+from cola_trabajo import id_trabajador
+from cache_enriquecimiento import ahorro_historico
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+METRICAS_ACTIVAS = os.environ.get("METRICAS_ACTIVAS", "1") == "1"
+# Cada cuánto publica cada proceso (web, orquestador...) su foto en la BD compartida
+METRICAS_PUBLICAR_SEG = float(os.environ.get("METRICAS_PUBLICAR_SEG", "15"))
+# Fotos sin renovar en este tiempo son de procesos muertos y no se suman
+METRICAS_VIGENCIA_SEG = float(os.environ.get("METRICAS_VIGENCIA_SEG", "300"))
+# Los conteos de prospects / gasto se releen como mucho cada tanto (un scrape no castiga la BD)
+METRICAS_CACHE_BD_SEG = float(os.environ.get("METRICAS_CACHE_BD_SEG", "10"))
+# Nombre del proceso en las etiquetas (p.ej. 'web' u 'orquestador')
+METRICAS_ROL = os.environ.get("METRICAS_ROL") or os.environ.get("FLY_PROCESS_GROUP") or "proceso"
+
+# Cubetas (segundos) de los histogramas de latencia: de una web rápida a una corrida de Apify
+CUBETAS_SEG = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+TIPO_CONTENIDO = "text/plain; version=0.0.4; charset=utf-8"
+
+_AYUDA = {
+    "autoneura_prospectos": ("gauge", "Prospectos por estado."),
+    "autoneura_cola_pendientes": ("gauge", "Prospectos esperando a la etapa (sin reclamo vigente)."),
+    "autoneura_cola_en_proceso": ("gauge", "Prospectos reclamados por un trabajador de la etapa."),
+    "autoneura_gasto_usd_mes": ("gauge", "Gasto del mes en curso por campaña y trabajador (spend_ledger)."),
+    "autoneura_items_mes": ("gauge", "Ítems consumidos del mes en curso por campaña y trabajador."),
+    "autoneura_enriquecimiento_aciertos": ("gauge", "Consultas de Instagram resueltas por la caché global (histórico)."),
+    "autoneura_enriquecimiento_ahorro_usd": ("gauge", "Dólares de Apify evitados por la caché global (histórico)."),
+    "autoneura_prospectos_transiciones_total": ("counter", "Prospectos que entraron a cada estado."),
+    "autoneura_gemini_segundos": ("histogram", "Duración de las llamadas a Gemini (sin la espera en cola)."),
+    "autoneura_gemini_espera_segundos": ("histogram", "Espera por cuota antes de llamar a Gemini."),
+    "autoneura_apify_segundos": ("histogram", "Duración de las corridas de actores de Apify."),
+    "autoneura_web_segundos": ("histogram", "Duración de la descarga de webs de prospectos."),
+    "autoneura_pool_conexiones": ("gauge", "Conexiones del pool por proceso y estado."),
+    "autoneura_pool_espera_segundos_total": ("counter", "Tiempo total esperando conexión del pool."),
+    "autoneura_pool_timeouts_total": ("counter", "Peticiones de conexión que agotaron la espera."),
+}
+
+
+def _clave(nombre, etiquetas):
+    return nombre, tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+
+class RegistroMetricas:
+    """
+    Contadores e histogramas de un proceso. /metrics expone las fotos de todos los procesos
+    (web + orquestador + máquinas de fly.io) que publican en 'metrics_snapshots', una serie por proceso.
+    """
+
+    def __init__(self, cubetas=CUBETAS_SEG):
+        self.cubetas = tuple(cubetas)
+        self._iniciar_estado()
+
+    def _iniciar_estado(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._contadores = {}     # (nombre, etiquetas) -> valor
+        self._histogramas = {}    # (nombre, etiquetas) -> [conteo por cubeta..., +Inf, suma]
+
+    def _verificar_fork(self):
+        # Lo acumulado antes del fork es del padre: el hijo empieza de cero (si no, se contaría doble)
+        if os.getpid() != self._pid:
+            self._iniciar_estado()
+
+    def incrementar(self, nombre, cantidad=1, **etiquetas):
+        self._verificar_fork()
+        clave = _clave(nombre, etiquetas)
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + cantidad
+
+    def observar(self, nombre, segundos, **etiquetas):
+        self._verificar_fork()
+        clave = _clave(nombre, etiquetas)
+        with self._lock:
+            h = self._histogramas.get(clave)
+            if h is None:
+                h = self._histogramas[clave] = [0] * (len(self.cubetas) + 1) + [0.0]
+            h[bisect_left(self.cubetas, segundos)] += 1
+            h[-1] += segundos
+
+    def foto(self):
+        """Estado serializable a JSON (lo que se publica en la BD)."""
+        self._verificar_fork()
+        with self._lock:
+            return {
+                "cubetas": list(self.cubetas),
+                "contadores": [[n, dict(e), v] for (n, e), v in self._contadores.items()],
+                "histogramas": [[n, dict(e), list(h)] for (n, e), h in self._histogramas.items()],
+            }
+
+
+# --- REGISTRO Y PUBLICACIÓN DEL PROCESO ---
+
+_registro = RegistroMetricas()
+_publicador = None
+_publicador_lock = threading.Lock()
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+
+def asegurar_tabla():
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        with conexion() as conn, conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS metrics_snapshots (
+                    proceso TEXT PRIMARY KEY,
+                    rol TEXT NOT NULL,
+                    actualizado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    datos JSONB NOT NULL
+                );
+            """)
+            conn.commit()
+        _esquema_listo = True
+
+def _foto_con_pool():
+    """Foto del registro + el estado del pool de este proceso (si ya se creó)."""
+    foto = _registro.foto()
+    foto["pool"] = pool_conexiones._pool.metricas() if pool_conexiones._pool is not None else None
+    return foto
+
+def publicar():
+    """Escribe la foto de este proceso en metrics_snapshots (una fila por proceso)."""
+    asegurar_tabla()
+    proceso = id_trabajador(METRICAS_ROL)
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO metrics_snapshots (proceso, rol, actualizado_en, datos)
+            VALUES (%s, %s, NOW(), %s)
+            ON CONFLICT (proceso) DO UPDATE SET actualizado_en = NOW(), datos = EXCLUDED.datos
+        """, (proceso, METRICAS_ROL, Json(_foto_con_pool())))
+        # Limpieza de procesos que ya no existen (reinicios, deploys)
+        cur.execute("DELETE FROM metrics_snapshots WHERE actualizado_en < NOW() - INTERVAL '1 day'")
+        conn.commit()
+
+def _bucle_publicar():
+    while True:
+        time.sleep(METRICAS_PUBLICAR_SEG)
+        try:
+            publicar()
+        except Exception as e:
+            logging.warning(f"⚠️ No se pudieron publicar métricas: {e}")
+
+def _asegurar_publicador():
+    global _publicador
+    if _publicador is not None and _publicador.is_alive():
+        return
+    with _publicador_lock:
+        # Tras un fork el hilo del padre no existe en el hijo: is_alive() es False y se relanza
+        if _publicador is None or not _publicador.is_alive():
+            _publicador = threading.Thread(target=_bucle_publicar, name="metricas", daemon=True)
+            _publicador.start()
+
+def _publicar_al_salir():
+    if _publicador is not None:
+        try:
+            publicar()
+        except Exception:
+            pass
+
+atexit.register(_publicar_al_salir)
+
+
+# --- API PARA LOS TRABAJADORES ---
+
+def incrementar(nombre, cantidad=1, **etiquetas):
+    if not METRICAS_ACTIVAS or not cantidad:
+        return
+    _registro.incrementar(nombre, cantidad, **etiquetas)
+    _asegurar_publicador()
+
+def observar(nombre, segundos, **etiquetas):
+    if not METRICAS_ACTIVAS:
+        return
+    _registro.observar(nombre, segundos, **etiquetas)
+    _asegurar_publicador()
+
+@contextmanager
+def medir(nombre, **etiquetas):
+    """`with medir("autoneura_apify_segundos", actor=...):` observa la duración del bloque."""
+    inicio = time.monotonic()
+    try:
+        yield
+    finally:
+        observar(nombre, time.monotonic() - inicio, **etiquetas)
+
+def contar_transicion(hacia, cantidad=1):
+    """Prospectos que pasaron a `hacia` (cazado, espiado, analizado_exitoso, persuadido...)."""
+    incrementar("autoneura_prospectos_transiciones_total", cantidad, hacia=hacia)
+
+
+# --- CONSULTAS A LA BD (ESTADO DEL PIPELINE) ---
+
+_SQL_COLAS = """
+    SELECT etapa, libre, COUNT(*) FROM (
+        SELECT CASE
+                   WHEN status = 'cazado' THEN 'espia'
+                   WHEN status = 'espiado' THEN 'analista'
+                   WHEN status = 'analizado_exitoso' THEN 'persuasor'
+                   ELSE 'nutridor'
+               END AS etapa,
+               (claimed_by IS NULL OR claim_expires_at IS NULL OR claim_expires_at < NOW()) AS libre
+        FROM prospects
+        WHERE status IN ('cazado', 'espiado', 'analizado_exitoso', 'persuadido', 'en_nutricion_1', 'en_nutricion_2')
+    ) t
+    GROUP BY etapa, libre
+"""
+
+_cache_bd = {"vence": 0.0, "muestras": []}
+_cache_bd_lock = threading.Lock()
+
+def _muestras_bd():
+    """[(nombre, etiquetas, valor)] con lo que vive en la BD: estados, colas, gasto del mes y ahorro de la caché."""
+    muestras = []
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("SELECT COALESCE(status, 'sin_estado'), COUNT(*) FROM prospects GROUP BY 1")
+        muestras += [("autoneura_prospectos", {"status": s}, n) for s, n in cur.fetchall()]
+
+        # Un scrape no toca el esquema: las columnas de reclamo las crean los trabajadores al arrancar
+        cur.execute("""
+            SELECT EXISTS (SELECT 1 FROM information_schema.columns
+                           WHERE table_name = 'prospects' AND column_name = 'claim_expires_at')
+        """)
+        if cur.fetchone()[0]:
+            cur.execute(_SQL_COLAS)
+            for etapa, libre, n in cur.fetchall():
+                nombre = "autoneura_cola_pendientes" if libre else "autoneura_cola_en_proceso"
+                muestras.append((nombre, {"etapa": etapa}, n))
+
+        cur.execute("SELECT to_regclass('spend_ledger') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("""
+                SELECT campaign_id, trabajador, SUM(costo_usd), SUM(items_consumidos)
+                FROM spend_ledger
+                WHERE dia >= date_trunc('month', CURRENT_DATE)
+                GROUP BY campaign_id, trabajador
+            """)
+            for campana, trabajador, costo, items in cur.fetchall():
+                etiquetas = {"campana": campana, "trabajador": trabajador}
+                muestras.append(("autoneura_gasto_usd_mes", etiquetas, float(costo or 0)))
+                muestras.append(("autoneura_items_mes", etiquetas, int(items or 0)))
+
+        aciertos, dolares = ahorro_historico(cur)
+        muestras.append(("autoneura_enriquecimiento_aciertos", {}, aciertos))
+        muestras.append(("autoneura_enriquecimiento_ahorro_usd", {}, dolares))
+    return muestras
+
+def muestras_bd():
+    ahora = time.monotonic()
+    with _cache_bd_lock:
+        if _cache_bd["vence"] > ahora:
+            return _cache_bd["muestras"]
+    muestras = _muestras_bd()
+    with _cache_bd_lock:
+        _cache_bd.update(vence=ahora + METRICAS_CACHE_BD_SEG, muestras=muestras)
+    return muestras
+
+def _fotos_publicadas():
+    """{proceso: foto} de los procesos vivos (la de este proceso se toma en vivo, no de la BD)."""
+    asegurar_tabla()
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT proceso, datos FROM metrics_snapshots
+            WHERE actualizado_en > NOW() - make_interval(secs => %s)
+        """, (METRICAS_VIGENCIA_SEG,))
+        fotos = {p: (d if isinstance(d, dict) else json.loads(d)) for p, d in cur.fetchall()}
+    fotos[id_trabajador(METRICAS_ROL)] = _foto_con_pool()
+    return fotos
+
+
+# --- EXPOSICIÓN (FORMATO DE TEXTO DE PROMETHEUS) ---
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _linea(nombre, etiquetas, valor):
+    if etiquetas:
+        pares = ",".join(f'{k}="{_escapar(v)}"' for k, v in sorted(etiquetas.items()))
+        return f"{nombre}{{{pares}}} {valor}"
+    return f"{nombre} {valor}"
+
+def _formatear(valor):
+    if isinstance(valor, float) and valor.is_integer():
+        return str(int(valor))
+    return repr(valor) if isinstance(valor, float) else str(valor)
+
+def exponer():
+    """
+    Texto para /metrics: contadores e histogramas de cada proceso (etiqueta `proceso`) + estado
+    del pipeline en la BD. No se suman aquí: si un worker se reinicia, su foto vieja y la nueva
+    son series distintas y Prometheus ve el reinicio de cada una (sum without(proceso) en la consulta).
+    """
+    contadores, histogramas, gauges = {}, {}, []
+    errores = 0
+
+    try:
+        fotos = _fotos_publicadas()
+    except Exception as e:
+        logging.warning(f"⚠️ /metrics sin fotos compartidas ({e}). Solo este proceso.")
+        fotos, errores = {id_trabajador(METRICAS_ROL): _foto_con_pool()}, errores + 1
+
+    for proceso, foto in fotos.items():
+        for nombre, etiquetas, valor in foto.get("contadores", []):
+            clave = _clave(nombre, {**etiquetas, "proceso": proceso})
+            contadores[clave] = contadores.get(clave, 0) + valor
+        cubetas = tuple(foto.get("cubetas") or CUBETAS_SEG)
+        for nombre, etiquetas, valores in foto.get("histogramas", []):
+            clave = (_clave(nombre, {**etiquetas, "proceso": proceso}), cubetas)
+            acumulado = histogramas.setdefault(clave, [0] * len(valores[:-1]) + [0.0])
+            for i, v in enumerate(valores):
+                acumulado[i] += v
+        pool = foto.get("pool")
+        if pool:
+            for estado in ("en_uso", "libres", "maximo"):
+                gauges.append(("autoneura_pool_conexiones", {"proceso": proceso, "estado": estado}, pool.get(estado, 0)))
+            contadores[_clave("autoneura_pool_espera_segundos_total", {"proceso": proceso})] = round(pool.get("espera_total_seg", 0.0), 4)
+            contadores[_clave("autoneura_pool_timeouts_total", {"proceso": proceso})] = pool.get("timeouts", 0)
+
+    try:
+        gauges += muestras_bd()
+    except Exception as e:
+        logging.warning(f"⚠️ /metrics sin datos de la BD: {e}")
+        errores += 1
+
+    # Agrupamos por métrica para emitir HELP/TYPE una sola vez
+    por_nombre = {}
+    for nombre, etiquetas, valor in gauges:
+        por_nombre.setdefault(nombre, []).append(_linea(nombre, etiquetas, _formatear(valor)))
+    for (nombre, etiquetas), valor in contadores.items():
+        por_nombre.setdefault(nombre, []).append(_linea(nombre, dict(etiquetas), _formatear(valor)))
+    for ((nombre, etiquetas), cubetas), valores in histogramas.items():
+        etiquetas = dict(etiquetas)
+        lineas = por_nombre.setdefault(nombre, [])
+        acumulado = 0
+        for limite, n in zip(cubetas + ("+Inf",), valores[:-1]):
+            acumulado += n
+            lineas.append(_linea(f"{nombre}_bucket", {**etiquetas, "le": limite}, acumulado))
+        lineas.append(_linea(f"{nombre}_sum", etiquetas, _formatear(round(valores[-1], 6))))
+        lineas.append(_linea(f"{nombre}_count", etiquetas, acumulado))
+
+    salida = []
+    for nombre in sorted(por_nombre):
+        tipo, ayuda = _AYUDA.get(nombre, ("untyped", nombre))
+        salida += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} {tipo}"] + por_nombre[nombre]
+    salida += ["# HELP autoneura_metricas_errores Fuentes que fallaron al armar esta respuesta.",
+               "# TYPE autoneura_metricas_errores gauge",
+               f"autoneura_metricas_errores {errores}"]
+    return "\n".join(salida) + "\n"
@@ -0,0 +1,457 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from collections import deque
+from dotenv import load_dotenv
+from limitador_tasa import CubetaTokens
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+# genai.configure() es global del proceso: antes cada trabajador la llamaba con su variable y ganaba
+# la última (en el orquestador, GOOGLE_API_KEY). La pasarela la configura una vez con GOOGLE_API_KEY,
+# o GEMINI_API_KEY si es la única definida. El Analista suelto (python trabajador_analista.py) sigue
+# prefiriendo GEMINI_API_KEY mediante usar_clave().
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY")
+
+# Modelos en uso (todos los trabajadores piden por nombre a esta pasarela)
+MODELO_RAPIDO = 'models/gemini-2.0-flash'      # Analista y Orquestador (alto volumen)
+MODELO_PRO = 'models/gemini-pro-latest'        # Persuasor, Nutridor y chats
+
+# Cuota por modelo, compartida por TODOS los hilos del proceso (rpm, ráfaga, concurrencia).
+# Se puede sobreescribir con LLM_LIMITES='{"models/gemini-2.0-flash": {"rpm": 30}}'
+LIMITES_POR_DEFECTO = {
+    MODELO_RAPIDO: {"rpm": 15, "rafaga": 3, "concurrencia": 4},
+    MODELO_PRO: {"rpm": 12, "rafaga": 2, "concurrencia": 3},
+}
+LIMITE_GENERICO = {"rpm": 10, "rafaga": 2, "concurrencia": 2}
+
+# Reintentos ante 429 / 5xx con backoff exponencial y jitter completo
+LLM_REINTENTOS = int(os.environ.get("LLM_REINTENTOS", "4"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "2"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "60"))
+# Tras un 429 todo el modelo se frena este tiempo (no solo el hilo que lo recibió)
+LLM_PAUSA_429 = float(os.environ.get("LLM_PAUSA_429", "10"))
+# 1 = la cuota por minuto se comparte entre procesos/máquinas a través de Postgres
+LLM_LIMITE_GLOBAL = os.environ.get("LLM_LIMITE_GLOBAL", "0") == "1"
+
+# Carriles de prioridad: el chat con personas adelanta a los trabajos por lotes
+INTERACTIVO = "interactivo"
+LOTE = "lote"
+
+_CODIGOS_REINTENTABLES = (429, 500, 502, 503, 504)
+
+_errores_google = None
+
+def _excepciones_google():
+    """
+    (reintentables, de cuota) del SDK de Google, importadas al primer error y no al arrancar:
+    google.api_core arrastra gRPC/protobuf y alarga el arranque en frío de cada worker.
+    """
+    global _errores_google
+    if _errores_google is None:
+        try:
+            from google.api_core import exceptions as e
+            _errores_google = (
+                (e.ResourceExhausted, e.TooManyRequests, e.InternalServerError, e.BadGateway,
+                 e.ServiceUnavailable, e.GatewayTimeout, e.DeadlineExceeded),
+                (e.ResourceExhausted, e.TooManyRequests),
+            )
+        except ImportError:
+            _errores_google = ((), ())
+    return _errores_google
+
+class LLMNoDisponible(Exception):
+    """No hay API key configurada: la IA está apagada."""
+
+
+def _limites_configurados():
+    limites = {m: dict(v) for m, v in LIMITES_POR_DEFECTO.items()}
+    try:
+        for modelo, valores in json.loads(os.environ.get("LLM_LIMITES", "{}")).items():
+            limites.setdefault(modelo, dict(LIMITE_GENERICO)).update(valores)
+    except Exception as e:
+        logging.warning(f"⚠️ LLM_LIMITES inválido ({e}). Se usan los límites por defecto.")
+    return limites
+
+def _codigo_error(error):
+    codigo = getattr(error, "code", None)
+    if callable(codigo):
+        codigo = codigo()
+    codigo = getattr(codigo, "value", codigo)
+    if isinstance(codigo, tuple):
+        codigo = codigo[0]
+    return codigo if isinstance(codigo, int) else None
+
+def es_reintentable(error):
+    reintentables = _excepciones_google()[0]
+    if reintentables and isinstance(error, reintentables):
+        return True
+    codigo = _codigo_error(error)
+    if codigo in _CODIGOS_REINTENTABLES:
+        return True
+    texto = str(error)
+    return "429" in texto or "Resource has been exhausted" in texto or "503" in texto
+
+def es_cuota_agotada(error):
+    de_cuota = _excepciones_google()[1]
+    if de_cuota and isinstance(error, de_cuota):
+        return True
+    return _codigo_error(error) == 429 or "429" in str(error)
+
+
+# --- CUOTA COMPARTIDA ENTRE PROCESOS (OPCIONAL) ---
+
+_global_listo = False
+_global_lock = threading.Lock()
+
+def _asegurar_tabla_global():
+    global _global_listo
+    if _global_listo:
+        return
+    with _global_lock:
+        if _global_listo:
+            return
+        from pool_conexiones import conexion
+        with conexion() as conn, conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS llm_rate_limit (
+                    modelo TEXT PRIMARY KEY,
+                    tokens DOUBLE PRECISION NOT NULL,
+                    actualizado TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+                );
+            """)
+            conn.commit()
+        _global_listo = True
+
+def _consumir_global(modelo, tasa_por_segundo, capacidad):
+    """
+    Cubeta de tokens en Postgres: rellena y consume en un solo UPDATE atómico.
+    Devuelve 0 si se consiguió cuota, o los segundos estimados hasta el próximo token.
+    """
+    from pool_conexiones import conexion
+    _asegurar_tabla_global()
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO llm_rate_limit (modelo, tokens) VALUES (%s, %s)
+            ON CONFLICT (modelo) DO NOTHING
+        """, (modelo, capacidad))
+        cur.execute("""
+            WITH actual AS (
+                SELECT LEAST(%s, tokens + EXTRACT(EPOCH FROM clock_timestamp() - actualizado) * %s) AS disponibles
+                FROM llm_rate_limit WHERE modelo = %s
+                FOR UPDATE
+            )
+            UPDATE llm_rate_limit r
+            SET tokens = CASE WHEN a.disponibles >= 1 THEN a.disponibles - 1 ELSE a.disponibles END,
+                actualizado = clock_timestamp()
+            FROM actual a
+            WHERE r.modelo = %s
+            RETURNING a.disponibles
+        """, (capacidad, tasa_por_segundo, modelo, modelo))
+        disponibles = cur.fetchone()[0]
+        conn.commit()
+    if disponibles >= 1:
+        return 0.0
+    return (1 - disponibles) / tasa_por_segundo
+
+
+# --- CARRIL POR MODELO ---
+
+class CarrilModelo:
+    """
+    Puerta de entrada a un modelo: concurrencia máxima, cuota por minuto y prioridad.
+    Mientras haya peticiones interactivas esperando, las de lote no entran.
+    """
+
+    def __init__(self, modelo, rpm, rafaga, concurrencia):
+        self.modelo = modelo
+        self.cubeta = CubetaTokens.por_minuto(rpm, rafaga)
+        self.concurrencia = max(1, int(concurrencia))
+        self._cond = threading.Condition()
+        self._en_vuelo = 0
+        self._esperando = {INTERACTIVO: 0, LOTE: 0}
+        self._pausa_hasta = 0.0
+
+    def entrar(self, prioridad=LOTE, timeout=None):
+        """Espera turno. Devuelve los segundos esperados; TimeoutError si vence `timeout`."""
+        interactivo = prioridad == INTERACTIVO
+        inicio = time.monotonic()
+        with self._cond:
+            self._esperando[prioridad] += 1
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    espera = 1.0
+                    puede = self._en_vuelo < self.concurrencia and (interactivo or not self._esperando[INTERACTIVO])
+                    if ahora < self._pausa_hasta:
+                        espera = self._pausa_hasta - ahora
+                    elif puede:
+                        if LLM_LIMITE_GLOBAL or self.cubeta.intentar():
+                            self._en_vuelo += 1
+                            break
+                        espera = (1 - self.cubeta.disponibles()) / self.cubeta.tasa
+                    if timeout is not None and ahora - inicio + espera > timeout:
+                        raise TimeoutError(f"Sin turno en {self.modelo} tras {timeout:.0f}s")
+                    self._cond.wait(max(0.01, min(espera, 1.0)))
+            finally:
+                self._esperando[prioridad] -= 1
+                self._cond.notify_all()
+
+        # Cuota entre procesos: se pide fuera del candado local (es una ida a la BD)
+        if LLM_LIMITE_GLOBAL:
+            try:
+                while True:
+                    faltan = _consumir_global(self.modelo, self.cubeta.tasa, self.cubeta.capacidad)
+                    if not faltan:
+                        break
+                    if timeout is not None and time.monotonic() - inicio + faltan > timeout:
+                        raise TimeoutError(f"Sin cuota global en {self.modelo} tras {timeout:.0f}s")
+                    time.sleep(min(faltan, 5.0))
+            except TimeoutError:
+                self.salir()
+                raise
+            except Exception as e:
+                # Si la BD falla, el límite local sigue protegiendo a este proceso
+                logging.warning(f"⚠️ Cuota global LLM no disponible ({e}). Se usa la local.")
+                self.cubeta.adquirir()
+        return time.monotonic() - inicio
+
+    def salir(self):
+        with self._cond:
+            self._en_vuelo -= 1
+            self._cond.notify_all()
+
+    def pausar(self, segundos):
+        """Frena a todos los hilos del modelo (p.ej. tras un 429)."""
+        with self._cond:
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + segundos)
+            self._cond.notify_all()
+
+    def estado(self):
+        with self._cond:
+            return {
+                "en_vuelo": self._en_vuelo,
+                "esperando_interactivos": self._esperando[INTERACTIVO],
+                "esperando_lote": self._esperando[LOTE],
+                "pausado_seg": round(max(0.0, self._pausa_hasta - time.monotonic()), 1),
+            }
+
+
+# --- MÉTRICAS ---
+
+class MetricasLLM:
+    """Contadores y latencias por modelo (ventana de las últimas N llamadas para percentiles)."""
+
+    def __init__(self, ventana=500):
+        self._lock = threading.Lock()
+        self._ventana = ventana
+        self._por_modelo = {}
+
+    def _datos(self, modelo):
+        datos = self._por_modelo.get(modelo)
+        if datos is None:
+            datos = {
+                "llamadas": 0, "ok": 0, "errores": 0, "reintentos": 0, "cuota_429": 0,
+                "interactivas": 0, "lote": 0,
+                "latencias": deque(maxlen=self._ventana), "esperas": deque(maxlen=self._ventana),
+            }
+            self._por_modelo[modelo] = datos
+        return datos
+
+    def registrar(self, modelo, prioridad, ok, segundos, espera, reintentos, cuota_429):
+        with self._lock:
+            d = self._datos(modelo)
+            d["llamadas"] += 1
+            d["ok" if ok else "errores"] += 1
+            d["reintentos"] += reintentos
+            d["cuota_429"] += cuota_429
+            d["interactivas" if prioridad == INTERACTIVO else "lote"] += 1
+            d["latencias"].append(segundos)
+            d["esperas"].append(espera)
+
+    def foto(self):
+        def percentil(valores, p):
+            if not valores:
+                return 0.0
+            valores = sorted(valores)
+            return round(valores[min(len(valores) - 1, int(len(valores) * p))], 3)
+
+        with self._lock:
+            resultado = {}
+            for modelo, d in self._por_modelo.items():
+                resultado[modelo] = {
+                    **{k: v for k, v in d.items() if k not in ("latencias", "esperas")},
+                    "latencia_p50": percentil(d["latencias"], 0.5),
+                    "latencia_p95": percentil(d["latencias"], 0.95),
+                    "espera_p50": percentil(d["esperas"], 0.5),
+                    "espera_p95": percentil(d["esperas"], 0.95),
+                }
+            return resultado
+
+
+# --- PASARELA ---
+
+class PasarelaLLM:
+    """Punto único de salida hacia Gemini para todo el sistema."""
+
+    def __init__(self, limites=None, api_key=None):
+        self.api_key = api_key or GOOGLE_API_KEY
+        self._limites = limites or _limites_configurados()
+        self._carriles = {}
+        self._modelos = {}
+        self._lock = threading.Lock()
+        self._configurado = False
+        self._local = threading.local()
+        self.metricas = MetricasLLM()
+
+    def disponible(self):
+        return bool(self.api_key)
+
+    def carril(self, modelo):
+        with self._lock:
+            carril = self._carriles.get(modelo)
+            if carril is None:
+                l = self._limites.get(modelo, LIMITE_GENERICO)
+                carril = CarrilModelo(modelo, l.get("rpm", 10), l.get("rafaga", 2), l.get("concurrencia", 2))
+                self._carriles[modelo] = carril
+            return carril
+
+    def modelo(self, nombre):
+        """GenerativeModel cacheado por nombre (se crea y configura la API al primer uso)."""
+        if not self.disponible():
+            raise LLMNoDisponible("No hay GOOGLE_API_KEY / GEMINI_API_KEY")
+        with self._lock:
+            instancia = self._modelos.get(nombre)
+            if instancia is None:
+                import google.generativeai as genai
+                if not self._configurado:
+                    genai.configure(api_key=self.api_key)
+                    self._configurado = True
+                instancia = genai.GenerativeModel(nombre)
+                self._modelos[nombre] = instancia
+            return instancia
+
+    def ejecutar(self, modelo, funcion, prioridad=LOTE, timeout_cola=None, retener=False):
+        """
+        Ejecuta `funcion()` (una llamada a Gemini) respetando el carril del modelo.
+        Reintenta 429/5xx con backoff exponencial + jitter; el resto de errores se propagan.
+        Con retener=True el turno del carril sigue ocupado al volver: el llamador debe soltarlo
+        con self.carril(modelo).salir() (streams que se leen después).
+        """
+        carril = self.carril(modelo)
+        reintentos = cuota_429 = 0
+        espera_total = 0.0
+        while True:
+            espera_total += carril.entrar(prioridad, timeout_cola)
+            t0 = time.monotonic()
+            try:
+                resultado = funcion()
+            except Exception as e:
+                carril.salir()
+                if not es_reintentable(e) or reintentos >= LLM_REINTENTOS:
+                    self._registrar(modelo, prioridad, False, time.monotonic() - t0, espera_total, reintentos, cuota_429)
+                    raise
+                if es_cuota_agotada(e):
+                    cuota_429 += 1
+                    carril.pausar(LLM_PAUSA_429)
+                pausa = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** reintentos)))
+                reintentos += 1
+                logging.warning(f"🔁 {modelo}: {e.__class__.__name__} ({str(e)[:80]}). Reintento {reintentos}/{LLM_REINTENTOS} en {pausa:.1f}s")
+                time.sleep(pausa)
+                continue
+            if not retener:
+                carril.salir()
+            self._registrar(modelo, prioridad, True, time.monotonic() - t0, espera_total, reintentos, cuota_429)
+            return resultado
+
+    def _registrar(self, modelo, prioridad, ok, segundos, espera, reintentos, cuota_429):
+        self.metricas.registrar(modelo, prioridad, ok, segundos, espera, reintentos, cuota_429)
+        from metricas import observar
+        observar("autoneura_gemini_segundos", segundos, modelo=modelo, resultado="ok" if ok else "error")
+        observar("autoneura_gemini_espera_segundos", espera, modelo=modelo, prioridad=prioridad)
+        self._local.ultima = {"espera": espera, "total": segundos + espera, "reintentos": reintentos}
+
+    def generar(self, prompt, modelo=MODELO_RAPIDO, prioridad=LOTE, timeout_cola=None, **opciones):
+        """generate_content pasando por la pasarela. Devuelve la respuesta de Gemini."""
+        instancia = self.modelo(modelo)
+        return self.ejecutar(modelo, lambda: instancia.generate_content(prompt, **opciones), prioridad, timeout_cola)
+
+    def generar_stream(self, prompt, modelo=MODELO_PRO, prioridad=INTERACTIVO, timeout_cola=None, **opciones):
+        """
+        Igual que generar() pero va entregando el texto a medida que Gemini lo produce.
+        La cuota y los reintentos aplican al arranque de la respuesta (antes del primer trozo);
+        el turno de concurrencia se ocupa hasta leer el último trozo (o hasta que se cierre el stream).
+        """
+        instancia = self.modelo(modelo)
+        respuesta = self.ejecutar(modelo, lambda: instancia.generate_content(prompt, stream=True, **opciones),
+                                  prioridad, timeout_cola, retener=True)
+        try:
+            for trozo in respuesta:
+                try:
+                    texto = trozo.text
+                except Exception:
+                    texto = ""   # trozos sin texto (p.ej. solo metadatos de seguridad)
+                if texto:
+                    yield texto
+        finally:
+            self.carril(modelo).salir()
+
+    def ultima_llamada(self):
+        """Espera en cola, duración total y reintentos de la última llamada de ESTE hilo."""
+        return getattr(self._local, "ultima", None) or {"espera": 0.0, "total": 0.0, "reintentos": 0}
+
+    def estado(self):
+        with self._lock:
+            carriles = dict(self._carriles)
+        foto = self.metricas.foto()
+        for modelo, carril in carriles.items():
+            foto.setdefault(modelo, {}).update(carril.estado())
+        return foto
+
+
+# --- PASARELA COMPARTIDA DEL PROCESO ---
+
+_pasarela = None
+_pasarela_lock = threading.Lock()
+
+def obtener_pasarela():
+    global _pasarela
+    if _pasarela is None:
+        with _pasarela_lock:
+            if _pasarela is None:
+                _pasarela = PasarelaLLM()
+    return _pasarela
+
+def usar_clave(api_key):
+    """
+    Fija la API key de este proceso. Solo tiene efecto antes del primer modelo creado
+    (genai.configure es global): pensado para el arranque de un trabajador suelto.
+    """
+    pasarela = obtener_pasarela()
+    with pasarela._lock:
+        if pasarela._configurado:
+            logging.warning("⚠️ La pasarela LLM ya está configurada: se mantiene la API key actual.")
+            return
+        pasarela.api_key = api_key or pasarela.api_key
+
+def llm_disponible():
+    return obtener_pasarela().disponible()
+
+def generar(prompt, modelo=MODELO_RAPIDO, prioridad=LOTE, timeout_cola=None, **opciones):
+    return obtener_pasarela().generar(prompt, modelo, prioridad, timeout_cola, **opciones)
+
+def generar_stream(prompt, modelo=MODELO_PRO, prioridad=INTERACTIVO, timeout_cola=None, **opciones):
+    return obtener_pasarela().generar_stream(prompt, modelo, prioridad, timeout_cola, **opciones)
+
+def ejecutar(modelo, funcion, prioridad=LOTE, timeout_cola=None):
+    return obtener_pasarela().ejecutar(modelo, funcion, prioridad, timeout_cola)
+
+def obtener_modelo(nombre):
+    return obtener_pasarela().modelo(nombre)
+
+def metricas_llm():
+    return obtener_pasarela().estado()
@@ -0,0 +1,67 @@
+import os
+import re
+import sys
+import subprocess
+
+# Informe de tiempos de importación (python -X importtime) de lo que un worker carga al arrancar.
+# Uso: python perfil_arranque.py [modulo] [top]     p.ej.  python perfil_arranque.py main 25
+
+_LINEA = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(.+)$")
+
+
+def perfilar(modulo="main"):
+    """
+    Importa `modulo` en un proceso limpio y devuelve [(modulo, propio_us, acumulado_us, nivel)].
+    Se descarta lo que el intérprete ya carga solo al arrancar (site, codecs...).
+    """
+    base = {f[0] for f in _importtime("pass")[0] if f[3] == 0}
+    filas, proceso = _importtime(f"import {modulo}")
+    # -X importtime escribe los hijos antes que su padre: cada módulo de primer nivel cierra su subárbol
+    propias, subarbol = [], []
+    for fila in filas:
+        subarbol.append(fila)
+        if fila[3] == 0:
+            if fila[0] not in base:
+                propias.extend(subarbol)
+            subarbol = []
+    filas = propias
+    if proceso.returncode != 0:
+        error = proceso.stderr.strip().splitlines()[-1:] or ["(sin salida)"]
+        print(f"⚠️ 'import {modulo}' falló: {error[0]}")
+    return filas
+
+
+def _importtime(codigo):
+    proceso = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", codigo],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    filas = []
+    for linea in proceso.stderr.splitlines():
+        m = _LINEA.match(linea)
+        if m:
+            propio, acumulado, sangria, nombre = m.groups()
+            filas.append((nombre.strip(), int(propio), int(acumulado), (len(sangria) - 1) // 2))
+    return filas, proceso
+
+
+def informe(modulo="main", top=20):
+    filas = perfilar(modulo)
+    if not filas:
+        print("No hay datos de importación.")
+        return
+    # El total es lo acumulado por los módulos de primer nivel (importados directamente)
+    total_us = sum(acumulado for _, _, acumulado, nivel in filas if nivel == 0)
+    print(f"\n⏱️  Importar '{modulo}': {total_us / 1000:.1f} ms en {len(filas)} módulos\n")
+    print(f"{'acumulado ms':>13} {'propio ms':>10}  módulo")
+    for nombre, propio, acumulado, nivel in sorted(filas, key=lambda f: f[2], reverse=True)[:top]:
+        print(f"{acumulado / 1000:>13.1f} {propio / 1000:>10.1f}  {'  ' * nivel}{nombre}")
+
+    pesados = [n for n in ("google.generativeai", "google.api_core", "grpc", "apify_client", "bs4")
+               if any(f[0] == n for f in filas)]
+    if pesados:
+        print(f"\n⚠️ SDK pesados cargados al arrancar: {', '.join(pesados)}")
+
+
+if __name__ == "__main__":
+    informe(sys.argv[1] if len(sys.argv) > 1 else "main", int(sys.argv[2]) if len(sys.argv) > 2 else 20)
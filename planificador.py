@@ -0,0 +1,89 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- CONFIGURACIÓN ---
+# Hilos fijos para Cazador/Espía (cada uno suele esperar a Apify varios minutos)
+PLANIFICADOR_MAX_HILOS = int(os.environ.get("ORQUESTADOR_MAX_HILOS", "4"))
+# Trabajos que pueden esperar turno; por encima se rechazan hasta el próximo ciclo
+PLANIFICADOR_MAX_EN_COLA = int(os.environ.get("ORQUESTADOR_MAX_EN_COLA", "50"))
+
+
+class PlanificadorTrabajos:
+    """
+    Ejecutor de tamaño fijo con 'single-flight' por clave (p.ej. ('cazador', campaña)):
+    mientras una clave está en cola o corriendo, no se vuelve a lanzar.
+    Así un Apify lento no apila hilos ni duplica gasto entre ciclos.
+    """
+
+    def __init__(self, max_hilos=PLANIFICADOR_MAX_HILOS, max_en_cola=PLANIFICADOR_MAX_EN_COLA):
+        self.max_hilos = max(1, max_hilos)
+        self.max_en_cola = max(0, max_en_cola)
+        self._ejecutor = ThreadPoolExecutor(max_workers=self.max_hilos, thread_name_prefix="planificador")
+        self._lock = threading.Lock()
+        self._trabajos = {}   # clave -> {"estado": "en_cola" | "corriendo", "encolado": ts, "inicio": ts}
+        self._stats = {
+            "enviados": 0,
+            "omitidos_en_vuelo": 0,
+            "rechazados_cola_llena": 0,
+            "completados": 0,
+            "fallidos": 0,
+        }
+
+    def en_vuelo(self, clave):
+        with self._lock:
+            return clave in self._trabajos
+
+    def enviar(self, clave, funcion, *args, **kwargs):
+        """Encola el trabajo salvo que esa clave ya esté en vuelo o la cola esté llena. Devuelve True si se encoló."""
+        with self._lock:
+            if clave in self._trabajos:
+                self._stats["omitidos_en_vuelo"] += 1
+                return False
+            en_cola = sum(1 for t in self._trabajos.values() if t["estado"] == "en_cola")
+            corriendo = len(self._trabajos) - en_cola
+            if corriendo >= self.max_hilos and en_cola >= self.max_en_cola:
+                self._stats["rechazados_cola_llena"] += 1
+                logging.warning(f"🚦 Cola del planificador llena ({en_cola}). Se descarta {clave} hasta el próximo ciclo.")
+                return False
+            self._trabajos[clave] = {"estado": "en_cola", "encolado": time.time(), "inicio": None}
+            self._stats["enviados"] += 1
+
+        self._ejecutor.submit(self._ejecutar, clave, funcion, args, kwargs)
+        return True
+
+    def _ejecutar(self, clave, funcion, args, kwargs):
+        with self._lock:
+            self._trabajos[clave]["estado"] = "corriendo"
+            self._trabajos[clave]["inicio"] = time.time()
+        exito = False
+        try:
+            # Un trabajo falla si lanza una excepción o devuelve False explícitamente
+            exito = funcion(*args, **kwargs) is not False
+        except Exception as e:
+            logging.error(f"Error en trabajo {clave}: {e}")
+        finally:
+            with self._lock:
+                self._trabajos.pop(clave, None)
+                self._stats["completados" if exito else "fallidos"] += 1
+
+    def estado(self):
+        """Foto de lo que corre y lo que espera (con antigüedad en segundos)."""
+        ahora = time.time()
+        with self._lock:
+            corriendo = [(clave, round(ahora - t["inicio"], 1)) for clave, t in self._trabajos.items() if t["estado"] == "corriendo"]
+            en_cola = [(clave, round(ahora - t["encolado"], 1)) for clave, t in self._trabajos.items() if t["estado"] == "en_cola"]
+            stats = dict(self._stats)
+        return {"corriendo": corriendo, "en_cola": en_cola, "max_hilos": self.max_hilos, **stats}
+
+    def resumen(self):
+        e = self.estado()
+        corriendo = ", ".join(f"{c[0]}:{c[1]}({s:.0f}s)" if isinstance(c, tuple) else f"{c}({s:.0f}s)" for c, s in e["corriendo"]) or "-"
+        return (f"corriendo {len(e['corriendo'])}/{e['max_hilos']} [{corriendo}] | en cola {len(e['en_cola'])} | "
+                f"omitidos por single-flight {e['omitidos_en_vuelo']} | rechazados {e['rechazados_cola_llena']} | "
+                f"ok {e['completados']} | fallidos {e['fallidos']}")
+
+    def apagar(self, esperar=True):
+        self._ejecutor.shutdown(wait=esperar)
@@ -0,0 +1,244 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+# --- CONFIGURACIÓN ---
+load_dotenv()
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# Tamaño del pool POR PROCESO (gunicorn worker, orquestador, etc.)
+POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+# Segundos máximos esperando una conexión libre antes de rendirse
+POOL_TIMEOUT_ADQUIRIR = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+# Reciclamos conexiones viejas (Supabase/pgbouncer cortan las muy largas)
+POOL_VIDA_MAXIMA = float(os.environ.get("DB_POOL_VIDA_MAXIMA", "1800"))
+# Si una conexión estuvo inactiva más de esto, hacemos 'SELECT 1' antes de entregarla
+POOL_PING_INACTIVA = float(os.environ.get("DB_POOL_PING_SEG", "30"))
+
+
+class PoolAgotadoError(Exception):
+    """No se consiguió una conexión libre dentro del tiempo de espera."""
+
+
+class PoolConexiones:
+    """
+    Pool de conexiones PostgreSQL seguro para hilos.
+    Verifica la salud de cada conexión antes de entregarla, recicla las viejas
+    y lleva métricas de espera para dimensionar POOL_MAX.
+    """
+
+    def __init__(self, dsn=None, minimo=POOL_MIN, maximo=POOL_MAX, timeout=POOL_TIMEOUT_ADQUIRIR,
+                 vida_maxima=POOL_VIDA_MAXIMA, ping_inactiva=POOL_PING_INACTIVA, connection_factory=None):
+        self.dsn = dsn or DATABASE_URL
+        self.minimo = max(0, min(minimo, maximo))
+        self.maximo = max(1, maximo)
+        self.timeout = timeout
+        self.vida_maxima = vida_maxima
+        self.ping_inactiva = ping_inactiva
+        self.connection_factory = connection_factory
+
+        self._lock = threading.Lock()
+        self._heredadas = []
+        self._reiniciar_estado()
+
+    def _reiniciar_estado(self):
+        self._pid = os.getpid()
+        self._cupos = threading.BoundedSemaphore(self.maximo)
+        self._libres = []      # LIFO de [conn, creada, ultimo_uso]
+        self._en_uso = {}      # id(conn) -> [conn, creada, ultimo_uso]
+        self._precalentado = False
+        self._stats = {
+            "adquisiciones": 0,
+            "timeouts": 0,
+            "creadas": 0,
+            "recicladas": 0,
+            "descartadas": 0,
+            "espera_total_seg": 0.0,
+            "espera_max_seg": 0.0,
+        }
+
+    # --- CICLO DE VIDA DE CADA CONEXIÓN ---
+
+    def _abrir(self):
+        if self.connection_factory:
+            conn = psycopg2.connect(self.dsn, connection_factory=self.connection_factory)
+        else:
+            conn = psycopg2.connect(self.dsn)
+        ahora = time.monotonic()
+        with self._lock:
+            self._stats["creadas"] += 1
+        return [conn, ahora, ahora]
+
+    def _cerrar(self, entrada):
+        try:
+            entrada[0].close()
+        except Exception:
+            pass
+
+    def _esta_sana(self, entrada):
+        conn, creada, ultimo_uso = entrada
+        ahora = time.monotonic()
+        if conn.closed:
+            return False
+        if self.vida_maxima and ahora - creada > self.vida_maxima:
+            with self._lock:
+                self._stats["recicladas"] += 1
+            return False
+        if ahora - ultimo_uso > self.ping_inactiva:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    def _verificar_fork(self):
+        # Tras un fork (gunicorn --preload) las conexiones del padre NO se pueden compartir.
+        # No las cerramos (eso cortaría el socket del padre): solo las olvidamos.
+        if os.getpid() != self._pid:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    self._heredadas = self._libres + list(self._en_uso.values())
+                    self._reiniciar_estado()
+
+    def _precalentar(self):
+        with self._lock:
+            if self._precalentado:
+                return
+            self._precalentado = True
+        for _ in range(self.minimo):
+            try:
+                entrada = self._abrir()
+            except Exception as e:
+                logging.warning(f"⚠️ Pool: no se pudo precalentar conexión: {e}")
+                break
+            with self._lock:
+                self._libres.append(entrada)
+
+    # --- API PÚBLICA ---
+
+    def adquirir(self):
+        """Entrega una conexión sana o lanza PoolAgotadoError si no hay cupo a tiempo."""
+        self._verificar_fork()
+        self._precalentar()
+
+        inicio = time.monotonic()
+        if not self._cupos.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolAgotadoError(f"Sin conexiones libres tras {self.timeout}s (máx {self.maximo}).")
+
+        espera = time.monotonic() - inicio
+        try:
+            while True:
+                with self._lock:
+                    entrada = self._libres.pop() if self._libres else None
+                if entrada is None:
+                    entrada = self._abrir()
+                    break
+                if self._esta_sana(entrada):
+                    break
+                self._cerrar(entrada)
+        except Exception:
+            self._cupos.release()
+            raise
+
+        with self._lock:
+            self._en_uso[id(entrada[0])] = entrada
+            self._stats["adquisiciones"] += 1
+            self._stats["espera_total_seg"] += espera
+            self._stats["espera_max_seg"] = max(self._stats["espera_max_seg"], espera)
+        return entrada[0]
+
+    def liberar(self, conn, descartar=False):
+        """Devuelve la conexión al pool. Lo no confirmado se descarta (igual que conn.close())."""
+        with self._lock:
+            entrada = self._en_uso.pop(id(conn), None)
+        if entrada is None:
+            # Conexión de otro proceso (fork) o ya liberada: nada que devolver.
+            return
+
+        try:
+            if descartar or conn.closed:
+                with self._lock:
+                    self._stats["descartadas"] += 1
+                self._cerrar(entrada)
+                return
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            entrada[2] = time.monotonic()
+            with self._lock:
+                self._libres.append(entrada)
+        except Exception:
+            self._cerrar(entrada)
+        finally:
+            self._cupos.release()
+
+    @contextmanager
+    def conexion(self):
+        """
+        Uso:
+            with pool.conexion() as conn:
+                cur = conn.cursor()
+                ...
+                conn.commit()
+        La conexión SIEMPRE vuelve al pool, incluso si hay excepción.
+        """
+        conn = self.adquirir()
+        descartar = False
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                descartar = True
+            raise
+        finally:
+            self.liberar(conn, descartar=descartar)
+
+    def metricas(self):
+        with self._lock:
+            datos = dict(self._stats)
+            datos["en_uso"] = len(self._en_uso)
+            datos["libres"] = len(self._libres)
+        datos["maximo"] = self.maximo
+        datos["minimo"] = self.minimo
+        datos["espera_media_seg"] = (datos["espera_total_seg"] / datos["adquisiciones"]) if datos["adquisiciones"] else 0.0
+        return datos
+
+    def cerrar_todo(self):
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for entrada in libres:
+            self._cerrar(entrada)
+
+
+# --- POOL COMPARTIDO DEL PROCESO ---
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def obtener_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PoolConexiones()
+                logging.info(f"🔌 Pool de conexiones listo (min={_pool.minimo}, max={_pool.maximo}).")
+    return _pool
+
+def conexion():
+    """Atajo: `with conexion() as conn:` usando el pool del proceso."""
+    return obtener_pool().conexion()
+
+def metricas_pool():
+    return obtener_pool().metricas()
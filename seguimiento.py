@@ -1,12 +1,239 @@
 import os
-import requests
+import json
+import time
+import queue
+import threading
+from itertools import groupby
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, text
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
+from entrega_messenger import EntregaMessenger
+# SQLAlchemy y LangChain se importan donde se usan: PipelineSeguimiento (y sus pruebas) no los necesitan
 # --- YA NO IMPORTAMOS TAVILY ---
 
+# Mensajes del historial que se le pasan a la IA por sesión
+MENSAJES_HISTORIAL = int(os.environ.get("SEGUIMIENTO_MENSAJES_HISTORIAL", "6"))
+# Horas sin mensajes para considerar inactiva una conversación
+HORAS_INACTIVIDAD = float(os.environ.get("SEGUIMIENTO_HORAS_INACTIVIDAD", "24"))
+# Filas que se traen por viaje del cursor del servidor (no se carga todo en memoria)
+FILAS_POR_LOTE = int(os.environ.get("SEGUIMIENTO_FILAS_POR_LOTE", "2000"))
+# Etapas del envío: mensajes que redacta la IA a la vez y envíos simultáneos a Graph
+HILOS_IA = int(os.environ.get("SEGUIMIENTO_HILOS_IA", "4"))
+HILOS_ENVIO = int(os.environ.get("SEGUIMIENTO_HILOS_ENVIO", "8"))
+# Trabajo en espera entre etapas (si se llena, la etapa anterior espera: memoria acotada)
+TAMANO_COLA = int(os.environ.get("SEGUIMIENTO_TAMANO_COLA", "50"))
+# follow_up_log se escribe por lotes: N sesiones o cada X segundos, lo que llegue antes
+LOTE_LOG = int(os.environ.get("SEGUIMIENTO_LOTE_LOG", "50"))
+FLUSH_LOG_SEG = float(os.environ.get("SEGUIMIENTO_FLUSH_LOG_SEG", "2"))
+
+# Sesiones inactivas sin seguimiento y sus últimos N mensajes, en una sola pasada:
+# anti-join contra follow_up_log + ROW_NUMBER() por sesión (nada de NOT IN ni una consulta por sesión).
+# Sale ordenado por sesión y del más viejo al más nuevo, listo para agrupar mientras se lee.
+CONSULTA_INACTIVAS = """
+    WITH inactivas AS (
+        SELECT m.session_id
+        FROM message_store m
+        WHERE NOT EXISTS (SELECT 1 FROM follow_up_log f WHERE f.session_id = m.session_id)
+        GROUP BY m.session_id
+        HAVING MAX(m.created_at) <= NOW() - make_interval(secs => :segundos)
+    )
+    SELECT session_id, message
+    FROM (
+        SELECT m.session_id, m.id, m.message,
+               ROW_NUMBER() OVER (PARTITION BY m.session_id ORDER BY m.id DESC) AS n
+        FROM message_store m
+        JOIN inactivas i ON i.session_id = m.session_id
+    ) t
+    WHERE n <= :limite
+    ORDER BY session_id, id
+"""
+
+
+# Índices de message_store que sostienen la consulta de inactivas
+INDICES_MESSAGE_STORE = {
+    # (session_id, created_at): MAX(created_at) por sesión sin leer la tabla (index-only scan)
+    "idx_message_store_sesion_fecha": "(session_id, created_at)",
+    # (session_id, id): la ventana ROW_NUMBER() recorre cada sesión ya ordenada
+    "idx_message_store_sesion_id": "(session_id, id)",
+}
+
+def asegurar_esquema(engine):
+    """
+    Tabla de log e índices que sostienen la consulta de inactivas (solo si no existen).
+    message_store la escribe el chat en vivo: los índices se crean CONCURRENTLY (sin bloquear
+    escrituras), lo que exige autocommit. Un intento previo interrumpido deja el índice
+    inválido; se borra y se vuelve a construir.
+    """
+    from sqlalchemy import text
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("""
+            CREATE TABLE IF NOT EXISTS follow_up_log (
+                session_id VARCHAR(255) PRIMARY KEY,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+        """))
+        invalidos = connection.execute(text("""
+            SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE NOT i.indisvalid AND c.relname = ANY(:nombres)
+        """), {"nombres": list(INDICES_MESSAGE_STORE)}).scalars().all()
+        for nombre in invalidos:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {nombre};"))
+        for nombre, columnas in INDICES_MESSAGE_STORE.items():
+            connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {nombre} ON message_store {columnas};"))
+
+def linea_historial(mensaje):
+    """Un mensaje de message_store ('type' + 'data.content') como línea de conversación."""
+    if isinstance(mensaje, str):
+        mensaje = json.loads(mensaje)
+    return f"{mensaje['type']}: {mensaje['data']['content']}"
+
+def sesiones_inactivas(connection):
+    """Genera (session_id, historial) con un cursor del servidor, sin cargar el resultado entero."""
+    from sqlalchemy import text
+    resultado = connection.execution_options(stream_results=True, yield_per=FILAS_POR_LOTE).execute(
+        text(CONSULTA_INACTIVAS), {"segundos": HORAS_INACTIVIDAD * 3600, "limite": MENSAJES_HISTORIAL}
+    )
+    for session_id, filas in groupby(resultado, key=lambda fila: fila[0]):
+        yield session_id, "\n".join(linea_historial(fila[1]) for fila in filas)
+
+def texto_generado(resultado):
+    """Texto del mensaje sea cual sea la forma que devuelve la cadena (dict, AIMessage o str)."""
+    if isinstance(resultado, dict):
+        resultado = resultado.get("text", "")
+    return str(getattr(resultado, "content", resultado) or "").strip()
+
+
+class PipelineSeguimiento:
+    """
+    Redacción y envío como etapas separadas con concurrencia acotada:
+    sesiones -> [HILOS_IA redactan] -> [HILOS_ENVIO envían] -> [1 hilo escribe follow_up_log por lotes].
+    `generar(historial)` devuelve el texto, `entrega` es un EntregaMessenger y
+    `guardar_lote(session_ids)` registra los enviados (una transacción por lote).
+    """
+
+    def __init__(self, generar, entrega, guardar_lote, hilos_ia=HILOS_IA, hilos_envio=HILOS_ENVIO,
+                 tamano_cola=TAMANO_COLA, lote_log=LOTE_LOG, flush_log_seg=FLUSH_LOG_SEG):
+        self.generar = generar
+        self.entrega = entrega
+        self.guardar_lote = guardar_lote
+        self.hilos_ia = max(1, hilos_ia)
+        self.hilos_envio = max(1, hilos_envio)
+        self.lote_log = max(1, lote_log)
+        self.flush_log_seg = flush_log_seg
+        self._por_redactar = queue.Queue(maxsize=max(1, tamano_cola))
+        self._por_enviar = queue.Queue(maxsize=max(1, tamano_cola))
+        self._por_registrar = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"leidas": 0, "redactados": 0, "errores_ia": 0, "enviados": 0, "fallidos_envio": 0,
+                       "registrados": 0, "errores_log": 0}
+
+    def _contar(self, clave, cantidad=1):
+        with self._lock:
+            self._stats[clave] += cantidad
+
+    # --- ETAPAS ---
+
+    def _redactor(self):
+        while True:
+            item = self._por_redactar.get()
+            if item is None:
+                return
+            session_id, historial = item
+            try:
+                texto = texto_generado(self.generar(historial))
+            except Exception as e:
+                print(f"!!! ERROR redactando para {session_id}: {e}")
+                self._contar("errores_ia")
+                continue
+            if not texto:
+                self._contar("errores_ia")
+                continue
+            self._contar("redactados")
+            self._por_enviar.put((session_id, texto))
+
+    def _emisor(self):
+        while True:
+            item = self._por_enviar.get()
+            if item is None:
+                return
+            session_id, texto = item
+            try:
+                enviado = self.entrega.enviar(session_id, texto)
+            except Exception as e:
+                # Un hilo muerto dejaría a los redactores bloqueados en la cola llena
+                print(f"!!! ERROR enviando a {session_id}: {e}")
+                enviado = False
+            if enviado:
+                self._contar("enviados")
+                self._por_registrar.put(session_id)
+            else:
+                self._contar("fallidos_envio")
+
+    def _registrador(self):
+        pendientes, ultimo = [], time.monotonic()
+        terminado = False
+        while not terminado:
+            try:
+                session_id = self._por_registrar.get(timeout=self.flush_log_seg)
+                if session_id is None:
+                    terminado = True
+                else:
+                    pendientes.append(session_id)
+            except queue.Empty:
+                pass
+            vencido = time.monotonic() - ultimo >= self.flush_log_seg
+            if pendientes and (terminado or vencido or len(pendientes) >= self.lote_log):
+                try:
+                    self.guardar_lote(pendientes)
+                    self._contar("registrados", len(pendientes))
+                    pendientes = []
+                except Exception as e:
+                    # Se reintenta en el siguiente volcado; si no, el próximo ciclo los volvería a contactar
+                    print(f"!!! ERROR registrando {len(pendientes)} seguimientos: {e}")
+                    self._contar("errores_log")
+                    if terminado:
+                        return
+                ultimo = time.monotonic()
+
+    @staticmethod
+    def _arrancar(objetivo, cantidad, nombre):
+        hilos = [threading.Thread(target=objetivo, name=f"{nombre}-{i}", daemon=True) for i in range(cantidad)]
+        for h in hilos:
+            h.start()
+        return hilos
+
+    def ejecutar(self, sesiones):
+        """Procesa el iterable de (session_id, historial) y devuelve las métricas de la ronda."""
+        inicio = time.monotonic()
+        redactores = self._arrancar(self._redactor, self.hilos_ia, "seguimiento-ia")
+        emisores = self._arrancar(self._emisor, self.hilos_envio, "seguimiento-envio")
+        registrador = self._arrancar(self._registrador, 1, "seguimiento-log")
+        try:
+            for item in sesiones:
+                self._contar("leidas")
+                self._por_redactar.put(item)
+        finally:
+            # Cierre ordenado etapa por etapa: lo que ya entró termina de procesarse
+            for _ in redactores:
+                self._por_redactar.put(None)
+            for h in redactores:
+                h.join()
+            for _ in emisores:
+                self._por_enviar.put(None)
+            for h in emisores:
+                h.join()
+            self._por_registrar.put(None)
+            for h in registrador:
+                h.join()
+
+        return self.metricas(time.monotonic() - inicio)
+
+    def metricas(self, duracion=None):
+        with self._lock:
+            datos = dict(self._stats)
+        if duracion is not None:
+            datos["duracion_seg"] = round(duracion, 2)
+            datos["mensajes_por_seg"] = round(datos["enviados"] / duracion, 2) if duracion > 0 else 0.0
+        return datos
+
 def run_follow_up():
     print("--- INICIANDO SCRIPT DE SEGUIMIENTO PROACTIVO ---")
 
@@ -17,6 +244,11 @@ def run_follow_up():
         print("!!! ERROR CRÍTICO: Faltan variables de entorno. Abortando seguimiento. !!!")
         return
 
+    from sqlalchemy import create_engine, text
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from langchain.prompts import PromptTemplate
+    from langchain.chains import LLMChain
+
     # Usamos el modelo robusto de Google
     llm = ChatGoogleGenerativeAI(model="gemini-1.5-pro-latest", temperature=0.7, api_version="v1")
     
@@ -31,61 +263,43 @@ def run_follow_up():
     IMPORTANTE: Escribe en el mismo idioma de la conversación.
     Escribe solo el mensaje de seguimiento:""")
 
+    # Una sola cadena para toda la ronda (antes se construía una por sesión)
+    follow_up_chain = LLMChain(llm=llm, prompt=follow_up_prompt)
+    entrega = EntregaMessenger(PAGE_ACCESS_TOKEN, conexiones=HILOS_ENVIO)
+
     engine = create_engine(DATABASE_URL)
-    with engine.connect() as connection:
+    asegurar_esquema(engine)
+    # Dos conexiones: la de lectura mantiene abierto el cursor del servidor mientras
+    # la de escritura (solo la usa el hilo registrador) confirma cada lote de envíos.
+    with engine.connect() as connection, engine.connect() as escritura:
+
+        def guardar_lote(session_ids):
+            try:
+                log_query = text("INSERT INTO follow_up_log (session_id) VALUES (:sid) ON CONFLICT (session_id) DO NOTHING;")
+                escritura.execute(log_query, [{"sid": sid} for sid in session_ids])
+                escritura.commit()
+            except Exception:
+                escritura.rollback()
+                raise
+
+        pipeline = PipelineSeguimiento(
+            generar=lambda historial: follow_up_chain.invoke({"conversation": historial}),
+            entrega=entrega,
+            guardar_lote=guardar_lote,
+        )
         try:
-            # Crea la tabla de log si no existe
-            connection.execute(text("""
-                CREATE TABLE IF NOT EXISTS follow_up_log (
-                    session_id VARCHAR(255) PRIMARY KEY,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                );
-            """))
-            connection.commit()
-
-            # La lógica para encontrar sesiones inactivas se mantiene
-            query = text("""
-                SELECT session_id, MAX(created_at) as last_message_time
-                FROM message_store -- Apuntamos a la nueva tabla de memoria
-                WHERE session_id NOT IN (SELECT session_id FROM follow_up_log)
-                GROUP BY session_id
-                HAVING MAX(created_at) <= NOW() - INTERVAL '24 hours';
-            """)
-            inactive_sessions = connection.execute(query).fetchall()
-
-            print(f"Se encontraron {len(inactive_sessions)} conversaciones inactivas.")
-
-            for session in inactive_sessions:
-                session_id = session[0]
-                print(f"--- Procesando a: {session_id} ---")
-
-                history_query = text("SELECT message FROM message_store WHERE session_id = :sid ORDER BY id DESC LIMIT 6")
-                messages_raw = connection.execute(history_query, {"sid": session_id}).fetchall()
-                # Adaptamos el formato del historial
-                conversation_history = "\n".join([f"{msg[0]['type']}: {msg[0]['data']['content']}" for msg in reversed(messages_raw)])
-
-                # Ya no necesitamos extraer el tema ni buscar en Tavily
-                
-                follow_up_chain = LLMChain(llm=llm, prompt=follow_up_prompt)
-                message_to_send = follow_up_chain.invoke({"conversation": conversation_history})
-
-                # La lógica de envío a Facebook se mantiene por ahora
-                params = {"access_token": PAGE_ACCESS_TOKEN}
-                headers = {"Content-Type": "application/json"}
-                data = {"recipient": {"id": session_id}, "message": {"text": message_to_send}}
-                r = requests.post("https://graph.facebook.com/v19.0/me/messages", params=params, headers=headers, json=data)
-                
-                if r.status_code == 200:
-                    print(f"Mensaje enviado a {session_id}")
-                    log_query = text("INSERT INTO follow_up_log (session_id) VALUES (:sid) ON CONFLICT (session_id) DO NOTHING;")
-                    connection.execute(log_query, {"sid": session_id})
-                    connection.commit()
-                else:
-                    print(f"!!! ERROR al enviar a {session_id}: {r.text}")
-        
+            m = pipeline.ejecutar(sesiones_inactivas(connection))
         except Exception as e:
             print(f"!!! ERROR GENERAL EN EL PROCESO DE SEGUIMIENTO: {e} !!!")
             connection.rollback()
+            m = pipeline.metricas()
+        finally:
+            entrega.cerrar()
+
+    print(f"Se procesaron {m['leidas']} conversaciones inactivas: {m['enviados']} enviados, "
+          f"{m['fallidos_envio']} fallidos, {m['errores_ia']} sin redactar.")
+    if "mensajes_por_seg" in m:
+        print(f"Envío: {m['mensajes_por_seg']} msg/s en {m['duracion_seg']}s. Graph: {entrega.metricas()}")
             
     print("--- SCRIPT DE SEGUIMIENTO FINALIZADO ---")
 
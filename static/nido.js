@@ -14,6 +14,59 @@ document.addEventListener('DOMContentLoaded', function() {
             chatWindowIA.scrollTop = chatWindowIA.scrollHeight;
         };
 
+        // Token del Nido: con él, el chat va al Agente de este prospecto y llega en streaming
+        const tokenNido = chatFormIA.dataset.token;
+
+        // Lee la respuesta SSE de /api/chat-nido/stream y va pintando el texto según llega
+        const streamMessageIA = async (userMessage) => {
+            const response = await fetch('/api/chat-nido/stream', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ token: tokenNido, mensaje: userMessage }),
+            });
+            if (!response.ok || !response.body) throw new Error('La respuesta del servidor no fue OK');
+
+            const messageDiv = document.createElement('div');
+            messageDiv.classList.add('message', 'bot-message');
+            chatWindowIA.appendChild(messageDiv);
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let texto = '';
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                // Cada evento SSE termina en una línea en blanco
+                let corte;
+                while ((corte = buffer.indexOf('\n\n')) !== -1) {
+                    const bloque = buffer.slice(0, corte);
+                    buffer = buffer.slice(corte + 2);
+
+                    let evento = 'message';
+                    let datos = '';
+                    bloque.split('\n').forEach((linea) => {
+                        if (linea.startsWith('event:')) evento = linea.slice(6).trim();
+                        else if (linea.startsWith('data:')) datos += linea.slice(5).trim();
+                    });
+                    const payload = datos ? JSON.parse(datos) : {};
+
+                    if (evento === 'error') {
+                        texto = texto || payload.error || 'Lo siento, estoy teniendo problemas de conexión.';
+                    } else if (evento === 'fin') {
+                        return;
+                    } else if (payload.t) {
+                        texto += payload.t;
+                    }
+                    messageDiv.innerText = texto;
+                    chatWindowIA.scrollTop = chatWindowIA.scrollHeight;
+                }
+            }
+        };
+
         chatFormIA.addEventListener('submit', async (event) => {
             event.preventDefault();
             const userMessage = userInputIA.value.trim();
@@ -23,6 +76,10 @@ document.addEventListener('DOMContentLoaded', function() {
             userInputIA.value = '';
 
             try {
+                if (tokenNido) {
+                    await streamMessageIA(userMessage);
+                    return;
+                }
                 const response = await fetch('/chat', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
@@ -0,0 +1,77 @@
+import threading
+
+from entrega_messenger import EntregaMessenger, GraphLocal
+from seguimiento import PipelineSeguimiento
+
+
+def _sesiones(n):
+    return [(f"psid-{i}", f"Historial {i}") for i in range(n)]
+
+
+def _pipeline(entrega, registrados):
+    return PipelineSeguimiento(
+        generar=lambda historial: {"text": f"Hola de nuevo ({historial})"},
+        entrega=entrega,
+        guardar_lote=registrados.extend,
+        hilos_ia=2, hilos_envio=4, tamano_cola=5, lote_log=7, flush_log_seg=0.1,
+    )
+
+
+def test_envia_y_registra_todo_contra_graph_local():
+    registrados = []
+    with GraphLocal(latencia=0.01) as graph:
+        entrega = EntregaMessenger("token-local", url=graph.url, conexiones=4)
+        datos = _pipeline(entrega, registrados).ejecutar(_sesiones(30))
+        entrega.cerrar()
+
+    assert graph.recibidos == 30
+    assert datos["leidas"] == datos["redactados"] == datos["enviados"] == datos["registrados"] == 30
+    assert datos["fallidos_envio"] == datos["errores_ia"] == datos["errores_log"] == 0
+    assert sorted(registrados) == sorted(s for s, _ in _sesiones(30))
+    assert entrega.metricas()["reintentos"] == 0
+
+
+def test_reintenta_429_hasta_entregar():
+    registrados = []
+    with GraphLocal(latencia=0.01, tasa_429=1.0) as graph:
+        # Graph limita al principio (Retry-After: 1) y se recupera al rato
+        threading.Timer(0.3, setattr, (graph, "tasa_429", 0.0)).start()
+        entrega = EntregaMessenger("token-local", url=graph.url, conexiones=4, reintentos=4)
+        datos = _pipeline(entrega, registrados).ejecutar(_sesiones(10))
+        entrega.cerrar()
+
+    metricas = entrega.metricas()
+    assert datos["enviados"] == datos["registrados"] == graph.recibidos == 10
+    assert datos["fallidos_envio"] == 0
+    assert metricas["reintentos"] >= 1
+    assert metricas["frenados"] >= 1
+    assert len(registrados) == 10
+
+
+def test_429_sin_reintentos_no_registra():
+    registrados = []
+    with GraphLocal(latencia=0.01, tasa_429=1.0) as graph:
+        entrega = EntregaMessenger("token-local", url=graph.url, conexiones=4, reintentos=0)
+        datos = _pipeline(entrega, registrados).ejecutar(_sesiones(8))
+        entrega.cerrar()
+
+    assert graph.recibidos == 0
+    assert datos["enviados"] == datos["registrados"] == 0
+    assert datos["fallidos_envio"] == 8
+    assert entrega.metricas()["fallidos"] == 8
+    assert registrados == []
+
+
+def test_una_excepcion_al_enviar_no_detiene_la_ronda():
+    class EntregaRota:
+        def enviar(self, destinatario, texto):
+            if destinatario.endswith("3"):
+                raise RuntimeError("conexión rota")
+            return True
+
+    registrados = []
+    datos = _pipeline(EntregaRota(), registrados).ejecutar(_sesiones(20))
+
+    assert datos["fallidos_envio"] == 2     # psid-3 y psid-13
+    assert datos["enviados"] == datos["registrados"] == 18
+    assert "psid-3" not in registrados
@@ -2,62 +2,49 @@ import os
 import time
 import json
 import logging
-import requests
-import psycopg2
-from bs4 import BeautifulSoup
-import google.generativeai as genai
+import threading
 from psycopg2.extras import Json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+from pool_conexiones import conexion
+from pasarela_llm import generar, llm_disponible, obtener_pasarela, usar_clave, MODELO_RAPIDO, LOTE
+from cola_trabajo import reclamar_lote
+from cache_web import leer_web, precargar_webs, metricas_cache
+from metricas import contar_transicion
 
 # --- CONFIGURACIÓN ---
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - ANALISTA - %(levelname)s - %(message)s')
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
-GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
 # --- CORRECCIÓN CRÍTICA DE MODELO ---
-# Usamos el modelo de tu lista que permite ALTO VOLUMEN (Más de 50 al día)
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('models/gemini-2.0-flash')
-else:
+# Usamos el modelo de tu lista que permite ALTO VOLUMEN (Más de 50 al día).
+# La cuota (RPM, concurrencia, reintentos 429) la regula la pasarela LLM compartida.
+MODELO_ANALISTA = MODELO_RAPIDO
+if not llm_disponible():
     logging.warning("⚠️ Sin API Key de Gemini en Analista")
-    model = None
+
+# --- CONCURRENCIA Y CUOTA ---
+# Prospectos en vuelo a la vez (1 = modo secuencial clásico)
+ANALISTA_CONCURRENCIA = int(os.environ.get("ANALISTA_CONCURRENCIA", "4"))
+# Filas que se toman de la BD por vuelta
+ANALISTA_LOTE = int(os.environ.get("ANALISTA_LOTE", str(max(5, ANALISTA_CONCURRENCIA * 2))))
 
 # --- 1. LECTURA DE WEB (OJOS DEL ANALISTA) ---
 
 def escanear_web_simple(url):
     """
     Entra a la web del prospecto (si tiene) y extrae texto clave.
+    Pasa por la caché persistente y el lector compartido (keep-alive, streaming, corte temprano).
     """
     if not url: return ""
-    if not url.startswith("http"): url = "http://" + url
-    
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-    
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code != 200: return ""
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        textos = []
-        for tag in soup.find_all(['h1', 'h2', 'h3', 'p', 'meta']):
-            if tag.name == 'meta' and tag.get('name') == 'description':
-                textos.append(tag.get('content', ''))
-            else:
-                textos.append(tag.get_text(strip=True))
-        
-        return " ".join(textos)[:2500] 
-
-    except Exception as e:
-        logging.warning(f"No se pudo leer la web {url}: {e}")
-        return ""
+    return leer_web(url)
 
 # --- 2. EL PSICÓLOGO (GEMINI) ---
 
 def realizar_psicoanalisis(prospecto, campana, texto_web):
-    if not model: return None
+    if not llm_disponible(): return None
 
     # Prompt optimizado para Venta Consultiva
     prompt = f"""
@@ -99,105 +86,188 @@ def realizar_psicoanalisis(prospecto, campana, texto_web):
     """
 
     try:
-        respuesta = model.generate_content(prompt)
+        respuesta = generar(prompt, modelo=MODELO_ANALISTA, prioridad=LOTE)
+        ultima = obtener_pasarela().ultima_llamada()
+        estadisticas.registrar("cuota", ultima["espera"])
+        estadisticas.registrar("gemini", ultima["total"] - ultima["espera"])
         texto_limpio = respuesta.text.replace("```json", "").replace("```", "").strip()
         return json.loads(texto_limpio)
     except Exception as e:
         logging.error(f"Error interpretando a Gemini: {e}")
         return None
 
-# --- 3. FUNCIÓN PRINCIPAL DEL TRABAJADOR ---
+# --- 3. MEDICIÓN POR ETAPA ---
 
-def trabajar_analista():
-    logging.info("🧠 Analista Iniciado (Modelo Gemini-2.0-Flash).")
-    
-    while True:
-        conn = None
-        try:
-            conn = psycopg2.connect(DATABASE_URL)
-            cur = conn.cursor()
-
-            # --- SELECCIÓN OPORTUNISTA ---
-            # Busca:
-            # 1. 'espiado' (El Espía trajo datos)
-            # 2. 'cazado' CON EMAIL (El Cazador trajo datos directos)
-            query = """
-                SELECT 
-                    p.id, p.business_name, p.website_url, p.raw_data, p.captured_email,
-                    c.id as campaign_id, c.product_description, c.ticket_price, 
-                    c.red_flags, c.pain_points_defined, c.competitors, c.tone_voice
-                FROM prospects p
-                JOIN campaigns c ON p.campaign_id = c.id
-                WHERE p.status = 'espiado' 
-                OR (p.status = 'cazado' AND (p.captured_email IS NOT NULL OR p.phone_number IS NOT NULL))
-                LIMIT 5;
-            """
-            cur.execute(query)
-            lote = cur.fetchall()
-
-            if not lote:
-                logging.info("💤 Nada que analizar. Durmiendo 60s...")
-                time.sleep(60)
-                continue
-
-            logging.info(f"🧠 Procesando lote de {len(lote)} prospectos...")
-
-            for fila in lote:
-                # Mapeo de datos
-                prospecto = {
-                    "id": fila[0], "business_name": fila[1], "website_url": fila[2], 
-                    "raw_data": fila[3], "email": fila[4]
-                }
-                campana = {
-                    "product_description": fila[6], "ticket_price": fila[7],
-                    "red_flags": fila[8], "pain_points_defined": fila[9],
-                    "competitors": fila[10], "tone_voice": fila[11]
-                }
-
-                # 1. Escanear
-                texto_web = ""
-                if prospecto["website_url"]:
-                    texto_web = escanear_web_simple(prospecto["website_url"])
-                
-                # 2. Analizar
-                analisis_ia = realizar_psicoanalisis(prospecto, campana, texto_web)
-
-                # 3. Decidir
-                nuevo_estado = "analizado_exitoso"
-                pain_points_json = None
-
-                if not analisis_ia:
-                    logging.warning(f"⚠️ Fallo análisis IA ID {prospecto['id']}")
-                    time.sleep(2) 
-                    continue 
-
-                if analisis_ia.get("veredicto") == "DESCARTADO":
-                    nuevo_estado = "descartado"
-                    logging.info(f"🚫 DESCARTADO ID {prospecto['id']}: {analisis_ia.get('razon_descarte')}")
-                else:
-                    logging.info(f"✅ APROBADO ID {prospecto['id']}")
-                    pain_points_json = Json(analisis_ia)
-
-                # 4. Guardar
-                cur.execute("""
-                    UPDATE prospects 
-                    SET status = %s,
-                        pain_points = %s,
-                        updated_at = NOW()
-                    WHERE id = %s
-                """, (nuevo_estado, pain_points_json, prospecto['id']))
-                conn.commit()
-                
-                # Pausa breve para no saturar
-                time.sleep(2) 
-
-            cur.close()
-
-        except Exception as e:
-            logging.error(f"🔥 Error Crítico Analista: {e}")
-            time.sleep(30)
-        finally:
-            if conn: conn.close()
+class EstadisticasEtapas:
+    """Acumula latencias por etapa (web, cuota, gemini, db) para dimensionar la concurrencia."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._muestras = {}
+        self._inicio = time.time()
+        self._procesados = 0
+
+    def registrar(self, etapa, segundos):
+        with self._lock:
+            self._muestras.setdefault(etapa, []).append(segundos)
+
+    def contar_procesado(self):
+        with self._lock:
+            self._procesados += 1
+
+    def reporte(self, reiniciar=True):
+        with self._lock:
+            muestras, self._muestras = self._muestras, ({} if reiniciar else self._muestras)
+            transcurrido = max(time.time() - self._inicio, 1e-6)
+            procesados = self._procesados
+            if reiniciar:
+                self._inicio = time.time()
+                self._procesados = 0
+
+        partes = []
+        for etapa, valores in sorted(muestras.items()):
+            valores = sorted(valores)
+            p50 = valores[len(valores) // 2]
+            p95 = valores[min(len(valores) - 1, int(len(valores) * 0.95))]
+            partes.append(f"{etapa}: p50={p50:.2f}s p95={p95:.2f}s máx={valores[-1]:.2f}s (n={len(valores)})")
+        ritmo = procesados / transcurrido * 60
+        return f"{ritmo:.1f} prospectos/min | " + " | ".join(partes)
+
+estadisticas = EstadisticasEtapas()
+
+# --- 4. PROCESAMIENTO DE UN PROSPECTO ---
+
+def mapear_fila(fila):
+    prospecto = {
+        "id": fila[0], "business_name": fila[1], "website_url": fila[2], 
+        "raw_data": fila[3], "email": fila[4]
+    }
+    campana = {
+        "product_description": fila[6], "ticket_price": fila[7],
+        "red_flags": fila[8], "pain_points_defined": fila[9],
+        "competitors": fila[10], "tone_voice": fila[11]
+    }
+    return prospecto, campana
+
+def analizar_prospecto(fila, precargas=None):
+    """
+    Etapas de red (web + Gemini) de un prospecto. No toca la BD.
+    `precargas` es el {url: Future} del lector para usar la web ya descargada en paralelo.
+    Devuelve (id, nuevo_estado, analisis) o (id, None, None) si la IA falló.
+    """
+    prospecto, campana = mapear_fila(fila)
+
+    # 1. Escanear (si la web se precargó, solo esperamos lo que falte)
+    t0 = time.time()
+    texto_web = ""
+    url = prospecto["website_url"]
+    if url:
+        futuro = (precargas or {}).get(url)
+        texto_web = futuro.result() if futuro else escanear_web_simple(url)
+    estadisticas.registrar("web", time.time() - t0)
+
+    # 2. Analizar (la espera por cuota se mide aparte de la latencia real de Gemini)
+    analisis_ia = realizar_psicoanalisis(prospecto, campana, texto_web)
+
+    if not analisis_ia:
+        logging.warning(f"⚠️ Fallo análisis IA ID {prospecto['id']}")
+        return prospecto["id"], None, None
+
+    # 3. Decidir
+    if analisis_ia.get("veredicto") == "DESCARTADO":
+        logging.info(f"🚫 DESCARTADO ID {prospecto['id']}: {analisis_ia.get('razon_descarte')}")
+        return prospecto["id"], "descartado", None
+
+    logging.info(f"✅ APROBADO ID {prospecto['id']}")
+    return prospecto["id"], "analizado_exitoso", analisis_ia
+
+def guardar_resultado(pid, nuevo_estado, analisis, dueno):
+    t0 = time.time()
+    with conexion() as conn, conn.cursor() as cur:
+        # Solo escribe quien tiene el reclamo: si nuestro lease venció y otro lo tomó, no pisamos su trabajo.
+        cur.execute("""
+            UPDATE prospects 
+            SET status = %s,
+                pain_points = %s,
+                claim_expires_at = NULL,
+                updated_at = NOW()
+            WHERE id = %s AND claimed_by = %s
+        """, (nuevo_estado, Json(analisis) if analisis else None, pid, dueno))
+        escritos = cur.rowcount
+        conn.commit()
+    contar_transicion(nuevo_estado, escritos)
+    estadisticas.registrar("db", time.time() - t0)
+    estadisticas.contar_procesado()
+
+# --- 5. FUNCIÓN PRINCIPAL DEL TRABAJADOR ---
+
+def seleccionar_lote(limite):
+    """
+    Reclama un lote (FOR UPDATE SKIP LOCKED + lease) para que varios Analistas,
+    en el mismo o en otros nodos, nunca paguen Gemini dos veces por el mismo prospecto.
+    """
+    # --- SELECCIÓN OPORTUNISTA ---
+    # Busca:
+    # 1. 'espiado' (El Espía trajo datos)
+    # 2. 'cazado' CON EMAIL (El Cazador trajo datos directos)
+    condicion = """
+        p.status = 'espiado' 
+        OR (p.status = 'cazado' AND (p.captured_email IS NOT NULL OR p.phone_number IS NOT NULL))
+    """
+    columnas = """
+        p.id, p.business_name, p.website_url, p.raw_data, p.captured_email,
+        c.id as campaign_id, c.product_description, c.ticket_price, 
+        c.red_flags, c.pain_points_defined, c.competitors, c.tone_voice
+    """
+    return reclamar_lote("analista", condicion, columnas, limite)
+
+def trabajar_analista(concurrencia=None, continuo=True):
+    """
+    Motor del Analista. Con continuo=False procesa un solo lote y devuelve cuántos
+    prospectos reclamó (0 si no había trabajo), sin dormir (uso manual / benchmark).
+    """
+    concurrencia = max(1, int(concurrencia or ANALISTA_CONCURRENCIA))
+    logging.info(f"🧠 Analista Iniciado (Modelo Gemini-2.0-Flash). En vuelo: {concurrencia} | Cuota: pasarela LLM compartida")
+
+    with ThreadPoolExecutor(max_workers=concurrencia, thread_name_prefix="analista") as pool:
+        while True:
+            try:
+                dueno, lote = seleccionar_lote(max(ANALISTA_LOTE, concurrencia))
+
+                if not lote:
+                    if not continuo:
+                        return 0
+                    logging.info("💤 Nada que analizar. Durmiendo 60s...")
+                    time.sleep(60)
+                    continue
+
+                logging.info(f"🧠 Procesando lote de {len(lote)} prospectos ({concurrencia} en paralelo)...")
+
+                # Todas las webs del lote se piden ya; las esperas de red se solapan
+                # y la BD se escribe en cuanto cada prospecto termina.
+                precargas = precargar_webs([fila[2] for fila in lote])
+                futuros = [pool.submit(analizar_prospecto, fila, precargas) for fila in lote]
+                for futuro in as_completed(futuros):
+                    try:
+                        pid, nuevo_estado, analisis = futuro.result()
+                        # Si la IA falló, el reclamo se deja vencer: se reintenta tras el lease (backoff natural)
+                        if nuevo_estado:
+                            guardar_resultado(pid, nuevo_estado, analisis, dueno)
+                    except Exception as e:
+                        logging.error(f"Error procesando prospecto: {e}")
+
+                logging.info(f"⏱️ Latencias Analista: {estadisticas.reporte()}")
+                logging.info(f"🗄️ Caché web: {metricas_cache()}")
+                if not continuo:
+                    return len(lote)
+
+            except Exception as e:
+                logging.error(f"🔥 Error Crítico Analista: {e}")
+                if not continuo:
+                    return 0
+                time.sleep(30)
 
 if __name__ == "__main__":
+    # Suelto, el Analista usa su propia clave si la tiene (como antes de la pasarela)
+    usar_clave(os.environ.get("GEMINI_API_KEY"))
     trabajar_analista()
@@ -1,11 +1,15 @@
 import os
 import json
 import logging
-import datetime
+import time
+import queue
+import threading
 from apify_client import ApifyClient
-import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 from dotenv import load_dotenv
+from pool_conexiones import conexion
+from libro_gastos import reservar as reservar_gasto, registrar_consumo
+from metricas import medir, contar_transicion
 
 # --- CONFIGURACIÓN INICIAL ---
 load_dotenv()
@@ -19,22 +23,40 @@ PRESUPUESTO_POR_PROSPECTO_CONTRATADO = 4.0  # Dólares USD
 COSTO_ESTIMADO_APIFY_POR_1000 = 5.0         # Costo promedio x 1000 leads crudos
 MULTIPLICADOR_RAW_LEADS = 200               # Cuántos leads crudos caben en 1 dólar (aprox)
 
+# --- INGESTA MASIVA ---
+# Filas por INSERT multi-fila (1 viaje a la BD por lote en vez de 2 por prospecto)
+LOTE_INSERCION_CAZA = int(os.environ.get("CAZADOR_LOTE_INSERCION", "500"))
+
+# --- INGESTA EN STREAMING ---
+# Leer el dataset mientras el actor sigue corriendo (0 = esperar a que termine, modo clásico)
+CAZA_STREAMING = os.environ.get("CAZADOR_STREAMING", "1") == "1"
+# Ítems por página al paginar el dataset y segundos entre sondeos cuando aún no hay nada nuevo
+CAZA_TAMANO_PAGINA = int(os.environ.get("CAZADOR_TAMANO_PAGINA", "100"))
+CAZA_SONDEO_SEG = float(os.environ.get("CAZADOR_SONDEO_SEG", "3"))
+# Prospectos válidos guardados por cada prospecto diario contratado antes de abortar el actor
+CAZA_OBJETIVO_POR_CONTRATADO = int(os.environ.get("CAZADOR_OBJETIVO_POR_CONTRATADO", "10"))
+
+ESTADOS_FINALES_APIFY = ("SUCCEEDED", "FAILED", "ABORTED", "TIMED-OUT")
+
 # --- 1. CEREBRO FINANCIERO ---
 
-def verificar_presupuesto_mensual(campana_id, limite_diario_contratado):
-    """
-    Calcula si tenemos saldo para cazar hoy.
-    Regla: No gastar más de $4 x (Prospectos Diarios Contratados) al mes.
-    """
+def normalizar_limite(limite_diario_contratado):
     # Corrección: Asegurar que sea entero
     if not limite_diario_contratado:
-        limite_diario_contratado = 4
-    
+        return 4
     try:
         limite_diario_int = int(limite_diario_contratado)
-        if limite_diario_int < 1: limite_diario_int = 4
+        return limite_diario_int if limite_diario_int >= 1 else 4
     except:
-        limite_diario_int = 4
+        return 4
+
+def verificar_presupuesto_mensual(campana_id, limite_diario_contratado):
+    """
+    Calcula si tenemos saldo para cazar hoy y lo RESERVA en el libro de gastos.
+    Regla: No gastar más de $4 x (Prospectos Diarios Contratados) al mes.
+    Devuelve una Reserva (o None si no hay saldo); liquidar con registrar_consumo al terminar.
+    """
+    limite_diario_int = normalizar_limite(limite_diario_contratado)
 
     # 1. Calcular Techo Financiero
     presupuesto_total_mes = limite_diario_int * PRESUPUESTO_POR_PROSPECTO_CONTRATADO
@@ -42,79 +64,52 @@ def verificar_presupuesto_mensual(campana_id, limite_diario_contratado):
     # 2. Traducir Dinero a "Cabezas" (Raw Leads)
     tope_leads_mensual = presupuesto_total_mes * MULTIPLICADOR_RAW_LEADS
 
-    conn = None
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-
-        # 3. Contar cuánto hemos cazado este mes
-        hoy = datetime.date.today()
-        inicio_mes = hoy.replace(day=1)
-        
-        query = """
-            SELECT count(*) FROM prospects 
-            WHERE campaign_id = %s 
-            AND status = 'cazado'
-            AND created_at >= %s;
-        """
-        cur.execute(query, (campana_id, inicio_mes))
-        cazados_mes_actual = cur.fetchone()[0]
-        cur.close()
-
-        # 4. Decisión
-        saldo_restante = tope_leads_mensual - cazados_mes_actual
-        
-        if saldo_restante <= 0:
-            logging.warning(f"🛑 FRENO FINANCIERO: Se alcanzó el tope mensual de {int(tope_leads_mensual)} leads crudos. Cazador duerme.")
-            return 0
-        
-        # Calculamos la cuota diaria segura
-        cuota_diaria_sugerida = int(tope_leads_mensual / 30)
-        cantidad_a_cazar = min(cuota_diaria_sugerida, saldo_restante)
-        
-        if cantidad_a_cazar < 5: cantidad_a_cazar = 5
-
-        logging.info(f"💰 PRESUPUESTO: Llevamos {cazados_mes_actual}/{int(tope_leads_mensual)}. Autorizado cazar hoy: {cantidad_a_cazar}")
-        return cantidad_a_cazar
+    # 3. Cuota diaria segura (mínimo técnico 5 para que valga la pena encender Apify)
+    cuota_diaria = max(int(tope_leads_mensual / 30), 5)
 
+    # 4. Reserva atómica en el libro de gastos (O(1); varios hilos no pueden pasarse juntos)
+    try:
+        reserva = reservar_gasto(campana_id, "cazador", cuota_diaria, cuota_diaria, tope_leads_mensual)
     except Exception as e:
         logging.error(f"❌ Error verificando presupuesto: {e}")
-        return 0 
-    finally:
-        if conn: conn.close()
+        return None
+
+    if not reserva:
+        logging.warning(f"🛑 FRENO FINANCIERO: Sin saldo hoy/mes (tope mensual {int(tope_leads_mensual)} leads crudos). Cazador duerme.")
+        return None
+
+    logging.info(f"💰 PRESUPUESTO: Autorizado cazar ahora: {reserva.cantidad}")
+    return reserva
 
 # --- 2. CONSULTA AL ARSENAL ---
 
 def consultar_arsenal(plataforma_objetivo, tipo_producto):
     logging.info(f"🔎 Consultando Arsenal para: Plataforma={plataforma_objetivo}")
-    conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
+        with conexion() as conn:
+            cur = conn.cursor()
         
-        # Busca el mejor bot activo para la plataforma
-        # NOTA: Requiere que hayas ejecutado el SQL de corrección en Supabase
-        query = """
-            SELECT actor_id, input_config 
-            FROM bot_arsenal 
-            WHERE platform = %s 
-            AND is_active = TRUE
-            ORDER BY confidence_level DESC
-            LIMIT 1;
-        """
-        cur.execute(query, (plataforma_objetivo,))
-        resultado = cur.fetchone()
-        cur.close()
+            # Busca el mejor bot activo para la plataforma
+            # NOTA: Requiere que hayas ejecutado el SQL de corrección en Supabase
+            query = """
+                SELECT actor_id, input_config 
+                FROM bot_arsenal 
+                WHERE platform = %s 
+                AND is_active = TRUE
+                ORDER BY confidence_level DESC
+                LIMIT 1;
+            """
+            cur.execute(query, (plataforma_objetivo,))
+            resultado = cur.fetchone()
+            cur.close()
         
-        if resultado:
-            return {"actor_id": resultado[0], "config_extra": resultado[1]}
-        else:
-            return {"actor_id": "compass/crawler-google-places", "config_extra": {}}
+            if resultado:
+                return {"actor_id": resultado[0], "config_extra": resultado[1]}
+            else:
+                return {"actor_id": "compass/crawler-google-places", "config_extra": {}}
     except Exception as e:
         logging.error(f"❌ Error Arsenal (Usando Default): {e}")
         return {"actor_id": "compass/crawler-google-places", "config_extra": {}}
-    finally:
-        if conn: conn.close()
 
 # --- 3. CONFIGURACIÓN AHORRADORA (INPUTS) ---
 
@@ -205,18 +200,235 @@ def validar_y_normalizar(item, plataforma, bot_id):
 
     return datos
 
-# --- 5. FUNCIÓN PRINCIPAL ---
+# --- 5. INGESTA MASIVA (STAGING + MERGE) ---
+
+def _fila_prospecto(campana_id, actor_id, datos_limpios):
+    return (
+        campana_id,
+        datos_limpios["business_name"],
+        datos_limpios["website_url"],
+        datos_limpios["phone_number"],
+        datos_limpios["email"],
+        Json(datos_limpios["social_profiles"]),
+        actor_id,
+        Json(datos_limpios["raw_data"])
+    )
+
+def guardar_lote_prospectos(cur, filas):
+    """
+    Escribe un lote en una tabla temporal con un solo INSERT multi-fila y luego
+    lo fusiona en 'prospects'. Devuelve (insertados, duplicados).
+    El llamador decide cuándo hacer commit.
+    """
+    if not filas:
+        return 0, 0
+
+    # La tabla temporal vive lo que la conexión del pool; se vacía en cada commit.
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS staging_prospects ON COMMIT DELETE ROWS AS
+        SELECT campaign_id, business_name, website_url, phone_number, captured_email,
+               social_profiles, source_bot_id, raw_data
+        FROM prospects
+        WITH NO DATA;
+    """)
+    execute_values(
+        cur,
+        """
+        INSERT INTO staging_prospects
+        (campaign_id, business_name, website_url, phone_number, captured_email, social_profiles, source_bot_id, raw_data)
+        VALUES %s
+        """,
+        filas,
+        page_size=len(filas)
+    )
+    cur.execute("""
+        INSERT INTO prospects 
+        (campaign_id, business_name, website_url, phone_number, captured_email, social_profiles, source_bot_id, status, raw_data, created_at)
+        SELECT campaign_id, business_name, website_url, phone_number, captured_email, social_profiles, source_bot_id, 'cazado', raw_data, NOW()
+        FROM staging_prospects
+        ON CONFLICT DO NOTHING;
+    """)
+    insertados = max(cur.rowcount, 0)
+    cur.execute("TRUNCATE staging_prospects;")
+    return insertados, len(filas) - insertados
+
+def ingerir_lote(conn, filas):
+    """
+    Guarda un lote y confirma. Si el lote completo falla (un dato corrupto),
+    reintenta fila a fila para no perder el resto. Devuelve (insertados, duplicados, fallidos).
+    """
+    with conn.cursor() as cur:
+        try:
+            insertados, duplicados = guardar_lote_prospectos(cur, filas)
+            conn.commit()
+            return insertados, duplicados, 0
+        except Exception as e:
+            conn.rollback()
+            logging.warning(f"⚠️ Lote de {len(filas)} falló ({e}). Reintentando fila a fila...")
+
+        insertados = duplicados = fallidos = 0
+        for fila in filas:
+            try:
+                ins, dup = guardar_lote_prospectos(cur, [fila])
+                conn.commit()
+                insertados += ins
+                duplicados += dup
+            except Exception:
+                conn.rollback()
+                fallidos += 1
+        return insertados, duplicados, fallidos
 
-def ejecutar_caza(campana_id, prompt_busqueda, ubicacion, plataforma="Google Maps", tipo_producto="Tangible", limite_diario_contratado=4):
+class IngestaCaza:
+    """
+    Normaliza ítems de Apify y los guarda por lotes, llevando la cuenta de la corrida.
+    Solo toma una conexión del pool al volcar un lote: mientras Apify corre no retiene ninguna.
+    """
+
+    def __init__(self, campana_id, plataforma, actor_id, tamano_lote, inicio=None):
+        self.campana_id = campana_id
+        self.plataforma = plataforma
+        self.actor_id = actor_id
+        self.tamano_lote = max(1, int(tamano_lote))
+        self.inicio = inicio or time.time()
+        self.lote = []
+        self.leidos = self.guardados = self.duplicados = self.fallidos = self.filtrados = 0
+        self.primer_guardado = None   # segundos desde el arranque hasta el primer prospecto guardado
+
+    def agregar(self, item):
+        self.leidos += 1
+        datos_limpios = validar_y_normalizar(item, self.plataforma, self.actor_id)
+        if not datos_limpios:
+            self.filtrados += 1
+            return
+        self.lote.append(_fila_prospecto(self.campana_id, self.actor_id, datos_limpios))
+        if len(self.lote) >= self.tamano_lote:
+            self.vaciar()
+
+    def vaciar(self):
+        if not self.lote:
+            return
+        with conexion() as conn:
+            ins, dup, fal = ingerir_lote(conn, self.lote)
+        self.guardados += ins; self.duplicados += dup; self.fallidos += fal
+        contar_transicion("cazado", ins)
+        self.lote = []
+        if ins and self.primer_guardado is None:
+            self.primer_guardado = time.time() - self.inicio
+
+    def resumen(self):
+        primero = f"{self.primer_guardado:.1f}s" if self.primer_guardado is not None else "-"
+        return (f"Guardados: {self.guardados} | Duplicados: {self.duplicados} | "
+                f"Basura filtrada: {self.filtrados} | Fallidos: {self.fallidos} | "
+                f"Leídos: {self.leidos} | Primer guardado: {primero}")
+
+def _paginar_dataset(client, run_id, dataset_id, cola, detener, tamano_pagina):
+    """
+    Productor: pide páginas del dataset mientras el actor corre y las deja en `cola`.
+    Termina (con None) cuando el actor acabó y ya no quedan ítems, o cuando se pide detener.
+    """
+    dataset = client.dataset(dataset_id)
+    run_client = client.run(run_id)
+    offset = 0
+
+    def entregar(valor):
+        while not detener.is_set():
+            try:
+                cola.put(valor, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        while not detener.is_set():
+            # El estado se lee ANTES de la página: si ya había terminado y la página vino vacía, no falta nada.
+            estado = (run_client.get() or {}).get("status")
+            items = dataset.list_items(offset=offset, limit=tamano_pagina).items
+            if items:
+                offset += len(items)
+                if not entregar(items):
+                    return
+            elif estado in ESTADOS_FINALES_APIFY:
+                entregar(("fin", estado))
+                return
+            else:
+                detener.wait(CAZA_SONDEO_SEG)
+    except Exception as e:
+        entregar(e)
+
+def _cazar_en_streaming(client, actor_id, run_input, ingesta, objetivo, tamano_pagina):
+    """
+    Arranca el actor sin esperar y guarda cada página en cuanto aparece en el dataset.
+    Al alcanzar `objetivo` prospectos guardados aborta el actor (deja de pagar la cola).
+    Devuelve el estado final del actor ('ABORTED' si lo cortamos nosotros).
+    """
+    run = client.actor(actor_id).start(run_input=run_input)
+    run_id, dataset_id = run["id"], run["defaultDatasetId"]
+
+    cola = queue.Queue(maxsize=4)
+    detener = threading.Event()
+    productor = threading.Thread(target=_paginar_dataset, name="cazador_paginas",
+                                 args=(client, run_id, dataset_id, cola, detener, tamano_pagina), daemon=True)
+    productor.start()
+
+    estado = None
+    try:
+        while True:
+            pagina = cola.get()
+            if isinstance(pagina, Exception):
+                raise pagina
+            if isinstance(pagina, tuple):
+                estado = pagina[1]
+                break
+
+            for item in pagina:
+                ingesta.agregar(item)
+            # Se guarda página a página (no se espera a llenar el lote) para bajar la latencia
+            ingesta.vaciar()
+
+            if ingesta.guardados >= objetivo:
+                logging.info(f"🎯 Objetivo alcanzado ({ingesta.guardados}/{objetivo}). Abortando actor para no pagar de más.")
+                client.run(run_id).abort()
+                estado = "ABORTED"
+                break
+    finally:
+        detener.set()
+        productor.join(timeout=CAZA_SONDEO_SEG + 5)
+        if estado is None:
+            # Salimos por error: no dejamos al actor gastando solo
+            try:
+                client.run(run_id).abort()
+            except Exception:
+                pass
+
+    # Apify cobra lo que el actor produjo, aunque no lo hayamos llegado a leer
+    try:
+        info = client.dataset(dataset_id).get() or {}
+        ingesta.leidos = max(ingesta.leidos, int(info.get("itemCount") or 0))
+    except Exception:
+        pass
+    return estado
+
+# --- 6. FUNCIÓN PRINCIPAL ---
+
+def ejecutar_caza(campana_id, prompt_busqueda, ubicacion, plataforma="Google Maps", tipo_producto="Tangible", limite_diario_contratado=4,
+                  tamano_lote=None, streaming=None, objetivo_guardados=None):
     
-    # 1. VERIFICACIÓN FINANCIERA
-    cantidad_a_cazar = verificar_presupuesto_mensual(campana_id, limite_diario_contratado)
+    # 1. VERIFICACIÓN FINANCIERA (reserva en el libro)
+    reserva = verificar_presupuesto_mensual(campana_id, limite_diario_contratado)
     
-    if cantidad_a_cazar <= 0:
+    if not reserva:
+        # Sin cupo no es un fallo: None para que el planificador no lo cuente como tal
         logging.info("⏸️ Cazador en pausa por presupuesto o fin de jornada.")
-        return False
+        return None
+
+    cantidad_a_cazar = reserva.cantidad
+    streaming = CAZA_STREAMING if streaming is None else streaming
+    objetivo = objetivo_guardados or CAZA_OBJETIVO_POR_CONTRATADO * normalizar_limite(limite_diario_contratado)
+    objetivo = max(1, min(objetivo, cantidad_a_cazar))
+    ingesta = None
 
-    logging.info(f"🚀 CAZANDO: {cantidad_a_cazar} prospectos | Campaña: {campana_id}")
+    logging.info(f"🚀 CAZANDO: {cantidad_a_cazar} prospectos (objetivo {objetivo} guardados) | Campaña: {campana_id}")
 
     # 2. Consultar Arsenal
     bot_info = consultar_arsenal(plataforma, tipo_producto)
@@ -227,65 +439,45 @@ def ejecutar_caza(campana_id, prompt_busqueda, ubicacion, plataforma="Google Map
     try:
         client = ApifyClient(APIFY_TOKEN)
         run_input = preparar_input_blindado(actor_id, prompt_busqueda, ubicacion, cantidad_a_cazar, config_extra)
-        
-        logging.info(f"📡 Apify Run ({actor_id})...")
-        run = client.actor(actor_id).call(run_input=run_input)
-        
-        if not run or run.get('status') != 'SUCCEEDED':
-            logging.error("❌ Fallo en Apify.")
-            return False
+        tamano_lote = tamano_lote or LOTE_INSERCION_CAZA
+        inicio = time.time()
+
+        ingesta = IngestaCaza(campana_id, plataforma, actor_id, tamano_lote, inicio)
+
+        if streaming:
+            # 4a. Guardamos mientras el actor corre y lo cortamos al llegar al objetivo
+            logging.info(f"📡 Apify Run en streaming ({actor_id})...")
+            with medir("autoneura_apify_segundos", actor=actor_id, trabajador="cazador"):
+                estado = _cazar_en_streaming(client, actor_id, run_input, ingesta, objetivo, CAZA_TAMANO_PAGINA)
+            ingesta.vaciar()
+            if estado not in ("SUCCEEDED", "ABORTED") and not ingesta.guardados:
+                logging.error(f"❌ Fallo en Apify ({estado}).")
+                return False
+        else:
+            # 4b. Modo clásico: esperar al actor y recorrer el dataset completo
+            logging.info(f"📡 Apify Run ({actor_id})...")
+            with medir("autoneura_apify_segundos", actor=actor_id, trabajador="cazador"):
+                run = client.actor(actor_id).call(run_input=run_input)
 
-        dataset_id = run["defaultDatasetId"]
-        
-        # 4. Procesar Resultados
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        contador_guardados = 0
-        dataset_items = client.dataset(dataset_id).iterate_items()
-        
-        for item in dataset_items:
-            datos_limpios = validar_y_normalizar(item, plataforma, actor_id)
-            
-            if not datos_limpios: 
-                continue 
+            if not run or run.get('status') != 'SUCCEEDED':
+                logging.error("❌ Fallo en Apify.")
+                return False
 
-            try:
-                cur.execute(
-                    """
-                    INSERT INTO prospects 
-                    (campaign_id, business_name, website_url, phone_number, captured_email, social_profiles, source_bot_id, status, raw_data, created_at)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, 'cazado', %s, NOW())
-                    ON CONFLICT DO NOTHING 
-                    RETURNING id;
-                    """,
-                    (
-                        campana_id,
-                        datos_limpios["business_name"],
-                        datos_limpios["website_url"],
-                        datos_limpios["phone_number"],
-                        datos_limpios["email"],
-                        Json(datos_limpios["social_profiles"]),
-                        actor_id,
-                        Json(datos_limpios["raw_data"])
-                    )
-                )
-                
-                if cur.rowcount > 0:
-                    contador_guardados += 1
-                    
-            except Exception as db_err:
-                conn.rollback()
-                continue
-            else:
-                conn.commit()
+            for item in client.dataset(run["defaultDatasetId"]).iterate_items():
+                ingesta.agregar(item)
+            ingesta.vaciar()
 
-        cur.close()
-        conn.close()
-        
-        logging.info(f"✅ FINALIZADO. Guardados: {contador_guardados} (Se filtró la basura).")
+        duracion = time.time() - inicio
+        logging.info(f"✅ FINALIZADO en {duracion:.1f}s. {ingesta.resumen()}")
         return True
 
     except Exception as e:
         logging.critical(f"🔥 Error en worker_cazador: {e}")
         return False
+
+    finally:
+        # Liquidamos la reserva con lo que Apify realmente entregó (lo no usado vuelve al saldo)
+        try:
+            registrar_consumo(reserva, ingesta.leidos if ingesta else 0, COSTO_ESTIMADO_APIFY_POR_1000 / 1000.0)
+        except Exception as e:
+            logging.error(f"❌ Error registrando gasto: {e}")
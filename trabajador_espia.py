@@ -3,9 +3,13 @@ import json
 import logging
 import datetime
 from apify_client import ApifyClient
-import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_batch
 from dotenv import load_dotenv
+from pool_conexiones import conexion
+from libro_gastos import reservar as reservar_gasto, registrar_consumo
+from cache_enriquecimiento import clave_enriquecimiento, buscar_lote as buscar_en_cache, guardar_lote as guardar_en_cache, metricas_enriquecimiento
+from metricas import medir, contar_transicion
+from cola_trabajo import asegurar_columnas, registrar_fallos
 
 # --- CONFIGURACIÓN ---
 load_dotenv()
@@ -22,6 +26,9 @@ COSTO_APIFY_INSTAGRAM_PERFIL = 0.005    # Costo aprox por consulta
 # Actor Apify Oficial (Instagram Scraper)
 ACTOR_ESPIA_ID = "apify/instagram-scraper" 
 
+# Corridas en las que un perfil adivinado no aparece antes de darlo por inexistente
+ESPIA_MAX_SIN_RESPUESTA = int(os.environ.get("ESPIA_MAX_SIN_RESPUESTA", "2"))
+
 # --- 1. AUDITORÍA GRATUITA (COSTO $0) ---
 
 def procesar_gratuitos(campana_id):
@@ -29,41 +36,39 @@ def procesar_gratuitos(campana_id):
     Revisa la base de datos y promueve a 'espiado' a todos los que 
     YA tienen datos de contacto (traídos por el Cazador), sin gastar dinero en Apify.
     """
-    conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-
-        # Actualización Masiva:
-        # Si está 'cazado' Y tiene (Email O Teléfono/Wasap) -> Pasa directo a 'espiado'
-        # Esto permite que el Analista los tome sin que el Espía gaste saldo.
-        query = """
-            UPDATE prospects
-            SET status = 'espiado',
-                updated_at = NOW()
-            WHERE campaign_id = %s
-            AND status = 'cazado'
-            AND (captured_email IS NOT NULL OR phone_number IS NOT NULL);
-        """
-        cur.execute(query, (campana_id,))
-        cantidad = cur.rowcount
-        conn.commit()
+        with conexion() as conn:
+            cur = conn.cursor()
+
+            # Actualización Masiva:
+            # Si está 'cazado' Y tiene (Email O Teléfono/Wasap) -> Pasa directo a 'espiado'
+            # Esto permite que el Analista los tome sin que el Espía gaste saldo.
+            query = """
+                UPDATE prospects
+                SET status = 'espiado',
+                    updated_at = NOW()
+                WHERE campaign_id = %s
+                AND status = 'cazado'
+                AND (captured_email IS NOT NULL OR phone_number IS NOT NULL);
+            """
+            cur.execute(query, (campana_id,))
+            cantidad = cur.rowcount
+            conn.commit()
+            contar_transicion("espiado", cantidad)
         
-        if cantidad > 0:
-            logging.info(f"✨ AUDITORÍA GRATUITA: {cantidad} prospectos ya tenían datos. Promovidos a 'espiado' sin costo.")
+            if cantidad > 0:
+                logging.info(f"✨ AUDITORÍA GRATUITA: {cantidad} prospectos ya tenían datos. Promovidos a 'espiado' sin costo.")
         
-        cur.close()
+            cur.close()
     except Exception as e:
         logging.error(f"Error en auditoría gratuita: {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn: conn.close()
 
 # --- 2. CEREBRO FINANCIERO (BOZAL) ---
 
 def calcular_cupo_diario_espia(campana_id, limite_diario_contratado):
     """
-    Calcula el límite de perfiles a espiar hoy basado en el presupuesto de $1.50.
+    Calcula el límite de perfiles a espiar hoy basado en el presupuesto de $1.50
+    y lo RESERVA en el libro de gastos. Devuelve una Reserva (cantidad 0 si no hay saldo).
     """
     if not limite_diario_contratado or limite_diario_contratado < 1:
         limite_diario_contratado = 4
@@ -79,8 +84,12 @@ def calcular_cupo_diario_espia(campana_id, limite_diario_contratado):
     
     # Mínimo técnico para encender motores
     if consultas_permitidas_hoy < 3: consultas_permitidas_hoy = 3
-    
-    return consultas_permitidas_hoy
+
+    # Tope del mes en consultas: el libro impide pasarse aunque el Espía corra varias veces al día
+    consultas_permitidas_mes = int(presupuesto_mensual / COSTO_APIFY_INSTAGRAM_PERFIL)
+
+    return reservar_gasto(campana_id, "espia", consultas_permitidas_hoy,
+                          consultas_permitidas_hoy, consultas_permitidas_mes)
 
 # --- 3. TRIANGULACIÓN Y APIFY ---
 
@@ -106,14 +115,24 @@ def triangular_username(prospecto):
 
     return None
 
-def espiar_en_instagram(username):
+def espiar_lote_instagram(usernames):
     """
-    Llama a Apify con configuración de AHORRO EXTREMO.
+    Llama a Apify UNA sola vez para todo el lote (un arranque de actor en vez de uno por perfil),
+    con configuración de AHORRO EXTREMO.
+    Devuelve (resultados, corrida_creada): resultados es {username_en_minúsculas: datos} con lo que
+    haya devuelto el actor, o None si la corrida falló; corrida_creada dice si Apify llegó a arrancarla
+    (solo entonces hay algo que cobrar).
+    Un perfil que no aparece en el dataset no está confirmado: Instagram suele omitir perfiles
+    de un lote (bloqueos, login) y conviene reintentarlo en otro turno.
     """
+    usernames = list(dict.fromkeys(u for u in usernames if u))
+    if not usernames:
+        return {}, False
+
     client = ApifyClient(APIFY_TOKEN)
     
     run_input = {
-        "usernames": [username],
+        "usernames": usernames,
         "resultsLimit": 1,
         "resultsType": "details",
         # --- AHORRO: NO BAJAR MEDIA ---
@@ -124,19 +143,50 @@ def espiar_en_instagram(username):
         "proxy": {"useApifyProxy": True}
     }
 
+    run = None
     try:
-        logging.info(f"🕵️ Gastando saldo en Instagram: @{username}")
-        run = client.actor(ACTOR_ESPIA_ID).call(run_input=run_input)
+        logging.info(f"🕵️ Gastando saldo en Instagram: {len(usernames)} perfiles en una sola corrida")
+        with medir("autoneura_apify_segundos", actor=ACTOR_ESPIA_ID, trabajador="espia"):
+            run = client.actor(ACTOR_ESPIA_ID).call(run_input=run_input)
         
-        if not run or run.get('status') != 'SUCCEEDED': return None
+        if not run or run.get('status') != 'SUCCEEDED': return None, run is not None
 
-        dataset_id = run["defaultDatasetId"]
-        items = client.dataset(dataset_id).list_items().items
-        return items[0] if items else None
+        resultados = {}
+        for item in client.dataset(run["defaultDatasetId"]).iterate_items():
+            usuario = (item.get("username") or "").lower()
+            if usuario and usuario not in resultados:
+                resultados[usuario] = item
+        return resultados, True
 
     except Exception as e:
         logging.error(f"❌ Fallo Apify: {e}")
+        return None, run is not None
+
+def espiar_en_instagram(username):
+    """Consulta un solo perfil (usa la misma vía que el lote)."""
+    resultados, _ = espiar_lote_instagram([username])
+    if not resultados:
         return None
+    return resultados.get(username.lower()) or next(iter(resultados.values()), None)
+
+def extraer_contacto(datos_nuevos):
+    """Email y teléfono de un perfil de Instagram (campos directos o, si no hay, la biografía)."""
+    if not datos_nuevos:
+        return None, None
+
+    # Buscamos en campos directos
+    nuevo_email = datos_nuevos.get("businessEmail") or datos_nuevos.get("email")
+    nuevo_phone = datos_nuevos.get("businessPhoneNumber") or datos_nuevos.get("phone")
+
+    # Buscamos en la biografía si no hay campo directo
+    if not nuevo_email and datos_nuevos.get("biography"):
+        bio = datos_nuevos["biography"]
+        for w in bio.split():
+            if "@" in w and "." in w:
+                nuevo_email = w
+                break
+
+    return nuevo_email, nuevo_phone
 
 # --- 4. FUNCIÓN PRINCIPAL ---
 
@@ -148,84 +198,118 @@ def ejecutar_espia(campana_id, limite_diario_contratado=4):
     procesar_gratuitos(campana_id)
 
     # PASO 2: Chequeo Financiero para los difíciles
-    cupo_hoy = calcular_cupo_diario_espia(campana_id, limite_diario_contratado)
-    logging.info(f"💰 Cupo Apify Restante Hoy: {cupo_hoy} perfiles.")
-
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
-
-    # PASO 3: Seleccionar objetivos
-    # Solo buscamos los que están 'cazado', NO tienen email NI teléfono.
-    query = """
-        SELECT id, business_name, social_profiles, source_bot_id
-        FROM prospects
-        WHERE campaign_id = %s
-        AND status = 'cazado' 
-        AND captured_email IS NULL 
-        AND phone_number IS NULL
-        LIMIT %s;
-    """
-    cur.execute(query, (campana_id, cupo_hoy))
-    objetivos = cur.fetchall()
+    try:
+        reserva = calcular_cupo_diario_espia(campana_id, limite_diario_contratado)
+    except Exception as e:
+        logging.error(f"❌ Error reservando presupuesto del Espía: {e}")
+        return
 
-    if not objetivos:
-        logging.info("💤 Todo limpio. No hay prospectos sin contacto pendientes de gasto.")
-        cur.close()
-        conn.close()
+    if not reserva:
+        logging.info("🛑 FRENO FINANCIERO: Sin cupo Apify hoy/mes para el Espía.")
         return
 
-    count_exitos = 0
-    count_fallos = 0
-    
-    for row in objetivos:
-        pid, bname, socials, source = row
-        prospecto_dict = {"business_name": bname, "social_profiles": socials}
-        
-        # Intentamos adivinar el usuario de Instagram
-        target_user = triangular_username(prospecto_dict)
-        datos_nuevos = None
-        
-        if target_user:
-            datos_nuevos = espiar_en_instagram(target_user)
-        
-        # Procesamos lo que encontró Apify
-        nuevo_email = None
-        nuevo_phone = None
-        
-        if datos_nuevos:
-            # Buscamos en campos directos
-            nuevo_email = datos_nuevos.get("businessEmail") or datos_nuevos.get("email")
-            nuevo_phone = datos_nuevos.get("businessPhoneNumber") or datos_nuevos.get("phone")
-            
-            # Buscamos en la biografía si no hay campo directo
-            if not nuevo_email and datos_nuevos.get("biography"):
-                bio = datos_nuevos["biography"]
-                for w in bio.split():
-                    if "@" in w and "." in w:
-                        nuevo_email = w
-                        break
-
-        # PASO 4: Guardar Resultados
-        if nuevo_email or nuevo_phone:
-            logging.info(f"✅ PAGADO Y ENCONTRADO ID {pid}: {nuevo_email}")
+    cupo_hoy = reserva.cantidad
+    logging.info(f"💰 Cupo Apify Reservado Hoy: {cupo_hoy} perfiles.")
+
+    consultas_pagadas = 0
+    try:
+        # PASO 3: Seleccionar objetivos
+        # Solo buscamos los que están 'cazado', NO tienen email NI teléfono.
+        # Primero los que menos veces faltaron en una corrida: los muertos no tapan a los nuevos.
+        asegurar_columnas()
+        with conexion() as conn, conn.cursor() as cur:
             cur.execute("""
+                SELECT id, business_name, social_profiles, source_bot_id
+                FROM prospects
+                WHERE campaign_id = %s
+                AND status = 'cazado' 
+                AND captured_email IS NULL 
+                AND phone_number IS NULL
+                ORDER BY claim_attempts, id
+                LIMIT %s;
+            """, (campana_id, cupo_hoy))
+            objetivos = cur.fetchall()
+
+        if not objetivos:
+            logging.info("💤 Todo limpio. No hay prospectos sin contacto pendientes de gasto.")
+            return
+
+        # Intentamos adivinar el usuario de Instagram de cada uno
+        usuarios = {}
+        claves = {}
+        for pid, bname, socials, source in objetivos:
+            usuarios[pid] = triangular_username({"business_name": bname, "social_profiles": socials})
+            claves[pid] = clave_enriquecimiento(bname, usuarios[pid])
+
+        # Caché global: el mismo negocio ya consultado en otra campaña/cliente no se vuelve a pagar
+        en_cache = buscar_en_cache(claves.values(), COSTO_APIFY_INSTAGRAM_PERFIL)
+        pendientes = [pid for pid in usuarios if usuarios[pid] and claves[pid] not in en_cache]
+
+        # Una sola corrida de Apify para lo que falta (sin conexión tomada mientras esperamos)
+        a_consultar = list(dict.fromkeys(usuarios[pid] for pid in pendientes))
+        resultados, corrida_creada = espiar_lote_instagram(a_consultar) if a_consultar else ({}, False)
+        if corrida_creada:
+            consultas_pagadas = len(a_consultar)
+        if resultados is None:
+            # La corrida entera falló: no descartamos a nadie, se reintentan en el próximo turno
+            logging.error(f"❌ Corrida de Apify fallida para {len(a_consultar)} perfiles. Se reintentará.")
+            return
+
+        # PASO 4: Guardar Resultados (todos en una transacción)
+        encontrados = []
+        descartados = []
+        sin_respuesta = []
+        nuevas_en_cache = []
+        for pid, usuario in usuarios.items():
+            if claves[pid] in en_cache:
+                nuevo_email, nuevo_phone, _ = en_cache[claves[pid]]
+                origen = "CACHÉ"
+            elif usuario and usuario.lower() not in resultados:
+                # El actor no devolvió el perfil: sin entrada en caché (puede ser un bloqueo pasajero).
+                # Sigue 'cazado' hasta faltar ESPIA_MAX_SIN_RESPUESTA veces (usuario adivinado que no existe)
+                sin_respuesta.append(pid)
+                continue
+            else:
+                nuevo_email, nuevo_phone = extraer_contacto(resultados.get(usuario.lower()) if usuario else None)
+                origen = "PAGADO"
+                if usuario:
+                    nuevas_en_cache.append((claves[pid], usuario, nuevo_email, nuevo_phone))
+
+            if nuevo_email or nuevo_phone:
+                logging.info(f"✅ {origen} Y ENCONTRADO ID {pid}: {nuevo_email}")
+                encontrados.append((nuevo_email, nuevo_phone, pid))
+            else:
+                # Si pagamos y no encontramos nada, marcamos 'descartado_espia'
+                # para no volver a gastar dinero en este prospecto mañana.
+                logging.info(f"❌ {origen} sin éxito ID {pid}. Descartado.")
+                descartados.append((pid,))
+
+        guardar_en_cache(nuevas_en_cache)
+
+        with conexion() as conn, conn.cursor() as cur:
+            execute_batch(cur, """
                 UPDATE prospects 
                 SET captured_email = COALESCE(captured_email, %s),
                     phone_number = COALESCE(phone_number, %s),
                     status = 'espiado',
                     updated_at = NOW()
                 WHERE id = %s
-            """, (nuevo_email, nuevo_phone, pid))
-            count_exitos += 1
-        else:
-            # Si pagamos y no encontramos nada, marcamos 'descartado_espia'
-            # para no volver a gastar dinero en este prospecto mañana.
-            logging.info(f"❌ Pagado sin éxito ID {pid}. Descartado.")
-            cur.execute("UPDATE prospects SET status = 'descartado_espia', updated_at = NOW() WHERE id = %s", (pid,))
-            count_fallos += 1
-            
-        conn.commit()
-
-    cur.close()
-    conn.close()
-    logging.info(f"🏁 Turno Espía finalizado. Invertidos en Apify: {count_exitos + count_fallos}")
+            """, encontrados)
+            execute_batch(cur, "UPDATE prospects SET status = 'descartado_espia', updated_at = NOW() WHERE id = %s", descartados)
+            conn.commit()
+        inexistentes = registrar_fallos(sin_respuesta, None, ESPIA_MAX_SIN_RESPUESTA, "descartado_espia")
+        contar_transicion("espiado", len(encontrados))
+        contar_transicion("descartado_espia", len(descartados) + inexistentes)
+
+        logging.info(
+            f"🏁 Turno Espía finalizado. Invertidos en Apify: {consultas_pagadas} "
+            f"| Desde caché: {sum(1 for pid in usuarios if claves[pid] in en_cache)} | Encontrados: {len(encontrados)} "
+            f"| Descartados: {len(descartados)} | Sin respuesta: {len(sin_respuesta)} ({inexistentes} descartados tras {ESPIA_MAX_SIN_RESPUESTA}) | Ahorro caché (proceso): ${metricas_enriquecimiento()['dolares_ahorrados']}"
+        )
+
+    finally:
+        # Liquidamos la reserva: solo se cobra lo que realmente se consultó en Apify
+        try:
+            registrar_consumo(reserva, consultas_pagadas, COSTO_APIFY_INSTAGRAM_PERFIL)
+        except Exception as e:
+            logging.error(f"❌ Error registrando gasto del Espía: {e}")
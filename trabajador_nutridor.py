@@ -1,33 +1,72 @@
 import os
-import json
+import time
 import logging
-import psycopg2
-from psycopg2.extras import Json
-import google.generativeai as genai
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import Json, execute_batch
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from pool_conexiones import conexion
+from cola_trabajo import reclamar_lote, liberar
+from pasarela_llm import generar, generar_stream, llm_disponible, MODELO_PRO, INTERACTIVO, LOTE
+from cache_sesiones_nido import obtener_cache_contexto
+from buffer_interacciones import sumar_interaccion
+from metricas import contar_transicion
 
 # --- CONFIGURACIÓN ---
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - NUTRIDOR - %(levelname)s - %(message)s')
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    # CORRECCIÓN CRÍTICA: Usar modelo estable
-    modelo_ia = genai.GenerativeModel('models/gemini-pro-latest')
-else:
+# CORRECCIÓN CRÍTICA: Usar modelo estable (llamadas vía la pasarela LLM compartida)
+MODELO_NUTRIDOR = MODELO_PRO
+if not llm_disponible():
     logging.error("❌ SIN CEREBRO: GOOGLE_API_KEY no encontrada.")
-    modelo_ia = None
+
+# Prospectos por trozo: se reclaman, se redactan y se confirman juntos (un commit por trozo)
+NUTRIDOR_TAMANO_TROZO = int(os.environ.get("NUTRIDOR_TAMANO_TROZO", "20"))
+# Emails redactados en paralelo dentro de un trozo (la pasarela LLM pone el techo real)
+NUTRIDOR_CONCURRENCIA = int(os.environ.get("NUTRIDOR_CONCURRENCIA", "3"))
+# Segundos máximos por ciclo; lo que falte se retoma en el próximo desde el cursor
+NUTRIDOR_PRESUPUESTO_SEG = float(os.environ.get("NUTRIDOR_PRESUPUESTO_SEG", "300"))
+
+# Las tres jugadas del ajedrez: (nombre, condición, tipo de email, estado siguiente)
+JUGADAS = (
+    ("valor", "p.status = 'persuadido' AND p.updated_at < NOW() - INTERVAL '3 DAYS'", "VALOR", "en_nutricion_1"),
+    ("prueba_social", "p.status = 'en_nutricion_1' AND p.updated_at < NOW() - INTERVAL '4 DAYS'", "PRUEBA_SOCIAL", "en_nutricion_2"),
+    ("despedida", "p.status = 'en_nutricion_2' AND p.updated_at < NOW() - INTERVAL '5 DAYS'", "DESPEDIDA", "lead_frio"),
+)
+
+_esquema_listo = False
+_esquema_lock = threading.Lock()
+
+def asegurar_tabla_cursor():
+    """Cursor por jugada: último id procesado (TEXT, sirve tanto para uuid como para enteros)."""
+    global _esquema_listo
+    if _esquema_listo:
+        return
+    with _esquema_lock:
+        if _esquema_listo:
+            return
+        with conexion() as conn, conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS nutridor_cursor (
+                    jugada TEXT PRIMARY KEY,
+                    ultimo_id TEXT,
+                    actualizado_en TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                );
+            """)
+            conn.commit()
+        _esquema_listo = True
 
 class TrabajadorNutridor:
     def __init__(self):
         self.db_url = DATABASE_URL
 
     def conectar_db(self):
-        return psycopg2.connect(self.db_url)
+        """Conexión del pool compartido. Usar como `with self.conectar_db() as conn:`."""
+        return conexion()
 
     # ==============================================================================
     # 🧠 MODO CHAT (INTERACTIVO)
@@ -38,128 +77,163 @@ class TrabajadorNutridor:
         Responde al chat del Nido y cuenta interacciones.
         """
         logging.info(f"💬 Chat recibido en Nido (Token: {token_acceso})")
-        conn = self.conectar_db()
-        cur = conn.cursor()
         respuesta_final = "Lo siento, estoy teniendo problemas de conexión. Intenta de nuevo."
 
         try:
-            # CORRECCIÓN: Tablas y Columnas en Inglés
-            query = """
-                SELECT 
-                    p.id, 
-                    p.business_name, 
-                    p.pain_points, 
-                    p.nurture_interactions_count,
-                    c.campaign_name, 
-                    c.product_description,
-                    c.campaign_name
-                FROM prospects p
-                JOIN campaigns c ON p.campaign_id = c.id
-                WHERE p.access_token = %s
-            """
-            cur.execute(query, (token_acceso,))
-            data = cur.fetchone()
-
-            if not data:
+            contexto = obtener_cache_contexto().obtener(token_acceso)
+            if not contexto:
                 return "Error: Token de sesión inválido."
 
-            pid, p_nombre, p_dolores, interacciones, c_cliente, c_producto, c_campana = data
-
-            # Parsear dolores
-            texto_dolores = ""
-            if p_dolores:
-                if isinstance(p_dolores, dict):
-                    texto_dolores = ", ".join(p_dolores.get("dolores_detectados", []))
-                elif isinstance(p_dolores, str):
-                    try: texto_dolores = ", ".join(json.loads(p_dolores).get("dolores_detectados", []))
-                    except: pass
-
-            # Prompt IA
-            prompt_analisis = f"""
-            Eres el Asistente de Ventas IA de '{c_cliente}'.
-            Estás hablando con '{p_nombre}'.
-            Producto que vendes: {c_producto}
-            Dolores del prospecto: {texto_dolores}
-            Mensaje del usuario: "{mensaje_usuario}"
-            Instrucciones: Responde como experto consultor, sé breve y profesional.
-            """
-
-            respuesta_ia = modelo_ia.generate_content(prompt_analisis)
+            # Carril interactivo: hay una persona esperando, adelanta a los trabajos por lotes
+            respuesta_ia = generar(self._prompt_chat(contexto, mensaje_usuario), modelo=MODELO_NUTRIDOR, prioridad=INTERACTIVO)
             respuesta_final = respuesta_ia.text.strip()
-
-            # CORRECCIÓN: Actualizar contador 'nurture_interactions_count'
-            nuevo_conteo = (interacciones or 0) + 1
-            cur.execute("""
-                UPDATE prospects 
-                SET nurture_interactions_count = %s,
-                    updated_at = NOW()
-                WHERE id = %s
-            """, (nuevo_conteo, pid))
-            
-            conn.commit()
-            logging.info(f"✅ Respuesta generada. Interacciones: {nuevo_conteo}")
+            self._contar_interaccion(contexto["id"])
 
         except Exception as e:
             logging.error(f"Error en Chat Nutridor: {e}")
-            if conn: conn.rollback()
-        finally:
-            cur.close()
-            conn.close()
 
         return respuesta_final
 
+    def responder_chat_nido_stream(self, token_acceso, mensaje_usuario):
+        """
+        Igual que responder_chat_nido pero entrega la respuesta por trozos según la genera Gemini.
+        Lanza ValueError si el token no es válido (antes de emitir nada).
+        """
+        logging.info(f"💬 Chat (stream) recibido en Nido (Token: {token_acceso})")
+        contexto = obtener_cache_contexto().obtener(token_acceso)
+        if not contexto:
+            raise ValueError("Token de sesión inválido.")
+
+        inicio = time.time()
+        primer_trozo = None
+        for texto in generar_stream(self._prompt_chat(contexto, mensaje_usuario), modelo=MODELO_NUTRIDOR, prioridad=INTERACTIVO):
+            if primer_trozo is None:
+                primer_trozo = time.time() - inicio
+            yield texto
+
+        self._contar_interaccion(contexto["id"])
+        logging.info(f"✅ Respuesta en stream: primer trozo {primer_trozo or 0:.2f}s, total {time.time() - inicio:.2f}s")
+
+    def _prompt_chat(self, contexto, mensaje_usuario):
+        # Prompt IA
+        return f"""
+                Eres el Asistente de Ventas IA de '{contexto["cliente"]}'.
+                Estás hablando con '{contexto["nombre"]}'.
+                Producto que vendes: {contexto["producto"]}
+                Dolores del prospecto: {contexto["dolores"]}
+                Mensaje del usuario: "{mensaje_usuario}"
+                Instrucciones: Responde como experto consultor, sé breve y profesional.
+                """
+
+    def _contar_interaccion(self, pid):
+        # Write-behind: se suma en memoria y se vuelca en lote (el chat no espera a la BD)
+        sumar_interaccion(pid)
+
     # ==============================================================================
     # ♟️ MODO AJEDREZ (SEGUIMIENTO)
     # ==============================================================================
 
-    def ejecutar_ciclo_seguimiento(self):
+    def ejecutar_ciclo_seguimiento(self, presupuesto_seg=None):
+        """
+        Ronda de seguimiento por trozos: cada trozo se reclama, se redacta en paralelo y se
+        confirma en su propia transacción corta. Las jugadas se turnan trozo a trozo y la ronda
+        se corta al agotar el presupuesto de tiempo; el cursor de cada jugada guarda dónde seguir.
+        """
         logging.info("♟️ Iniciando ronda de Seguimiento (Ajedrez)...")
-        conn = self.conectar_db()
-        cur = conn.cursor()
+        presupuesto = presupuesto_seg or NUTRIDOR_PRESUPUESTO_SEG
+        inicio = time.time()
+        totales = {nombre: 0 for nombre, _, _, _ in JUGADAS}
+        activas = list(JUGADAS)
 
         try:
-            # CORRECCIÓN: Tablas y Columnas en Inglés
-            # JUGADA 1: APORTE DE VALOR
-            cur.execute("""
-                SELECT p.id, p.business_name, p.pain_points, c.product_description 
-                FROM prospects p JOIN campaigns c ON p.campaign_id = c.id
-                WHERE p.status = 'persuadido' 
-                AND p.updated_at < NOW() - INTERVAL '3 DAYS'
-            """)
-            for row in cur.fetchall():
-                self._generar_y_guardar_email(cur, row, "VALOR", "en_nutricion_1")
+            asegurar_tabla_cursor()
+            with ThreadPoolExecutor(max_workers=max(1, NUTRIDOR_CONCURRENCIA), thread_name_prefix="nutridor") as ejecutor:
+                while activas and time.time() - inicio < presupuesto:
+                    for jugada in list(activas):
+                        if time.time() - inicio >= presupuesto:
+                            break
+                        guardados = self._procesar_trozo(jugada, ejecutor)
+                        if guardados:
+                            totales[jugada[0]] += guardados
+                        else:
+                            activas.remove(jugada)
+        except Exception as e:
+            logging.error(f"Error en ciclo de seguimiento: {e}")
 
-            # JUGADA 2: PRUEBA SOCIAL
-            cur.execute("""
-                SELECT p.id, p.business_name, p.pain_points, c.product_description 
-                FROM prospects p JOIN campaigns c ON p.campaign_id = c.id
-                WHERE p.status = 'en_nutricion_1' 
-                AND p.updated_at < NOW() - INTERVAL '4 DAYS'
-            """)
-            for row in cur.fetchall():
-                self._generar_y_guardar_email(cur, row, "PRUEBA_SOCIAL", "en_nutricion_2")
+        duracion = time.time() - inicio
+        estado = "completada" if not activas else "cortada por presupuesto (se retoma en el próximo ciclo)"
+        logging.info(f"🏁 Ronda de seguimiento {estado} en {duracion:.1f}s. Emails: {totales}")
 
-            # JUGADA 3: DESPEDIDA
-            cur.execute("""
-                SELECT p.id, p.business_name, p.pain_points, c.product_description 
-                FROM prospects p JOIN campaigns c ON p.campaign_id = c.id
-                WHERE p.status = 'en_nutricion_2' 
-                AND p.updated_at < NOW() - INTERVAL '5 DAYS'
-            """)
-            for row in cur.fetchall():
-                self._generar_y_guardar_email(cur, row, "DESPEDIDA", "lead_frio")
+    def _leer_cursor(self, jugada):
+        with self.conectar_db() as conn, conn.cursor() as cur:
+            cur.execute("SELECT ultimo_id FROM nutridor_cursor WHERE jugada = %s", (jugada,))
+            fila = cur.fetchone()
+        return fila[0] if fila else None
+
+    def _guardar_cursor(self, cur, jugada, ultimo_id):
+        cur.execute("""
+            INSERT INTO nutridor_cursor (jugada, ultimo_id, actualizado_en) VALUES (%s, %s, NOW())
+            ON CONFLICT (jugada) DO UPDATE SET ultimo_id = EXCLUDED.ultimo_id, actualizado_en = NOW()
+        """, (jugada, ultimo_id))
+
+    def _reclamar(self, condicion_sql, desde_id=None):
+        """
+        Reclama (con lease) el siguiente trozo de una jugada en orden de id, a partir del cursor,
+        para que otro Nutridor no los repita.
+        """
+        parametros = ()
+        if desde_id is not None:
+            # El literal sin tipo se convierte al tipo de prospects.id (uuid o entero)
+            condicion_sql = f"({condicion_sql}) AND p.id > %s"
+            parametros = (desde_id,)
+        return reclamar_lote(
+            "nutridor",
+            condicion_sql,
+            "p.id, p.business_name, p.pain_points, c.product_description",
+            NUTRIDOR_TAMANO_TROZO,
+            parametros=parametros,
+            orden_sql="p.id"
+        )
+
+    def _procesar_trozo(self, jugada, ejecutor):
+        """Un trozo de una jugada: reclamar -> redactar en paralelo -> un commit. Devuelve cuántos emails se guardaron."""
+        nombre, condicion, tipo_jugada, nuevo_estado = jugada
 
+        cursor = self._leer_cursor(nombre)
+        dueno, filas = self._reclamar(condicion, cursor)
+        if not filas and cursor is not None:
+            # Llegamos al final: damos la vuelta para recoger lo que quedó antes del cursor
+            dueno, filas = self._reclamar(condicion)
+        if not filas:
+            return 0
+
+        # La redacción (lo lento) ocurre sin ninguna transacción abierta
+        redactados = list(ejecutor.map(lambda fila: self._redactar_email(fila, tipo_jugada), filas))
+        listos = [(nuevo_estado, texto, pid, dueno) for pid, texto in redactados if texto]
+        fallidos = [pid for pid, texto in redactados if not texto]
+
+        with self.conectar_db() as conn, conn.cursor() as cur:
+            # CORRECCIÓN: 'status' y 'draft_message'
+            execute_batch(cur, """
+                UPDATE prospects 
+                SET status = %s,
+                    draft_message = %s,
+                    claim_expires_at = NULL,
+                    updated_at = NOW()
+                WHERE id = %s AND claimed_by = %s
+            """, listos)
+            self._guardar_cursor(cur, nombre, str(max(f[0] for f in filas)))
             conn.commit()
-            logging.info("🏁 Ronda de seguimiento completada.")
+        contar_transicion(nuevo_estado, len(listos))
 
-        except Exception as e:
-            logging.error(f"Error en ciclo de seguimiento: {e}")
-            conn.rollback()
-        finally:
-            cur.close()
-            conn.close()
+        # Los que fallaron vuelven a la cola ya (no esperan a que venza el lease)
+        liberar(fallidos, dueno)
+        logging.info(f"📧 Jugada {tipo_jugada}: {len(listos)} emails guardados, {len(fallidos)} fallidos en este trozo.")
+        # Si no salió ninguno (p.ej. Gemini caído) la jugada se deja para el próximo ciclo
+        return len(listos)
 
-    def _generar_y_guardar_email(self, cur, datos, tipo_jugada, nuevo_estado):
+    def _redactar_email(self, datos, tipo_jugada):
+        """Redacta el email de una jugada. Devuelve (id, texto) o (id, None) si la IA falló. No toca la BD."""
         pid, nombre, dolores, producto = datos
         prompt = ""
         asunto = ""
@@ -175,19 +249,11 @@ class TrabajadorNutridor:
             asunto = "¿Cerramos el expediente?"
 
         try:
-            res = modelo_ia.generate_content(prompt)
-            # CORRECCIÓN: 'status' y 'draft_message'
-            cur.execute("""
-                UPDATE prospects 
-                SET status = %s,
-                    draft_message = %s,
-                    updated_at = NOW()
-                WHERE id = %s
-            """, (nuevo_estado, f"ASUNTO: {asunto}\n\n{res.text}", pid))
-            
-            logging.info(f"📧 Email ({tipo_jugada}) generado para ID {pid}")
+            res = generar(prompt, modelo=MODELO_NUTRIDOR, prioridad=LOTE)
+            return pid, f"ASUNTO: {asunto}\n\n{res.text}"
         except Exception as e:
             logging.error(f"Fallo generando email para {pid}: {e}")
+            return pid, None
 
 # --- ENTRY POINT ---
 if __name__ == "__main__":
@@ -2,13 +2,16 @@ import os
 import time
 import json
 import logging
-import psycopg2
 import threading
 import random
 from datetime import datetime, timedelta
 from psycopg2.extras import Json
-import google.generativeai as genai
 from dotenv import load_dotenv
+from pool_conexiones import conexion
+from kpis_dashboard import reconciliar_kpis
+from planificador import PlanificadorTrabajos
+from cache_estrategias import obtener_estrategia, metricas_estrategias
+from pasarela_llm import generar, llm_disponible, metricas_llm, MODELO_RAPIDO, LOTE
 
 # --- IMPORTACIÓN DE TUS EMPLEADOS (LOS TRABAJADORES) ---
 try:
@@ -38,26 +41,25 @@ logging.basicConfig(
 )
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
 # Configuración del Cerebro Estratégico
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    # MODELO RÁPIDO PARA EL ORQUESTADOR
-    MODELO_ESTRATEGICO_ID = 'models/gemini-2.0-flash'
-    modelo_estrategico = genai.GenerativeModel(MODELO_ESTRATEGICO_ID)
+# MODELO RÁPIDO PARA EL ORQUESTADOR (las llamadas pasan por la pasarela LLM compartida)
+MODELO_ESTRATEGICO_ID = MODELO_RAPIDO
+if llm_disponible():
     logging.info(f"🧠 Cerebro conectado usando: {MODELO_ESTRATEGICO_ID}")
 else:
     logging.warning("⚠️ CEREBRO DESCONECTADO: No hay API Key de Google. El Orquestador será menos inteligente.")
-    modelo_estrategico = None
 
 class OrquestadorSupremo:
     def __init__(self):
         # Inicializamos solo al Nutridor aquí, los demás son funciones autónomas
         self.nutridor = TrabajadorNutridor()
+        # Pool fijo de hilos para Cazador/Espía con single-flight por (trabajador, campaña)
+        self.planificador = PlanificadorTrabajos()
         
     def conectar_db(self):
-        return psycopg2.connect(DATABASE_URL)
+        """Conexión del pool compartido. Usar como `with self.conectar_db() as conn:`."""
+        return conexion()
 
     # ==============================================================================
     # 💰 MÓDULO 1: DEPARTAMENTO FINANCIERO
@@ -66,60 +68,63 @@ class OrquestadorSupremo:
     def gestionar_finanzas_clientes(self):
         """Revisa pagos, envía alertas y corta el servicio a morosos."""
         logging.info("💼 Revisando estado de cuentas y pagos...")
-        conn = self.conectar_db()
-        cur = conn.cursor()
+        with self.conectar_db() as conn:
+            cur = conn.cursor()
         
-        try:
-            # 1. ALERTA DE PAGO PRÓXIMO
-            cur.execute("""
-                SELECT id, email, full_name, next_payment_date 
-                FROM clients 
-                WHERE is_active = TRUE 
-                AND next_payment_date BETWEEN NOW() AND NOW() + INTERVAL '3 DAYS'
-                AND payment_alert_sent = FALSE
-            """)
-            for c in cur.fetchall():
-                self.enviar_notificacion(c[1], "Tu suscripción vence pronto", f"Hola {c[2]}, recuerda recargar.")
-                cur.execute("UPDATE clients SET payment_alert_sent = TRUE WHERE id = %s", (c[0],))
-
-            # 2. PROCESAMIENTO DE COBROS
-            cur.execute("""
-                SELECT id, email, balance, plan_cost 
-                FROM clients 
-                WHERE is_active = TRUE AND next_payment_date <= NOW()
-            """)
-            for c in cur.fetchall():
-                cid, email, saldo, costo = c or (0, "", 0, 0)
-                costo = costo or 0
+            try:
+                # 1. ALERTA DE PAGO PRÓXIMO
+                cur.execute("""
+                    SELECT id, email, full_name, next_payment_date 
+                    FROM clients 
+                    WHERE is_active = TRUE 
+                    AND next_payment_date BETWEEN NOW() AND NOW() + INTERVAL '3 DAYS'
+                    AND payment_alert_sent = FALSE
+                """)
+                for c in cur.fetchall():
+                    self.enviar_notificacion(c[1], "Tu suscripción vence pronto", f"Hola {c[2]}, recuerda recargar.")
+                    cur.execute("UPDATE clients SET payment_alert_sent = TRUE WHERE id = %s", (c[0],))
+
+                # 2. PROCESAMIENTO DE COBROS
+                cur.execute("""
+                    SELECT id, email, balance, plan_cost 
+                    FROM clients 
+                    WHERE is_active = TRUE AND next_payment_date <= NOW()
+                """)
+                for c in cur.fetchall():
+                    cid, email, saldo, costo = c or (0, "", 0, 0)
+                    costo = costo or 0
                 
-                if saldo and saldo >= costo:
-                    nuevo_saldo = saldo - costo
-                    cur.execute("""
-                        UPDATE clients 
-                        SET balance = %s, next_payment_date = next_payment_date + INTERVAL '30 DAYS', payment_alert_sent = FALSE 
-                        WHERE id = %s
-                    """, (nuevo_saldo, cid))
-                    logging.info(f"✅ Cobro exitoso: Cliente {cid}. Nuevo ciclo iniciado.")
-                elif costo > 0:
-                    cur.execute("UPDATE clients SET is_active = FALSE, status = 'suspended_payment_fail' WHERE id = %s", (cid,))
-                    self.enviar_notificacion(email, "Servicio Suspendido", "No tienes saldo suficiente.")
-                    logging.warning(f"⛔ Cliente {cid} suspendido por falta de fondos.")
-
-            conn.commit()
+                    if saldo and saldo >= costo:
+                        nuevo_saldo = saldo - costo
+                        cur.execute("""
+                            UPDATE clients 
+                            SET balance = %s, next_payment_date = next_payment_date + INTERVAL '30 DAYS', payment_alert_sent = FALSE 
+                            WHERE id = %s
+                        """, (nuevo_saldo, cid))
+                        logging.info(f"✅ Cobro exitoso: Cliente {cid}. Nuevo ciclo iniciado.")
+                    elif costo > 0:
+                        cur.execute("UPDATE clients SET is_active = FALSE, status = 'suspended_payment_fail' WHERE id = %s", (cid,))
+                        self.enviar_notificacion(email, "Servicio Suspendido", "No tienes saldo suficiente.")
+                        logging.warning(f"⛔ Cliente {cid} suspendido por falta de fondos.")
+
+                conn.commit()
 
-        except Exception as e:
-            logging.error(f"Error crítico en finanzas: {e}")
-            conn.rollback()
-        finally:
-            cur.close()
-            conn.close()
+            except Exception as e:
+                logging.error(f"Error crítico en finanzas: {e}")
+                conn.rollback()
+            finally:
+                cur.close()
 
     # ==============================================================================
     # 🧠 MÓDULO 2: ESTRATEGIA DE MERCADO
     # ==============================================================================
 
-    def planificar_estrategia_caza(self, descripcion_producto, audiencia_objetivo, tipo_producto):
-        """Define si buscar en Maps, TikTok o Instagram y qué palabra clave usar."""
+    def planificar_estrategia_caza(self, descripcion_producto, audiencia_objetivo, tipo_producto, campana_id=None):
+        """
+        Define si buscar en Maps, TikTok o Instagram y qué palabra clave usar.
+        Con `campana_id` pasa por la caché de estrategias (misma campaña y mismas entradas
+        -> se rota entre estrategias ya pensadas en vez de volver a preguntar a Gemini).
+        """
         opciones = ["Google Maps"]
         if "intangible" in str(tipo_producto).lower() or "software" in str(descripcion_producto).lower():
             opciones.extend(["TikTok", "Instagram"])
@@ -127,9 +132,19 @@ class OrquestadorSupremo:
         platform_default = random.choice(opciones)
         query_default = audiencia_objetivo
 
-        if not modelo_estrategico:
+        if not llm_disponible():
             return query_default, platform_default
 
+        def consultar_ia():
+            return self._consultar_estrategia_ia(descripcion_producto, audiencia_objetivo, tipo_producto)
+
+        estrategia = obtener_estrategia(campana_id, descripcion_producto, audiencia_objetivo, tipo_producto, consultar_ia)
+        if not estrategia:
+            return query_default, platform_default
+        return estrategia[0] or query_default, estrategia[1] or platform_default
+
+    def _consultar_estrategia_ia(self, descripcion_producto, audiencia_objetivo, tipo_producto):
+        """Una llamada a Gemini. Devuelve (query, platform) o None si falló."""
         prompt = f"""
         Eres un Estratega de Marketing B2B.
         PRODUCTO: {descripcion_producto}
@@ -143,97 +158,108 @@ class OrquestadorSupremo:
         Responde SOLO con un JSON: {{"query": "...", "platform": "..."}}
         """
         try:
-            res = modelo_estrategico.generate_content(prompt)
+            res = generar(prompt, modelo=MODELO_ESTRATEGICO_ID, prioridad=LOTE)
             data = json.loads(res.text.replace("```json", "").replace("```", "").strip())
-            return data.get("query", query_default), data.get("platform", platform_default)
+            if not data.get("query") or not data.get("platform"):
+                return None
+            return data["query"], data["platform"]
         except:
-            return query_default, platform_default
+            return None
 
     # ==============================================================================
     # ⚙️ MÓDULO 3: COORDINACIÓN DE TRABAJADORES
     # ==============================================================================
 
     def ejecutar_trabajador_cazador_thread(self, cid, query, ubic, plat, limite_diario):
-        """Lanza el Cazador en un hilo paralelo."""
+        """
+        Trabajo del Cazador (corre en un hilo del planificador).
+        Devuelve el resultado de la caza: False cuenta como fallido en el planificador.
+        """
         try:
             logging.info(f"🧵 Hilo de Caza iniciado para Campaña {cid} en {plat}")
             # Llama al Cazador nuevo con el parámetro correcto de límite diario
-            ejecutar_caza(cid, query, ubic, plat, tipo_producto="Variable", limite_diario_contratado=limite_diario)
+            return ejecutar_caza(cid, query, ubic, plat, tipo_producto="Variable", limite_diario_contratado=limite_diario)
         except Exception as e:
             logging.error(f"Error en hilo de caza {cid}: {e}")
+            raise
 
     def ejecutar_trabajador_espia_thread(self, cid, limite_diario):
-        """Lanza el Espía en un hilo paralelo."""
+        """Trabajo del Espía (corre en un hilo del planificador)."""
         try:
             logging.info(f"🧵 Hilo de Espionaje iniciado para Campaña {cid}")
-            ejecutar_espia(cid, limite_diario_contratado=limite_diario)
+            return ejecutar_espia(cid, limite_diario_contratado=limite_diario)
         except Exception as e:
             logging.error(f"Error en hilo de espía {cid}: {e}")
+            raise
 
     def coordinar_operaciones_diarias(self):
         """Verifica metas diarias y activa a los trabajadores."""
-        conn = self.conectar_db()
-        cur = conn.cursor()
-        
         try:
-            # A. OBTENER CAMPAÑAS ACTIVAS (Leyendo daily_prospects_limit)
-            cur.execute("""
-                SELECT c.id, c.campaign_name, c.product_description, c.target_audience, 
-                       c.product_type, c.daily_prospects_limit, c.geo_location
-                FROM campaigns c
-                JOIN clients cl ON c.client_id = cl.id
-                WHERE c.status = 'active' AND cl.is_active = TRUE
-            """)
-            campanas_activas = cur.fetchall()
-            
+            # A. OBTENER CAMPAÑAS ACTIVAS Y SU PROGRESO DE HOY (lectura corta: la conexión
+            # vuelve al pool antes de pensar estrategias, dormir o correr el Nutridor)
+            with self.conectar_db() as conn, conn.cursor() as cur:
+                cur.execute("""
+                    SELECT c.id, c.campaign_name, c.product_description, c.target_audience, 
+                           c.product_type, c.daily_prospects_limit, c.geo_location
+                    FROM campaigns c
+                    JOIN clients cl ON c.client_id = cl.id
+                    WHERE c.status = 'active' AND cl.is_active = TRUE
+                """)
+                campanas_activas = cur.fetchall()
+
+                # B. VERIFICAR PROGRESO (una consulta para todas las campañas)
+                cazados_hoy = {}
+                if campanas_activas:
+                    cur.execute("""
+                        SELECT campaign_id, COUNT(*) FROM prospects 
+                        WHERE campaign_id = ANY(%s)
+                        AND created_at::date = CURRENT_DATE
+                        AND status = 'cazado'
+                        GROUP BY campaign_id
+                    """, ([c[0] for c in campanas_activas],))
+                    cazados_hoy = dict(cur.fetchall())
+                conn.commit()
+
             logging.info(f"⚙️ Coordinando {len(campanas_activas)} campañas activas...")
 
             for camp in campanas_activas:
                 camp_id, nombre, prod, audiencia, tipo_prod, limite_diario, ubicacion = camp
-                
+
                 # Default de seguridad
                 if not limite_diario: limite_diario = 4
 
-                # B. VERIFICAR PROGRESO
-                cur.execute("""
-                    SELECT COUNT(*) FROM prospects 
-                    WHERE campaign_id = %s 
-                    AND created_at::date = CURRENT_DATE
-                    AND status = 'cazado'
-                """, (camp_id,))
-                
-                cazados_hoy = cur.fetchone()[0]
-                
-                logging.info(f"📊 Estado '{nombre}': {cazados_hoy} cazados hoy. Activando trabajadores...")
-
-                # 1. PENSAR ESTRATEGIA (IA)
-                query_optimizada, plataforma = self.planificar_estrategia_caza(prod, audiencia, tipo_prod)
-                
-                # 2. LANZAR CAZADOR (Thread)
-                t_caza = threading.Thread(
-                    target=self.ejecutar_trabajador_cazador_thread,
-                    args=(camp_id, query_optimizada, ubicacion, plataforma, limite_diario)
+                logging.info(f"📊 Estado '{nombre}': {cazados_hoy.get(camp_id, 0)} cazados hoy. Activando trabajadores...")
+
+                # 1. LANZAR CAZADOR (single-flight: si el anterior sigue en Apify, no se duplica)
+                clave_caza = ("cazador", camp_id)
+                if self.planificador.en_vuelo(clave_caza):
+                    logging.info(f"⏳ Cazador de '{nombre}' sigue en vuelo. No se relanza.")
+                else:
+                    # PENSAR ESTRATEGIA (IA) solo si de verdad se va a cazar
+                    query_optimizada, plataforma = self.planificar_estrategia_caza(prod, audiencia, tipo_prod, campana_id=camp_id)
+                    self.planificador.enviar(
+                        clave_caza, self.ejecutar_trabajador_cazador_thread,
+                        camp_id, query_optimizada, ubicacion, plataforma, limite_diario
+                    )
+
+                # 2. LANZAR ESPÍA
+                self.planificador.enviar(
+                    ("espia", camp_id), self.ejecutar_trabajador_espia_thread,
+                    camp_id, limite_diario
                 )
-                t_caza.start()
 
-                # 3. LANZAR ESPÍA (Thread)
-                t_espia = threading.Thread(
-                    target=self.ejecutar_trabajador_espia_thread,
-                    args=(camp_id, limite_diario)
-                )
-                t_espia.start()
-                
                 time.sleep(2)
 
+            logging.info(f"🧵 Planificador: {self.planificador.resumen()}")
+            logging.info(f"🗂️ Caché de estrategias: {metricas_estrategias()}")
+            logging.info(f"🤖 Pasarela LLM: {metricas_llm()}")
+
             # C. EL NUTRIDOR
             logging.info("♟️ Despertando al Nutridor...")
             self.nutridor.ejecutar_ciclo_seguimiento()
 
         except Exception as e:
             logging.error(f"Error en coordinación operaciones: {e}")
-        finally:
-            cur.close()
-            conn.close()
 
     # ==============================================================================
     # 📨 MÓDULO 4: REPORTES Y COMUNICACIÓN
@@ -243,39 +269,46 @@ class OrquestadorSupremo:
         logging.info(f"📧 [SIMULACION EMAIL] A: {email} | Asunto: {asunto}")
 
     def generar_reporte_diario(self):
-        conn = self.conectar_db()
-        cur = conn.cursor()
-        logging.info("📊 Generando reportes diarios...")
+        with self.conectar_db() as conn:
+            cur = conn.cursor()
+            logging.info("📊 Generando reportes diarios...")
         
-        try:
-            cur.execute("SELECT id, email, full_name FROM clients WHERE is_active = TRUE")
-            clientes = cur.fetchall()
+            try:
+                cur.execute("SELECT id, email, full_name FROM clients WHERE is_active = TRUE")
+                clientes = cur.fetchall()
             
-            for c in clientes:
-                cid, email, nombre = c
+                for c in clientes:
+                    cid, email, nombre = c
                 
-                # --- CORRECCIÓN CRÍTICA DE SQL AQUÍ ---
-                # Usamos 'p.status' para evitar la ambigüedad
-                cur.execute("""
-                    SELECT 
-                        COUNT(*) FILTER (WHERE p.status='cazado') as nuevos,
-                        COUNT(*) FILTER (WHERE p.status='persuadido') as listos_nutrir
-                    FROM prospects p
-                    JOIN campaigns cam ON p.campaign_id = cam.id
-                    WHERE cam.client_id = %s 
-                    AND p.created_at >= NOW() - INTERVAL '24 HOURS'
-                """, (cid,))
-                stats = cur.fetchone()
+                    # --- CORRECCIÓN CRÍTICA DE SQL AQUÍ ---
+                    # Usamos 'p.status' para evitar la ambigüedad
+                    cur.execute("""
+                        SELECT 
+                            COUNT(*) FILTER (WHERE p.status='cazado') as nuevos,
+                            COUNT(*) FILTER (WHERE p.status='persuadido') as listos_nutrir
+                        FROM prospects p
+                        JOIN campaigns cam ON p.campaign_id = cam.id
+                        WHERE cam.client_id = %s 
+                        AND p.created_at >= NOW() - INTERVAL '24 HOURS'
+                    """, (cid,))
+                    stats = cur.fetchone()
                 
-                if stats:
-                    cuerpo = f"Hola {nombre}, resumen de hoy: {stats[0]} nuevos encontrados, {stats[1]} listos para contactar."
-                    self.enviar_notificacion(email, "Reporte Diario AutoNeura", cuerpo)
+                    if stats:
+                        cuerpo = f"Hola {nombre}, resumen de hoy: {stats[0]} nuevos encontrados, {stats[1]} listos para contactar."
+                        self.enviar_notificacion(email, "Reporte Diario AutoNeura", cuerpo)
                     
+            except Exception as e:
+                logging.error(f"Error generando reportes: {e}")
+            finally:
+                cur.close()
+
+    def reconciliar_kpis_dashboard(self):
+        """Recuento diario de los KPIs del dashboard (los triggers los mantienen; esto corrige derivas)."""
+        try:
+            reconciliar_kpis()
+            logging.info("📐 KPIs del dashboard reconciliados.")
         except Exception as e:
-            logging.error(f"Error generando reportes: {e}")
-        finally:
-            cur.close()
-            conn.close()
+            logging.error(f"Error reconciliando KPIs: {e}")
 
     # ==============================================================================
     # 🏁 BUCLE PRINCIPAL
@@ -308,6 +341,7 @@ class OrquestadorSupremo:
                 # 3. Reportes Diarios
                 if datetime.now() > ultima_revision_reportes + timedelta(hours=24):
                     self.generar_reporte_diario()
+                    self.reconciliar_kpis_dashboard()
                     ultima_revision_reportes = datetime.now()
 
                 # 4. DESCANSO (10 Minutos)
@@ -317,6 +351,7 @@ class OrquestadorSupremo:
 
             except KeyboardInterrupt:
                 logging.info("🛑 Deteniendo sistema por orden del usuario...")
+                self.planificador.apagar(esperar=False)
                 break
             except Exception as e:
                 logging.critical(f"🔥 ERROR CATASTRÓFICO EN MAIN LOOP: {e}")
@@ -3,26 +3,58 @@ import json
 import logging
 import secrets
 import time
-import psycopg2
-from psycopg2.extras import Json
-import google.generativeai as genai
+from psycopg2.extras import Json, execute_batch
 from dotenv import load_dotenv
+from pool_conexiones import conexion
+from cola_trabajo import reclamar_lote, asegurar_columnas, registrar_fallos
+from pasarela_llm import generar, llm_disponible, MODELO_PRO, LOTE
+from metricas import contar_transicion
 
 # --- CONFIGURACIÓN ---
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - PERSUASOR - %(levelname)s - %(message)s')
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-
-# Configuración IA
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    # CAMBIO: Usamos el modelo estable que aparece en tu lista para evitar errores 404
-    modelo_ia = genai.GenerativeModel('models/gemini-pro-latest')
-else:
+
+# Configuración IA (la cuota de Google la regula la pasarela LLM compartida)
+# CAMBIO: Usamos el modelo estable que aparece en tu lista para evitar errores 404
+MODELO_PERSUASOR = MODELO_PRO
+if not llm_disponible():
     logging.error("❌ SIN CEREBRO: GOOGLE_API_KEY no encontrada.")
-    modelo_ia = None
+
+# --- RITMO DEL MOTOR ---
+# Tope de prospectos por reclamo; el tamaño real se ajusta al backlog pendiente
+PERSUASOR_LOTE_MAX = int(os.environ.get("PERSUASOR_LOTE_MAX", "20"))
+# Cuántos resultados se agrupan por escritura en BD
+PERSUASOR_LOTE_ESCRITURA = int(os.environ.get("PERSUASOR_LOTE_ESCRITURA", "5"))
+# Prospectos de una misma campaña que se piden a Gemini en UN solo prompt (1 = uno por llamada)
+PERSUASOR_LOTE_PROMPT = int(os.environ.get("PERSUASOR_LOTE_PROMPT", "5"))
+# Espera cuando no hay trabajo: empieza corta y crece hasta el máximo
+PERSUASOR_ESPERA_MIN = float(os.environ.get("PERSUASOR_ESPERA_MIN", "5"))
+PERSUASOR_ESPERA_MAX = float(os.environ.get("PERSUASOR_ESPERA_MAX", "120"))
+# Turnos fallidos (IA caída o contenido que no pasa los controles) antes de rendirse con un prospecto
+PERSUASOR_MAX_INTENTOS = int(os.environ.get("PERSUASOR_MAX_INTENTOS", "3"))
+
+CAMPOS_CONTENIDO = ("email_asunto", "email_cuerpo", "prenido_titulo", "prenido_mensaje")
+
+def limpiar_json(texto):
+    return texto.strip().replace("```json", "").replace("```", "").strip()
+
+def validar_contenido(contenido):
+    """Controles de calidad por prospecto. Devuelve el problema encontrado o None si está bien."""
+    if not isinstance(contenido, dict):
+        return "no es un objeto JSON"
+    for campo in CAMPOS_CONTENIDO:
+        valor = contenido.get(campo)
+        if not isinstance(valor, str) or not valor.strip():
+            return f"falta '{campo}'"
+    if len(contenido["email_asunto"].split()) > 12:
+        return "asunto demasiado largo"
+    if len(contenido["email_cuerpo"].split()) > 180:
+        return "email demasiado largo"
+    if "espero que estés bien" in contenido["email_cuerpo"].lower():
+        return "saludo prohibido"
+    return None
 
 def generar_contenido_persuasivo(nombre_prospecto, nombre_cliente, que_vende_cliente, puntos_dolor):
     """
@@ -57,98 +89,235 @@ def generar_contenido_persuasivo(nombre_prospecto, nombre_cliente, que_vende_cli
     """
 
     try:
-        respuesta = modelo_ia.generate_content(prompt)
-        texto_limpio = respuesta.text.strip().replace("```json", "").replace("```", "")
-        return json.loads(texto_limpio)
+        respuesta = generar(prompt, modelo=MODELO_PERSUASOR, prioridad=LOTE)
+        contenido = json.loads(limpiar_json(respuesta.text))
     except Exception as e:
         logging.error(f"Error generando contenido con IA: {e}")
         return None
 
-def trabajar_persuasor(limite_lote=5):
+    problema = validar_contenido(contenido)
+    if problema:
+        logging.warning(f"⚠️ Contenido descartado para {nombre_prospecto}: {problema}")
+        return None
+    return contenido
+
+def generar_contenido_lote(nombre_cliente, que_vende_cliente, prospectos):
     """
-    Busca prospectos 'analizados', genera su contenido y crea el token mágico.
+    Genera el contenido de VARIOS prospectos de la misma campaña en una sola llamada.
+    `prospectos` = [(id, nombre, dolores)]. Devuelve {str(id): contenido} solo con los
+    elementos que pasan la validación; los que falten se reintentan uno a uno.
     """
-    logging.info("🧠 INICIANDO TURNO DE PERSUASIÓN")
+    bloques = []
+    for pid, nombre, dolores in prospectos:
+        lista_dolores = ", ".join(dolores) if isinstance(dolores, list) and dolores else "falta de optimización digital"
+        bloques.append(f'    - id: "{pid}" | Prospecto: {nombre} | Dolor/Problema detectado: {lista_dolores}')
+    lista_prospectos = "\n".join(bloques)
+
+    prompt = f"""
+    Eres un experto en Copywriting Persuasivo y Ventas B2B.
+    
+    TUS DATOS:
+    - Vendedor (Cliente): {nombre_cliente}
+    - Producto/Servicio: {que_vende_cliente}
+    - Prospectos (Compradores):
+{lista_prospectos}
+
+    TU MISIÓN:
+    Para CADA prospecto genera 4 textos persuasivos para un embudo de ventas, centrados en SU dolor principal.
     
-    conn = None
+    ESTRUCTURA REQUERIDA: un ARRAY JSON con un objeto por prospecto, en el mismo orden:
+    [
+        {{
+            "id": "el id exacto del prospecto",
+            "email_asunto": "Un asunto corto y curioso (max 7 palabras)",
+            "email_cuerpo": "Un email corto (max 100 palabras). NO saludes con 'Espero que estés bien'. Ve al grano. Menciona su problema y diles que preparaste una demostración personalizada. El llamado a la acción es hacer clic en el enlace.",
+            "prenido_titulo": "Un título impactante para la página web (Círculo Negro). Debe prometer una solución a su problema.",
+            "prenido_mensaje": "Un párrafo persuasivo (Círculo Azul). Explica que ya hiciste un análisis preliminar y detectaste una oportunidad. Diles que para ver el reporte completo y la demo, solo necesitan confirmar su correo abajo."
+        }}
+    ]
+
+    IMPORTANTE: Responde SOLO con el array JSON. Sin bloques de código markdown.
+    """
+
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-
-        # 1. Obtener prospectos ANALIZADOS + Datos de la CAMPAÑA
-        # CORRECCIÓN: Tablas en Inglés (prospects, campaigns) y columnas correctas (pain_points, campaign_name)
-        query = """
-            SELECT 
-                p.id, 
-                p.business_name, 
-                p.pain_points,
-                c.campaign_name, 
-                c.product_description 
-            FROM prospects p
-            JOIN campaigns c ON p.campaign_id = c.id
-            WHERE p.status = 'analizado_exitoso'
-            LIMIT %s
-            FOR UPDATE OF p SKIP LOCKED
-        """
-        cur.execute(query, (limite_lote,))
-        lote = cur.fetchall()
-
-        if not lote:
-            logging.info("💤 No hay prospectos analizados esperando persuasión.")
-            return
+        respuesta = generar(prompt, modelo=MODELO_PERSUASOR, prioridad=LOTE)
+        datos = json.loads(limpiar_json(respuesta.text))
+    except Exception as e:
+        logging.error(f"Error generando contenido en lote ({len(prospectos)} prospectos): {e}")
+        return {}
+
+    # Aceptamos también {"id": {...}} por si el modelo devuelve un objeto en vez de array
+    if isinstance(datos, dict):
+        datos = [dict(v, id=k) for k, v in datos.items() if isinstance(v, dict)]
+    if not isinstance(datos, list):
+        return {}
 
-        logging.info(f"⚡ Procesando {len(lote)} prospectos para crear sus Nidos.")
-
-        for fila in lote:
-            pid, p_nombre, p_dolores, c_nombre, c_producto = fila
-            
-            # Parsear dolores si viene como string JSON o Dict
-            dolores_lista = []
-            if p_dolores:
-                if isinstance(p_dolores, str):
-                    try: 
-                        data = json.loads(p_dolores)
-                        dolores_lista = data.get("dolores_detectados", [])
-                    except: pass
-                elif isinstance(p_dolores, dict):
-                     dolores_lista = p_dolores.get("dolores_detectados", [])
-
-            # 2. Generar Contenido (Email + Landing)
-            contenido = generar_contenido_persuasivo(p_nombre, c_nombre, c_producto, dolores_lista)
-
-            if contenido:
-                # 3. Generar TOKEN ÚNICO (La llave del Nido)
-                token_unico = secrets.token_urlsafe(16)
-
-                # 4. Guardar Todo
-                # CORRECCIÓN: Columnas en Inglés (generated_content, access_token, status)
-                update_query = """
-                    UPDATE prospects
-                    SET 
-                        generated_content = %s,
-                        access_token = %s,
-                        status = 'persuadido',
-                        updated_at = NOW()
-                    WHERE id = %s
-                """
-                cur.execute(update_query, (Json(contenido), token_unico, pid))
-                conn.commit()
-                logging.info(f"✅ Prospecto {p_nombre} persuadido. Token: {token_unico}")
+    esperados = {str(pid) for pid, _, _ in prospectos}
+    contenidos = {}
+    for elemento in datos:
+        if not isinstance(elemento, dict):
+            continue
+        clave = str(elemento.get("id", "")).strip()
+        if clave not in esperados or clave in contenidos:
+            continue
+        contenido = {k: elemento.get(k) for k in CAMPOS_CONTENIDO}
+        problema = validar_contenido(contenido)
+        if problema:
+            logging.warning(f"⚠️ Elemento {clave} del lote descartado: {problema}")
+            continue
+        contenidos[clave] = contenido
+    return contenidos
+
+def extraer_dolores(p_dolores):
+    """Parsear dolores si viene como string JSON o Dict."""
+    dolores_lista = []
+    if p_dolores:
+        if isinstance(p_dolores, str):
+            try: 
+                data = json.loads(p_dolores)
+                dolores_lista = data.get("dolores_detectados", [])
+            except: pass
+        elif isinstance(p_dolores, dict):
+             dolores_lista = p_dolores.get("dolores_detectados", [])
+    return dolores_lista
+
+def contar_pendientes():
+    """Backlog real: analizados que nadie tiene reclamados ahora mismo."""
+    asegurar_columnas()
+    with conexion() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT COUNT(*) FROM prospects
+            WHERE status = 'analizado_exitoso'
+            AND (claim_expires_at IS NULL OR claim_expires_at < NOW())
+        """)
+        return cur.fetchone()[0]
+
+def guardar_resultados(resultados):
+    """Escribe un grupo de prospectos persuadidos en UNA transacción corta."""
+    if not resultados:
+        return
+    # CORRECCIÓN: Columnas en Inglés (generated_content, access_token, status)
+    with conexion() as conn, conn.cursor() as cur:
+        execute_batch(cur, """
+            UPDATE prospects
+            SET 
+                generated_content = %s,
+                access_token = %s,
+                status = 'persuadido',
+                claim_expires_at = NULL,
+                claim_attempts = 0,
+                updated_at = NOW()
+            WHERE id = %s AND claimed_by = %s
+        """, resultados)
+        conn.commit()
+    contar_transicion("persuadido", len(resultados))
+
+def procesar_lote_persuasion(limite_lote):
+    """
+    Reclama un lote (el reclamo se confirma al instante), genera el contenido
+    FUERA de cualquier transacción y lo guarda en grupos pequeños.
+    Devuelve cuántos prospectos se reclamaron.
+    """
+    # 1. Reclamar prospectos ANALIZADOS + Datos de la CAMPAÑA
+    dueno, lote = reclamar_lote(
+        "persuasor",
+        "p.status = 'analizado_exitoso'",
+        "p.id, p.business_name, p.pain_points, c.campaign_name, c.product_description",
+        limite_lote
+    )
+    if not lote:
+        return 0
+
+    logging.info(f"⚡ Procesando {len(lote)} prospectos para crear sus Nidos.")
+    pendientes_guardar = []
+    fallidos = []
+    llamadas = 0
+    inicio = time.time()
+
+    # Agrupamos por campaña: un mismo prompt comparte vendedor y producto
+    por_campana = {}
+    for fila in lote:
+        por_campana.setdefault((fila[3], fila[4]), []).append(fila)
+
+    for (c_nombre, c_producto), filas in por_campana.items():
+        for i in range(0, len(filas), max(1, PERSUASOR_LOTE_PROMPT)):
+            grupo = filas[i:i + max(1, PERSUASOR_LOTE_PROMPT)]
+
+            # 2. Generar Contenido (Email + Landing). La cuota de Google la regula la pasarela LLM.
+            contenidos = {}
+            if len(grupo) > 1:
+                llamadas += 1
+                contenidos = generar_contenido_lote(
+                    c_nombre, c_producto, [(f[0], f[1], extraer_dolores(f[2])) for f in grupo]
+                )
+
+            for pid, p_nombre, p_dolores, _, _ in grupo:
+                contenido = contenidos.get(str(pid))
+                if not contenido:
+                    # Solo los que fallaron en el lote (o lotes de uno) van por la vía individual
+                    llamadas += 1
+                    contenido = generar_contenido_persuasivo(p_nombre, c_nombre, c_producto, extraer_dolores(p_dolores))
+
+                if contenido:
+                    # 3. Generar TOKEN ÚNICO (La llave del Nido)
+                    token_unico = secrets.token_urlsafe(16)
+                    pendientes_guardar.append((Json(contenido), token_unico, pid, dueno))
+                    logging.info(f"✅ Prospecto {p_nombre} persuadido. Token: {token_unico}")
+                else:
+                    # Vuelve a la cola ya (sin esperar al lease); tras PERSUASOR_MAX_INTENTOS se abandona
+                    logging.warning(f"⚠️ Fallo al generar IA para {p_nombre}")
+                    fallidos.append(pid)
+
+                # 4. Guardar en grupos pequeños
+                if len(pendientes_guardar) >= PERSUASOR_LOTE_ESCRITURA:
+                    guardar_resultados(pendientes_guardar)
+                    pendientes_guardar = []
+
+    guardar_resultados(pendientes_guardar)
+    abandonados = registrar_fallos(fallidos, dueno, PERSUASOR_MAX_INTENTOS, "persuasion_fallida")
+    if abandonados:
+        contar_transicion("persuasion_fallida", abandonados)
+        logging.warning(f"🛑 {abandonados} prospectos pasan a 'persuasion_fallida' tras {PERSUASOR_MAX_INTENTOS} intentos.")
+    duracion = time.time() - inicio
+    logging.info(
+        f"📊 Lote de persuasión: {len(lote)} prospectos | {llamadas} llamadas a Gemini | "
+        f"{duracion / len(lote):.1f}s por prospecto"
+    )
+    return len(lote)
+
+def trabajar_persuasor(limite_lote=None, continuo=True):
+    """
+    Motor permanente de persuasión: busca prospectos 'analizados', genera su contenido
+    y crea el token mágico. El tamaño de cada lote sigue al backlog y, sin trabajo,
+    la espera crece de PERSUASOR_ESPERA_MIN a PERSUASOR_ESPERA_MAX.
+    Con continuo=False hace un solo turno (uso manual).
+    """
+    logging.info("🧠 INICIANDO MOTOR DE PERSUASIÓN")
+    espera = PERSUASOR_ESPERA_MIN
+
+    while True:
+        try:
+            pendientes = contar_pendientes()
+            tope = limite_lote or PERSUASOR_LOTE_MAX
+            reclamados = procesar_lote_persuasion(max(1, min(pendientes, tope))) if pendientes else 0
+
+            if reclamados:
+                espera = PERSUASOR_ESPERA_MIN
+                if pendientes > reclamados:
+                    logging.info(f"📈 Backlog de persuasión: {pendientes - reclamados} pendientes. Sigo sin pausa.")
+                    if continuo:
+                        continue
             else:
-                logging.warning(f"⚠️ Fallo al generar IA para {p_nombre}")
+                logging.info(f"💤 No hay prospectos analizados esperando persuasión. Reviso en {espera:.0f}s.")
 
-            # --- FRENO DE MANO PARA GOOGLE ---
-            # Esperamos 5 segundos entre cada petición para no saturar la API gratuita
-            logging.info("⏳ Pausando 20 segundos para respetar la cuota de Google...")
-            time.sleep(5)
+        except Exception as e:
+            logging.critical(f"❌ Error catastrófico en Persuasor: {e}")
+            espera = PERSUASOR_ESPERA_MAX
 
-    except Exception as e:
-        logging.critical(f"❌ Error catastrófico en Persuasor: {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
+        if not continuo:
+            return
+        time.sleep(espera)
+        espera = min(espera * 2, PERSUASOR_ESPERA_MAX)
 
 # --- ENTRY POINT ---
 if __name__ == "__main__":